@@ -0,0 +1,80 @@
+"""
+Бенчмарк клиента bePaid против локального фейкового сервера:
+новая сессия на каждый запрос (старое поведение) vs общий keep-alive пул.
+
+  python benchmarks/bench_bepaid.py --requests 300 --latency 0.005
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bepaid_api import BePaidAPI  # noqa: E402
+from fake_bepaid import FakeBePaid  # noqa: E402
+
+
+def _make_api(url: str) -> BePaidAPI:
+    return BePaidAPI("shop", "secret", test_mode=True, base_url=f"{url}/ctp/api", gateway_url=url)
+
+
+async def _call(api: BePaidAPI, i: int):
+    if i % 2:
+        await api.charge_recurrent(
+            amount=Decimal("30"), currency="BYN", description="bench",
+            order_id=f"{i}:0", card_token="tok", email="bench@example.com",
+        )
+    else:
+        await api.create_checkout_link(
+            amount=Decimal("30"), currency="BYN", description="bench",
+            order_id=f"{i}:0", email="bench@example.com",
+        )
+
+
+async def _run(url: str, requests: int, shared: bool):
+    timings = []
+    api = _make_api(url) if shared else None
+    for i in range(requests):
+        started = time.perf_counter()
+        if shared:
+            await _call(api, i)
+        else:
+            fresh = _make_api(url)
+            await _call(fresh, i)
+            await fresh.close()
+        timings.append(time.perf_counter() - started)
+    if api is not None:
+        await api.close()
+    return timings
+
+
+def _report(name: str, timings, connections: int):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(
+        f"{name:<16} mean={statistics.mean(timings) * 1000:7.2f}ms "
+        f"p50={statistics.median(timings) * 1000:7.2f}ms p95={p95 * 1000:7.2f}ms "
+        f"tcp_connections={connections}"
+    )
+
+
+async def main(args):
+    for shared in (False, True):
+        fake = FakeBePaid(latency=args.latency)
+        url = await fake.start()
+        try:
+            timings = await _run(url, args.requests, shared)
+        finally:
+            await fake.stop()
+        _report("shared pool" if shared else "session/request", timings, len(fake.connections))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка фейкового сервера, сек")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,340 @@
+"""
+Нагрузочный бенчмарк бота целиком против локальных фейков bePaid и Telegram Bot API.
+
+Создаёт временную базу с N синтетическими пользователями и прогоняет сценарии:
+  start     — /start через диспетчер (хендлер + БД + ответ в Telegram), задержка и апдейтов/сек;
+  webhook   — приём вебхуков bePaid по HTTP (ack) и разбор очереди webhook_worker;
+  scheduler — проход планировщика со списаниями должников;
+  outbox    — отправка накопившихся уведомлений;
+  broadcast — рассылка всем пользователям.
+
+  python benchmarks/bench_bot.py --users 10000 --due 1000 --output report.json
+  python benchmarks/bench_bot.py --users 10000 --due 1000 --compare report.json
+
+С --compare сравнивает с прошлым отчётом и завершается с кодом 1, если какая-то метрика
+хуже больше чем на --tolerance (по умолчанию 20%).
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import aiosqlite
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_bepaid import FakeBePaid  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+FIRST_USER_ID = 1_000_000
+ADMIN_ID = 999
+
+
+def _latency_stats(timings, total_elapsed):
+    timings = sorted(timings)
+
+    def pct(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+    return {
+        "count": len(timings),
+        "p50_ms": round(statistics.median(timings) * 1000, 3),
+        "p95_ms": round(pct(0.95), 3),
+        "p99_ms": round(pct(0.99), 3),
+        "throughput_per_s": round(len(timings) / total_elapsed, 1) if total_elapsed else 0.0,
+    }
+
+
+async def _seed(db_path, users, due, grace):
+    """Пользователи: due — должники с картой, grace — в грейсе без карты, остальные — активные."""
+    now = int(time.time())
+    rows = []
+    for i in range(users):
+        user_id = FIRST_USER_ID + i
+        if i < due:
+            rows.append((user_id, "tok", now - 60, None, None))
+        elif i < due + grace:
+            rows.append((user_id, "", now - 86400, now + 2 * 86400, now - 2 * 86400))
+        else:
+            rows.append((user_id, "tok", now + 30 * 86400, None, None))
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.executemany(
+            """
+            INSERT INTO users (id, username, full_name, agreed_to_terms, subscription_active, card_token,
+                               subscription_end_date, email, grace_until_ts, last_payment_fail_notice_ts)
+            VALUES (?, 'bench', 'Bench User', 1, 1, ?, ?, 'bench@example.com', ?, ?)
+            """,
+            rows,
+        )
+        await conn.commit()
+
+
+async def _count(db_path, query):
+    async with aiosqlite.connect(db_path) as conn:
+        async with conn.execute(query) as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def _wait_empty(db_path, query, timeout=600.0):
+    deadline = time.monotonic() + timeout
+    while await _count(db_path, query):
+        if time.monotonic() > deadline:
+            raise TimeoutError(query)
+        await asyncio.sleep(0.02)
+
+
+async def bench_start(bot_module, updates, concurrency):
+    from aiogram.types import Update
+
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one(i):
+        user_id = FIRST_USER_ID * 10 + i
+        update = Update.model_validate({
+            "update_id": i,
+            "message": {
+                "message_id": i, "date": int(time.time()), "text": "/start",
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            },
+        }, context={"bot": bot_module.bot})
+        async with semaphore:
+            started = time.perf_counter()
+            await bot_module.dp.feed_update(bot_module.bot, update)
+            timings.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    # cmd_start печатает USER ID в stdout — не засоряем отчёт
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(one(i) for i in range(updates)))
+    return _latency_stats(timings, time.perf_counter() - started)
+
+
+async def bench_webhook(bot_module, db_path, webhooks, concurrency, users):
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_post(bot_module.WEBHOOK_PATH, bot_module.bepaid_webhook_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{bot_module.WEBHOOK_PATH}"
+
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+    now = int(time.time())
+
+    async def one(session, i):
+        user_id = FIRST_USER_ID + (users - 1 - i % users)
+        payload = {"transaction": {
+            "uid": f"bench-{i}", "status": "successful", "tracking_id": f"{user_id}:{now}",
+            "amount": 3000, "currency": "BYN",
+            "credit_card": {"token": "tok"}, "customer": {"email": "bench@example.com"},
+        }}
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, json=payload) as response:
+                await response.read()
+                assert response.status == 200, response.status
+            timings.append(time.perf_counter() - started)
+
+    try:
+        started = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(one(session, i) for i in range(webhooks)))
+        ack = _latency_stats(timings, time.perf_counter() - started)
+
+        # Пул инвайтов, как у лидера: заполняем до замера, чтобы оплаты брали готовые ссылки
+        pool = bot_module.invite_pool
+        pool_task = asyncio.create_task(pool.run())
+        while await bot_module.db.count_free_invite_links(pool.chat_id) < pool.size:
+            await asyncio.sleep(0.05)
+
+        started = time.perf_counter()
+        workers = [asyncio.create_task(bot_module.webhook_worker()) for _ in range(bot_module.WEBHOOK_WORKERS)]
+        bot_module.webhook_wakeup.set()
+        await _wait_empty(db_path, "SELECT COUNT(*) FROM webhook_inbox WHERE state != 'failed'")
+        elapsed = time.perf_counter() - started
+        for task in workers + [pool_task]:
+            task.cancel()
+        await asyncio.gather(*workers, pool_task, return_exceptions=True)
+    finally:
+        await runner.cleanup()
+    return {
+        "ack_p50_ms": ack["p50_ms"],
+        "ack_p95_ms": ack["p95_ms"],
+        "ack_throughput_per_s": ack["throughput_per_s"],
+        "processed_per_s": round(webhooks / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+async def bench_scheduler(bot_module, due):
+    started = time.perf_counter()
+    await bot_module.run_scheduler_pass()
+    elapsed = time.perf_counter() - started
+    return {"pass_s": round(elapsed, 3), "charges_per_s": round(due / elapsed, 1) if elapsed else 0.0}
+
+
+async def bench_outbox(bot_module, db_path):
+    pending = await _count(db_path, "SELECT COUNT(*) FROM outbox WHERE state != 'failed'")
+    started = time.perf_counter()
+    task = asyncio.create_task(bot_module.notifier.run())
+    await _wait_empty(db_path, "SELECT COUNT(*) FROM outbox WHERE state != 'failed'")
+    elapsed = time.perf_counter() - started
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return {"messages": pending, "sent_per_s": round(pending / elapsed, 1) if elapsed else 0.0}
+
+
+async def bench_broadcast(bot_module, db_path):
+    recipients = await bot_module.db.count_broadcast_recipients()
+    started = time.perf_counter()
+    await bot_module.broadcaster.start(ADMIN_ID, 1, 0, 0)
+    await _wait_empty(db_path, "SELECT COUNT(*) FROM broadcasts WHERE state = 'running'")
+    elapsed = time.perf_counter() - started
+    return {"recipients": recipients, "sent_per_s": round(recipients / elapsed, 1) if elapsed else 0.0}
+
+
+def _compare(report, baseline, tolerance):
+    """Метрики *_per_s — больше лучше, *_ms / *_s — меньше лучше. Возвращает список регрессий."""
+    regressions = []
+    for scenario, values in report["results"].items():
+        for key, value in values.items():
+            old = baseline.get("results", {}).get(scenario, {}).get(key)
+            if not isinstance(old, (int, float)) or not old:
+                continue
+            if key.endswith("_per_s"):
+                change = (old - value) / old
+            elif key.endswith("_ms") or key.endswith("_s"):
+                change = (value - old) / old
+            else:
+                continue
+            marker = "REGRESSION" if change > tolerance else ""
+            print(f"  {scenario}.{key:<22} {old:>12} -> {value:>12}  {-change * 100:+7.1f}% {marker}")
+            if marker:
+                regressions.append(f"{scenario}.{key}")
+    return regressions
+
+
+async def main(args):
+    fake_bepaid = FakeBePaid(latency=args.bepaid_latency, fail_rate=args.fail_rate, error_rate=args.error_rate)
+    fake_telegram = FakeTelegram(
+        latency=args.telegram_latency, global_limit=args.telegram_global_limit, blocked_rate=args.blocked_rate,
+    )
+    bepaid_url = await fake_bepaid.start()
+    telegram_url = await fake_telegram.start()
+    workdir = tempfile.mkdtemp(prefix="bench_bot_")
+    db_path = os.path.join(workdir, "bench.db")
+
+    # Окружение бота — до импорта bot.py: он читает настройки при импорте
+    os.environ.update({
+        "DB_NAME": db_path,
+        "BOT_TOKEN": "123456:bench",
+        "BEPAID_SHOP_ID": "shop",
+        "BEPAID_SECRET_KEY": "secret",
+        "CHANNEL_ID": "-1001",
+        "ADMIN_IDS": str(ADMIN_ID),
+        "TELEGRAM_API_URL": telegram_url,
+        "FSM_STORAGE": "memory",
+        "CHARGE_RATE_LIMIT": str(args.charge_rate),
+        "BROADCAST_RATE_LIMIT": str(args.telegram_rate),
+        "OUTBOX_RATE_LIMIT": str(args.telegram_rate),
+        "INVITE_POOL_SIZE": str(args.webhooks),
+    })
+    import bot as bot_module
+    from bepaid_api import BePaidAPI
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # Отказы bePaid, заданные --fail-rate, ожидаемы — не засоряем вывод
+    logging.getLogger("bepaid_api").setLevel(logging.CRITICAL)
+    bot_module.bepaid = BePaidAPI("shop", "secret", test_mode=True, base_url=f"{bepaid_url}/ctp/api",
+                                  gateway_url=bepaid_url, retry_base_delay=0.05)
+    db = bot_module.db
+    await db.init_db()
+    results = {}
+    try:
+        await _seed(db_path, args.users, args.due, args.grace)
+        print(f"Seeded {args.users} users into {db_path}")
+        scenarios = [
+            ("start", lambda: bench_start(bot_module, args.starts, args.concurrency)),
+            ("webhook", lambda: bench_webhook(bot_module, db_path, args.webhooks, args.concurrency, args.users)),
+            ("scheduler", lambda: bench_scheduler(bot_module, args.due)),
+            ("outbox", lambda: bench_outbox(bot_module, db_path)),
+            ("broadcast", lambda: bench_broadcast(bot_module, db_path)),
+        ]
+        for name, run in scenarios:
+            if args.only and name not in args.only:
+                continue
+            results[name] = await run()
+            print(f"{name:<10} {json.dumps(results[name], ensure_ascii=False)}")
+    finally:
+        await bot_module.bepaid.close()
+        await bot_module.bot.session.close()
+        await db.close_db()
+        await fake_bepaid.stop()
+        await fake_telegram.stop()
+
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "telegram_calls": dict(fake_telegram.calls),
+            "telegram_flood_waits": fake_telegram.flood_waits,
+            "bepaid_connections": len(fake_bepaid.connections),
+        },
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"Report written to {args.output}")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if baseline.get("meta", {}).get("params") != report["meta"]["params"]:
+            print("Warning: baseline was recorded with different parameters")
+        print(f"Compared with {args.compare}:")
+        regressions = _compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000, help="синтетических пользователей в базе")
+    parser.add_argument("--due", type=int, default=500, help="из них должников для автосписания")
+    parser.add_argument("--grace", type=int, default=500, help="из них в грейсе (напоминания)")
+    parser.add_argument("--starts", type=int, default=500, help="апдейтов /start")
+    parser.add_argument("--webhooks", type=int, default=1000, help="вебхуков bePaid")
+    parser.add_argument("--concurrency", type=int, default=50, help="параллельных апдейтов/вебхуков")
+    parser.add_argument("--bepaid-latency", type=float, default=0.02, help="задержка фейкового bePaid, сек")
+    parser.add_argument("--telegram-latency", type=float, default=0.01, help="задержка фейкового Telegram, сек")
+    parser.add_argument("--telegram-global-limit", type=int, default=0,
+                        help="лимит фейкового Telegram, сообщений/сек (0 — без лимита)")
+    parser.add_argument("--blocked-rate", type=float, default=0.0,
+                        help="доля ответов фейкового Telegram 403 «бот заблокирован»")
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="доля отказов bePaid")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля временных сбоев bePaid (503)")
+    parser.add_argument("--charge-rate", type=float, default=0, help="CHARGE_RATE_LIMIT (0 — без лимита)")
+    parser.add_argument("--telegram-rate", type=float, default=0,
+                        help="BROADCAST/OUTBOX_RATE_LIMIT (0 — без лимита)")
+    parser.add_argument("--only", nargs="*", help="только эти сценарии")
+    parser.add_argument("--output", help="записать отчёт JSON")
+    parser.add_argument("--compare", help="сравнить с отчётом JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (0.2 = 20%%)")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,107 @@
+"""
+Локальный фейковый bePaid для бенчмарков: отвечает на создание checkout
+и на списание по токену с настраиваемой задержкой, долей отказов по карте
+и долей временных сбоев шлюза (503). Списания запоминаются по tracking_id —
+их можно запросить так же, как у bePaid (GET /v2/transactions/tracking_id/{id}).
+
+Отдельный запуск:
+  python benchmarks/fake_bepaid.py --port 8090 --latency 0.05
+"""
+import argparse
+import asyncio
+import random
+import uuid
+
+from aiohttp import web
+
+
+class FakeBePaid:
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.error_rate = error_rate
+        self.transactions = {}
+        self.requests = 0
+        self.connections = set()
+        self.app = web.Application()
+        self.app.router.add_post("/ctp/api/checkouts", self.create_checkout)
+        self.app.router.add_post("/transactions/payments", self.payment)
+        self.app.router.add_get("/v2/transactions/tracking_id/{tracking_id}", self.find_by_tracking_id)
+        self._runner = None
+        self.url = None
+
+    async def _simulate(self, request):
+        self.requests += 1
+        # Считаем уникальные TCP-соединения: видно, переиспользует ли клиент keep-alive
+        self.connections.add(request.transport.get_extra_info("peername"))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await request.json()
+
+    async def create_checkout(self, request):
+        payload = await self._simulate(request)
+        if random.random() < self.fail_rate:
+            return web.json_response({"message": "Fake failure"}, status=422)
+        token = uuid.uuid4().hex
+        return web.json_response({
+            "checkout": {
+                "token": token,
+                "redirect_url": f"{self.url}/checkout?token={token}",
+                "order": payload.get("checkout", {}).get("order", {}),
+            }
+        }, status=201)
+
+    async def payment(self, request):
+        payload = await self._simulate(request)
+        req = payload.get("request", {})
+        if random.random() < self.error_rate:
+            return web.json_response({"message": "Service Unavailable"}, status=503)
+        declined = random.random() < self.fail_rate
+        transaction = {
+            "uid": uuid.uuid4().hex,
+            "status": "failed" if declined else "successful",
+            "amount": req.get("amount"),
+            "currency": req.get("currency"),
+            "tracking_id": req.get("tracking_id"),
+            "message": "Insufficient funds" if declined else "Successfully processed",
+            "credit_card": {"token": (req.get("credit_card") or {}).get("token")},
+        }
+        self.transactions.setdefault(req.get("tracking_id"), []).append(transaction)
+        return web.json_response({"transaction": transaction}, status=200)
+
+    async def find_by_tracking_id(self, request):
+        self.requests += 1
+        transactions = self.transactions.get(request.match_info["tracking_id"])
+        if not transactions:
+            return web.json_response({"message": "Not found"}, status=404)
+        return web.json_response({"transactions": transactions})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        sock = site._server.sockets[0]
+        self.url = f"http://{host}:{sock.getsockname()[1]}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve(args):
+    fake = FakeBePaid(latency=args.latency, fail_rate=args.fail_rate, error_rate=args.error_rate)
+    url = await fake.start(port=args.port)
+    print(f"Fake bePaid listening on {url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля отказов 0..1")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 0..1")
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,136 @@
+"""
+Локальный фейковый Telegram Bot API для бенчмарков: принимает запросы бота
+(sendMessage, copyMessage, createChatInviteLink, ...) с настраиваемой задержкой,
+общим лимитом сообщений/сек (сверх него — 429 с retry_after) и долей «заблокировавших бота».
+
+Бот ходит сюда, если задан TELEGRAM_API_URL (см. bot.py). Отдельный запуск:
+  python benchmarks/fake_telegram.py --port 8091 --latency 0.02 --global-limit 30
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+_BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+# Методы, которые Telegram ограничивает ~30 сообщениями/сек на бота
+_SEND_METHODS = {"sendmessage", "sendphoto", "copymessage"}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, global_limit: int = 0, blocked_rate: float = 0.0):
+        self.latency = latency
+        self.global_limit = global_limit
+        self.blocked_rate = blocked_rate
+        self.calls = Counter()
+        self.flood_waits = 0
+        self._sent_at = deque()
+        self._message_ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = None
+        self.url = None
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": _BOT_USER,
+            **extra,
+        }
+
+    def _flooded(self) -> bool:
+        if not self.global_limit:
+            return False
+        now = time.monotonic()
+        while self._sent_at and now - self._sent_at[0] >= 1.0:
+            self._sent_at.popleft()
+        if len(self._sent_at) >= self.global_limit:
+            return True
+        self._sent_at.append(now)
+        return False
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        params = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in _SEND_METHODS:
+            if self._flooded():
+                self.flood_waits += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1},
+                })
+            if self.blocked_rate and random.random() < self.blocked_rate:
+                return web.json_response({
+                    "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user",
+                })
+
+        chat_id = params.get("chat_id", "0")
+        if method == "getme":
+            result = _BOT_USER
+        elif method == "sendmessage":
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "sendphoto":
+            result = self._message(chat_id, photo=[{
+                "file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1,
+            }])
+        elif method == "copymessage":
+            result = {"message_id": next(self._message_ids)}
+        elif method == "editmessagetext":
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "createchatinvitelink":
+            result = {
+                "invite_link": f"https://t.me/+bench{next(self._message_ids)}",
+                "creator": _BOT_USER, "creates_join_request": False, "is_primary": False, "is_revoked": False,
+                "member_limit": 1,
+            }
+        elif method == "revokechatinvitelink":
+            result = {
+                "invite_link": params.get("invite_link", ""), "creator": _BOT_USER,
+                "creates_join_request": False, "is_primary": False, "is_revoked": True,
+            }
+        elif method == "getchatmember":
+            result = {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False,
+                                                   "first_name": "User"}}
+        else:
+            # banChatMember, unbanChatMember, answerCallbackQuery, setWebhook, deleteWebhook, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        sock = site._server.sockets[0]
+        self.url = f"http://{host}:{sock.getsockname()[1]}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve(args):
+    fake = FakeTelegram(latency=args.latency, global_limit=args.global_limit, blocked_rate=args.blocked_rate)
+    url = await fake.start(port=args.port)
+    print(f"Fake Telegram Bot API listening on {url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument("--global-limit", type=int, default=0, help="сообщений/сек до 429 (0 — без лимита)")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="доля ответов 403 «бот заблокирован»")
+    asyncio.run(_serve(parser.parse_args()))
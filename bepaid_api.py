@@ -1,5 +1,13 @@
+import asyncio
 import aiohttp
 import logging
+import random
+import time
+from decimal import Decimal
+from typing import Dict, Optional
+
+import metrics
+from throttle import CircuitBreaker
 
 logger = logging.getLogger(__name__)
 
@@ -12,15 +20,83 @@ _CTP_HEADERS = {
 _JSON_HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
 
 
+CHECKOUT_URL = "https://checkout.bepaid.by/ctp/api"
+GATEWAY_URL = "https://gateway.bepaid.by"
+
+
+# Ответ шлюза, после которого повтор бессмысленен: карта отклонена / запрос некорректен
+_DECLINED_STATUSES = {"failed", "declined", "expired"}
+# HTTP-коды, которые не говорят ничего о карте: перегрузка, сбой шлюза, проблемы авторизации магазина
+_TRANSIENT_HTTP = {401, 403, 408, 409, 425, 429}
+
+
+class BePaidTransientError(Exception):
+    """
+    Временный сбой (сеть, таймаут, 5xx, 429): списание не состоялось или его исход неизвестен.
+    Это не отказ по карте — токен не трогаем, пользователя спишем позже с тем же tracking_id.
+    """
+
+
+class BePaidUnavailable(BePaidTransientError):
+    """Circuit breaker разомкнут: шлюз недавно сбоил, запросы временно не отправляем."""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"bePaid gateway unavailable, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+def _observe(operation: str, outcome: str, started: float):
+    metrics.BEPAID_REQUEST_DURATION.labels(operation).observe(time.perf_counter() - started)
+    metrics.BEPAID_REQUESTS.labels(operation, outcome).inc()
+
+
 class BePaidAPI:
-    def __init__(self, shop_id: str, secret_key: str, test_mode: bool = False):
+    def __init__(self, shop_id: str, secret_key: str, test_mode: bool = False,
+                 base_url: str = CHECKOUT_URL, gateway_url: str = GATEWAY_URL,
+                 timeout: float = 30.0, connect_timeout: float = 10.0,
+                 max_connections_per_host: int = 20, max_attempts: int = 3, retry_base_delay: float = 1.0,
+                 breaker_threshold: int = 5, breaker_reset_timeout: float = 60.0,
+                 inconclusive_ttl: float = 86400.0):
         self.shop_id = shop_id
         self.secret_key = secret_key
-        self.base_url = "https://checkout.bepaid.by/ctp/api"
+        self.base_url = base_url.rstrip("/")
+        self.gateway_url = gateway_url.rstrip("/")
         self.test_mode = test_mode
         self._auth = aiohttp.BasicAuth(login=shop_id, password=secret_key)
+        self._timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._max_connections_per_host = max_connections_per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        # Общий для всех списаний: при деградации шлюза очередь списаний встаёт на паузу
+        self.breaker = CircuitBreaker(failure_threshold=breaker_threshold, reset_timeout=breaker_reset_timeout)
+        # tracking_id, исход списания по которым неизвестен (таймаут после отправки и т.п.):
+        # перед повтором сначала спрашиваем шлюз, не прошло ли оно. Помним inconclusive_ttl
+        # секунд (tracking_id -> monotonic-срок), чтобы брошенные id не копились
+        self.inconclusive_ttl = inconclusive_ttl
+        self._inconclusive: Dict[str, float] = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Общая сессия с keep-alive пулом: соединения (TCP + TLS) к checkout/gateway
+        переиспользуются между запросами. Создаётся лениво — внутри работающего event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._max_connections_per_host * 2,  # два хоста: checkout и gateway
+                limit_per_host=self._max_connections_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(auth=self._auth, connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
-    async def create_checkout_link(self, amount: float, currency: str, description: str, 
+    async def create_checkout_link(self, amount: Decimal, currency: str, description: str, 
                                    order_id: str, email: str, notification_url: str = None, 
                                    return_url: str = None):
         """
@@ -68,27 +144,129 @@ class BePaidAPI:
             }
         }
 
-        async with aiohttp.ClientSession(auth=self._auth, headers=_CTP_HEADERS) as session:
-            try:
-                async with session.post(url, json=payload) as response:
+        session = self._get_session()
+        started, outcome = time.perf_counter(), "error"
+        try:
+            async with session.post(url, json=payload, headers=_CTP_HEADERS) as response:
+                data = await response.json()
+                if response.status in (200, 201):
+                    outcome = "ok"
+                    return data.get("checkout", {}).get("redirect_url")
+                else:
+                    outcome = "rejected"
+                    logger.error(f"BePaid create_checkout error: {data}")
+                    return None
+        except Exception as e:
+            logger.error(f"BePaid request failed: {e}")
+            return None
+        finally:
+            _observe("checkout", outcome, started)
+
+    def _retry_delay(self, attempt: int) -> float:
+        # Экспоненциальная пауза с jitter, чтобы параллельные воркеры не повторяли синхронно
+        return min(self.retry_base_delay * 2 ** attempt, 30.0) * random.uniform(0.5, 1.5)
+
+    async def find_transactions(self, tracking_id: str) -> list:
+        """Транзакции шлюза с данным tracking_id (для сверки исхода, если ответ на списание потерян)."""
+        url = f"{self.gateway_url}/v2/transactions/tracking_id/{tracking_id}"
+        session = self._get_session()
+        started, outcome = time.perf_counter(), "transient"
+        try:
+            async with session.get(url, headers=_JSON_HEADERS) as response:
+                if response.status == 404:
+                    outcome = "ok"
+                    return []
+                if response.status >= 500 or response.status in _TRANSIENT_HTTP:
+                    raise BePaidTransientError(f"status lookup http={response.status}")
+                data = await response.json()
+                outcome = "ok"
+                return data.get("transactions") or []
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise BePaidTransientError(f"status lookup failed: {e!r}") from e
+        finally:
+            _observe("lookup", outcome, started)
+
+    def _mark_inconclusive(self, tracking_id: str):
+        now = time.monotonic()
+        self._inconclusive.pop(tracking_id, None)
+        self._inconclusive[tracking_id] = now + self.inconclusive_ttl
+        # Срок у всех одинаковый — порядок вставки совпадает с порядком истечения
+        while self._inconclusive:
+            oldest = next(iter(self._inconclusive))
+            if self._inconclusive[oldest] > now:
+                break
+            del self._inconclusive[oldest]
+
+    def _is_inconclusive(self, tracking_id: str) -> bool:
+        expires_at = self._inconclusive.get(tracking_id)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    async def _resolve_inconclusive(self, tracking_id: str):
+        """(True, tx) / (False, err) если исход прошлой попытки уже известен шлюзу, иначе None."""
+        transactions = await self.find_transactions(tracking_id)
+        self._inconclusive.pop(tracking_id, None)
+        for transaction in transactions:
+            if transaction.get("status") == "successful":
+                logger.info("BePaid charge %s already successful (uid=%s)", tracking_id, transaction.get("uid"))
+                return True, transaction
+        for transaction in transactions:
+            if transaction.get("status") in _DECLINED_STATUSES:
+                return False, transaction.get("message") or "Declined"
+        return None
+
+    async def _send_charge(self, url: str, payload: dict):
+        """
+        Один запрос списания: (True, tx) — успех, (False, err) — окончательный отказ;
+        BePaidTransientError — сбой, после которого можно повторить.
+        """
+        session = self._get_session()
+        started, outcome = time.perf_counter(), "transient"
+        try:
+            async with session.post(url, json=payload, headers=_JSON_HEADERS) as response:
+                try:
                     data = await response.json()
-                    if response.status in (200, 201):
-                        return data.get("checkout", {}).get("redirect_url")
-                    else:
-                        logger.error(f"BePaid create_checkout error: {data}")
-                        return None
-            except Exception as e:
-                logger.error(f"BePaid request failed: {e}")
-                return None
-
-    async def charge_recurrent(self, amount: float, currency: str, description: str, 
+                except (aiohttp.ContentTypeError, ValueError):
+                    data = {}
+                transaction = data.get("transaction", {}) or {}
+                status = transaction.get("status")
+                # Статус успешной оплаты: successful
+                if response.status in (200, 201) and status == "successful":
+                    outcome = "ok"
+                    return True, transaction
+                if response.status >= 500 or response.status in _TRANSIENT_HTTP or (
+                    response.status in (200, 201) and status not in _DECLINED_STATUSES
+                ):
+                    # 5xx/429 или неокончательный статус (incomplete, pending) — исход неизвестен
+                    raise BePaidTransientError(f"http={response.status} status={status} body={data}")
+                outcome = "declined"
+                message = transaction.get("message") or data.get("message")
+                code = transaction.get("code") or data.get("code")
+                err = f"{message or 'Unknown error'}" + (f" [{code}]" if code else "")
+                logger.error(
+                    "BePaid recurrent charge rejected: status=%s http=%s body=%s",
+                    status,
+                    response.status,
+                    data,
+                )
+                return False, err
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise BePaidTransientError(repr(e)) from e
+        finally:
+            _observe("charge", outcome, started)
+
+    async def charge_recurrent(self, amount: Decimal, currency: str, description: str, 
                                order_id: str, card_token: str, email: str):
         """
         Списывает деньги по сохраненному токену карты.
         Используем endpoint транзакций шлюза (не checkout).
+
+        Возвращает (True, transaction) или (False, текст отказа) — только когда шлюз дал
+        окончательный ответ. Временные сбои повторяются (до max_attempts, с паузой и jitter,
+        с тем же tracking_id = order_id; если исход попытки неизвестен — сначала сверка по
+        tracking_id); не удалось — BePaidTransientError. При разомкнутом breaker — BePaidUnavailable.
         """
         # Для прямых транзакций URL другой: https://gateway.bepaid.by/transactions/payments
-        gateway_url = "https://gateway.bepaid.by/transactions/payments"
+        gateway_url = f"{self.gateway_url}/transactions/payments"
         
         amount_cents = int(amount * 100)
         
@@ -115,25 +293,39 @@ class BePaidAPI:
             }
         }
 
-        async with aiohttp.ClientSession(auth=self._auth, headers=_JSON_HEADERS) as session:
+        last_error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                await asyncio.sleep(self._retry_delay(attempt - 1))
+            if not self.breaker.allow():
+                _observe("charge", "unavailable", time.perf_counter())
+                raise BePaidUnavailable(self.breaker.retry_in())
             try:
-                async with session.post(gateway_url, json=payload) as response:
-                    data = await response.json()
-                    transaction = data.get("transaction", {})
-                    # Статус успешной оплаты: successful
-                    if response.status in (200, 201) and transaction.get("status") == "successful":
-                        return True, transaction
-                    else:
-                        message = transaction.get("message") or data.get("message")
-                        code = transaction.get("code") or data.get("code")
-                        err = f"{message or 'Unknown error'}" + (f" [{code}]" if code else "")
-                        logger.error(
-                            "BePaid recurrent charge rejected: status=%s http=%s body=%s",
-                            transaction.get("status"),
-                            response.status,
-                            data,
-                        )
-                        return False, err
-            except Exception as e:
-                logger.error(f"BePaid recurrent charge failed: {e}")
-                return False, str(e)
+                if self._is_inconclusive(order_id):
+                    resolved = await self._resolve_inconclusive(order_id)
+                    if resolved is not None:
+                        self.breaker.record_success()
+                        return resolved
+                # До ответа исход неизвестен: если запрос оборвётся, повтор начнём со сверки
+                self._mark_inconclusive(order_id)
+                result = await self._send_charge(gateway_url, payload)
+            except BePaidTransientError as e:
+                self.breaker.record_failure()
+                last_error = e
+                logger.warning(
+                    "BePaid charge %s transient error (attempt %s/%s): %s",
+                    order_id, attempt + 1, self.max_attempts, e,
+                )
+                continue
+            except asyncio.CancelledError:
+                # Отмена — не сбой шлюза; пробный запрос breaker не должен «зависнуть».
+                # order_id остаётся в _inconclusive: запрос мог уйти, повтор начнём со сверки
+                self.breaker.release_probe()
+                raise
+            except BaseException:
+                self.breaker.record_failure()
+                raise
+            self._inconclusive.pop(order_id, None)
+            self.breaker.record_success()
+            return result
+        raise BePaidTransientError(f"charge {order_id} failed after {self.max_attempts} attempts: {last_error}")
@@ -1,21 +1,38 @@
 import logging
 import asyncio
+import hashlib
+import html
+import json
+import multiprocessing
 import os
+import signal
 import time
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from pathlib import Path
 from aiohttp import web
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 import database as db
 import keyboards as kb
-from bepaid_api import BePaidAPI
+import metrics
+from bepaid_api import BePaidAPI, BePaidTransientError, BePaidUnavailable
+from broadcast import Broadcaster
+from checkout_cache import CheckoutCache
+from fsm_storage import create_storage
+from invite_pool import InvitePool
+from leader import LeaderLease
+from outbox import NotificationDispatcher, dump_markup
+from reconcile import RECONCILE_JOB, MembershipReconciler
+from scheduler import DeadlineQueue
+from throttle import TokenBucket
 
 # Загружаем .env из папки, где лежит bot.py (важно для systemd: не зависим от текущей директории)
 _env_path = Path(__file__).resolve().parent / ".env"
@@ -32,25 +49,153 @@ BEPAID_SHOP_ID = os.getenv("BEPAID_SHOP_ID")
 BEPAID_SECRET_KEY = os.getenv("BEPAID_SECRET_KEY")
 # Тестовый режим магазина (должен совпадать с настройками в ЛК bePaid)
 BEPAID_TEST = os.getenv("BEPAID_TEST", "").strip().lower() in ("1", "true", "yes")
+# Таймаут запроса к bePaid (сек); соединения к шлюзу держатся в общем keep-alive пуле
+BEPAID_TIMEOUT = float(os.getenv("BEPAID_TIMEOUT", "30"))
+# Временные сбои шлюза (сеть, 5xx, 429): попыток на одно списание; после BEPAID_BREAKER_THRESHOLD
+# сбоев подряд очередь списаний встаёт на паузу BEPAID_BREAKER_RESET сек
+BEPAID_MAX_ATTEMPTS = int(os.getenv("BEPAID_MAX_ATTEMPTS", "3"))
+BEPAID_BREAKER_THRESHOLD = int(os.getenv("BEPAID_BREAKER_THRESHOLD", "5"))
+BEPAID_BREAKER_RESET = float(os.getenv("BEPAID_BREAKER_RESET", "60"))
+# Автосписания: сколько параллельно и не чаще скольких запросов в секунду к шлюзу
+CHARGE_CONCURRENCY = int(os.getenv("CHARGE_CONCURRENCY", "10"))
+CHARGE_RATE_LIMIT = float(os.getenv("CHARGE_RATE_LIMIT", "5"))
+# Через сколько секунд повторить списание, не прошедшее из-за временного сбоя шлюза
+CHARGE_RETRY_DELAY = float(os.getenv("CHARGE_RETRY_DELAY", "300"))
+# Сколько секунд повторное нажатие «Оформить подписку» отдаёт уже созданную ссылку на оплату
+CHECKOUT_LINK_TTL = float(os.getenv("CHECKOUT_LINK_TTL", "900"))
+# Пул готовых одноразовых инвайт-ссылок: сколько держать свободными и через сколько часов
+# неиспользованную ссылку отозвать и заменить (0 — без пула, ссылка создаётся при оплате)
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", "20"))
+INVITE_POOL_MAX_AGE_HOURS = float(os.getenv("INVITE_POOL_MAX_AGE_HOURS", "168"))
+# Сверка участников канала с подписками: раз в сколько часов, сколько проверок/сек
+# и банов-разбанов/сек. По умолчанию только пишет в лог, что было бы сделано;
+# баны и разбаны включаются явно: RECONCILE_DRY_RUN=0
+RECONCILE_INTERVAL_HOURS = float(os.getenv("RECONCILE_INTERVAL_HOURS", "24"))
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "10"))
+RECONCILE_APPLY_RATE = float(os.getenv("RECONCILE_APPLY_RATE", "2"))
+RECONCILE_DRY_RUN = os.getenv("RECONCILE_DRY_RUN", "1").strip().lower() not in ("0", "false", "no")
+# Планировщик просыпается к дедлайнам; полная сверка с БД — раз в SCHEDULER_SWEEP_INTERVAL сек
+SCHEDULER_SWEEP_INTERVAL = float(os.getenv("SCHEDULER_SWEEP_INTERVAL", "900"))
+SCHEDULER_RETRY_DELAY = 60
+# Как часто (сек) планировщик записывает в daily_stats число активных подписок
+STATS_SNAPSHOT_INTERVAL = 600
+# Сколько дней показывает «📊 Статистика» в админке
+STATS_REPORT_DAYS = 14
+# Рассылка: общий лимит Telegram ~30 сообщений/сек на бота
+BROADCAST_RATE_LIMIT = float(os.getenv("BROADCAST_RATE_LIMIT", "25"))
+# Уведомления из outbox (продление, грейс, оплата): отдельный лимит сообщений/сек
+OUTBOX_RATE_LIMIT = float(os.getenv("OUTBOX_RATE_LIMIT", "20"))
+# Админы из .env: разбираем один раз при старте (в ADMIN_IDS — Telegram ID через запятую)
+ENV_ADMIN_IDS = frozenset(
+    int(x) for x in (part.strip() for part in os.getenv("ADMIN_IDS", "").split(",")) if x.lstrip("-").isdigit()
+)
 # Webhook settings
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "http://194.62.19.77:8080")
 WEBHOOK_PATH = "/bepaid/webhook"
 WEB_SERVER_HOST = "0.0.0.0"
 WEB_SERVER_PORT = 8080
+# Апдейты Telegram: если задан TELEGRAM_WEBHOOK_URL (публичный https-адрес этого сервера) —
+# вебхук на том же aiohttp-сервере, иначе long polling
+TELEGRAM_WEBHOOK_URL = (os.getenv("TELEGRAM_WEBHOOK_URL") or "").strip().rstrip("/")
+TELEGRAM_WEBHOOK_PATH = "/telegram/webhook"
+# Секрет заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена бота,
+# чтобы совпадать во всех процессах без отдельной настройки
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or hashlib.sha256(
+    f"webhook:{TOKEN}".encode()
+).hexdigest()
+# Сколько одновременных соединений Telegram может открыть к вебхуку (1..100)
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_MAX_CONNECTIONS", "100"))
+# Очередь входящих вебхуков: сколько воркеров разбирают её и как повторяем ошибки
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_MAX_ATTEMPTS = 10
+WEBHOOK_RETRY_BASE_DELAY = 5
+WEBHOOK_POLL_INTERVAL = 5
+# Несколько процессов (только в режиме вебхука, Linux: общий порт через SO_REUSEPORT).
+# Апдейты и очереди разбирают все процессы, планировщик и рассылки — только держатель аренды
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+WORKER_RESTART_DELAY = 5
+BROADCAST_RESUME_INTERVAL = 10
+# Как часто процессы перечитывают настройки, изменённые админом в другом процессе
+SETTINGS_REFRESH_INTERVAL = 30
+# Свой сервер Bot API (локальный telegram-bot-api или фейк из benchmarks/); по умолчанию api.telegram.org
+TELEGRAM_API_URL = (os.getenv("TELEGRAM_API_URL") or "").strip().rstrip("/")
+# /metrics (Prometheus); если задан METRICS_TOKEN — только с заголовком Authorization: Bearer <token>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Хранилище состояний FSM: sqlite (по умолчанию, в базе бота), memory или redis (REDIS_URL)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+REDIS_URL = os.getenv("REDIS_URL")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize bot and dispatcher
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
-bepaid = BePaidAPI(shop_id=BEPAID_SHOP_ID, secret_key=BEPAID_SECRET_KEY, test_mode=BEPAID_TEST)
+db.set_static_admins(ENV_ADMIN_IDS)
+bot = Bot(
+    token=TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+fsm_storage, fsm_isolation = create_storage(FSM_STORAGE, REDIS_URL, shared=WORKERS > 1)
+dp = Dispatcher(storage=fsm_storage, events_isolation=fsm_isolation)
+dp.message.middleware(metrics.HandlerMetricsMiddleware())
+dp.callback_query.middleware(metrics.HandlerMetricsMiddleware())
+bot.session.middleware(metrics.TelegramRequestMetrics())
+bepaid = BePaidAPI(
+    shop_id=BEPAID_SHOP_ID, secret_key=BEPAID_SECRET_KEY, test_mode=BEPAID_TEST, timeout=BEPAID_TIMEOUT,
+    max_attempts=BEPAID_MAX_ATTEMPTS, breaker_threshold=BEPAID_BREAKER_THRESHOLD,
+    breaker_reset_timeout=BEPAID_BREAKER_RESET,
+)
+checkout_links = CheckoutCache(ttl=CHECKOUT_LINK_TTL)
+charge_limiter = TokenBucket(rate=CHARGE_RATE_LIMIT, capacity=CHARGE_CONCURRENCY)
+# Пользователи, по которым прямо сейчас идёт списание
+_charges_in_flight: set = set()
+# Когда (monotonic) последний раз записывали число активных подписок в daily_stats
+_stats_snapshot_at = float("-inf")
+# Очередь дедлайнов планировщика; БД сообщает об изменении дат пользователей
+deadlines = DeadlineQueue()
+db.add_deadline_listener(deadlines.arm)
+broadcaster = Broadcaster(bot, rate=BROADCAST_RATE_LIMIT)
+# Уведомления пользователям уходят через таблицу outbox; запись в неё будит отправителя
+notifier = NotificationDispatcher(bot, rate=OUTBOX_RATE_LIMIT / WORKERS)
+db.add_outbox_listener(notifier.wakeup)
+# Инвайты после оплаты берутся из пула в БД; пополняет его лидер
+invite_pool = InvitePool(bot, CHANNEL_ID, size=INVITE_POOL_SIZE, max_age=INVITE_POOL_MAX_AGE_HOURS * 3600)
+# Сверка участников канала с БД (у лидера), курсор прохода — в job_state
+reconciler = MembershipReconciler(
+    bot, CHANNEL_ID, db.get_admin_ids, interval=RECONCILE_INTERVAL_HOURS * 3600,
+    rate=RECONCILE_RATE, apply_rate=RECONCILE_APPLY_RATE, dry_run=RECONCILE_DRY_RUN,
+)
+# Аренда лидера: планировщик списаний и рассылки работают ровно в одном процессе
+leader = LeaderLease("scheduler", ttl=LEADER_LEASE_TTL, renew_interval=LEADER_LEASE_TTL / 3)
+# Будит webhook_worker, как только вебхук положен в очередь
+webhook_wakeup = asyncio.Event()
 
 # Захардкоженные ссылки в приветствии
 WELCOME_LINKS_HTML = """• <a href="https://psyprosto-help.by/policy">Политика конфиденциальности</a>
 • <a href="https://psyprosto-help.by/polozhenie">Положение</a>
 • <a href="https://school.psy-prosto.school/oferta">Оферта</a>"""
+DEFAULT_WELCOME_TEXT = "Добро пожаловать в наш бот!\n\nПожалуйста, ознакомьтесь с правилами ниже.\n\nНажмите кнопку ниже, чтобы продолжить."
+# Кнопка «Оплатить заново» в уведомлениях планировщика: в outbox кладётся уже сериализованной
+PAY_AGAIN_MARKUP_JSON = dump_markup(kb.PAY_AGAIN_KEYBOARD)
+# Готовое приветствие (текст, фото, клавиатура) и версия настроек, из которых оно собрано
+_welcome_cache = (None, None)
+
+
+async def get_welcome_payload():
+    """Приветствие для /start; пересобирается только после изменения настроек (текст/фото в админке)."""
+    global _welcome_cache
+    version, payload = _welcome_cache
+    if version != db.get_settings_version():
+        version = db.get_settings_version()
+        intro = await db.get_setting("welcome_text") or DEFAULT_WELCOME_TEXT
+        if WELCOME_LINKS_HTML not in intro:
+            text = intro.rstrip() + "\n\n" + WELCOME_LINKS_HTML
+        else:
+            text = intro
+        payload = (text, await db.get_setting("welcome_photo"), kb.WELCOME_KEYBOARD)
+        _welcome_cache = (version, payload)
+    return payload
 
 # States
 class AdminStates(StatesGroup):
@@ -62,270 +207,537 @@ class AdminStates(StatesGroup):
 
 # --- Helpers ---
 async def is_admin(user_id: int):
-    # Приводим к строке для надежного сравнения
-    user_id_str = str(user_id)
-    
-    # 1. Проверяем ADMIN_IDS из .env
-    env_admins_raw = os.getenv("ADMIN_IDS", "")
-    # Разбиваем по запятой, чистим от пробелов и пустых элементов
-    env_admins = [x.strip() for x in env_admins_raw.split(",") if x.strip()]
-    
-    if user_id_str in env_admins:
-        return True
-        
-    # 2. Проверяем таблицу admins в БД
-    db_admins = await db.get_admins()
-    # db.get_admins() возвращает список int, приводим к str
-    if user_id in db_admins:
-        return True
-        
-    return False
+    # ADMIN_IDS из .env + таблица admins; множество кэшируется в db (TTL), проверка — O(1)
+    return user_id in await db.get_admin_ids()
 
 # --- Webhook Handler for BePaid ---
+def _amount_cents(amount, price: Decimal) -> int:
+    """Сумма транзакции bePaid в копейках; если её нет в ответе — цена подписки."""
+    try:
+        return int(amount)
+    except (TypeError, ValueError):
+        return int(price * 100)
+
+
+def _extract_transaction(data) -> dict:
+    # Карточные уведомления: https://docs.bepaid.by/ru/using_api/webhooks/
+    if not isinstance(data, dict):
+        return {}
+    transaction = data.get("transaction") if isinstance(data.get("transaction"), dict) else {}
+    if not transaction and data.get("uid") and data.get("tracking_id"):
+        transaction = data
+    return transaction
+
+
 async def bepaid_webhook_handler(request):
+    """
+    Быстрый ответ bePaid: проверяем уведомление, кладём его в очередь webhook_inbox
+    (одна локальная запись) и сразу отвечаем 200. Обработку делают webhook_worker.
+    """
     try:
         data = await request.json()
-        # Карточные уведомления: https://docs.bepaid.by/ru/using_api/webhooks/
-        transaction = data.get("transaction") if isinstance(data.get("transaction"), dict) else {}
-        if not transaction and isinstance(data, dict) and data.get("uid") and data.get("tracking_id"):
-            transaction = data
-        status = transaction.get("status")
-        tracking_id = transaction.get("tracking_id")  # format: user_id:timestamp
+    except Exception as e:
+        logger.warning(f"Webhook with invalid JSON: {e}")
+        metrics.BEPAID_WEBHOOKS.labels("invalid").inc()
+        return web.Response(text="Bad request", status=400)
+
+    transaction = _extract_transaction(data)
+    if not transaction:
+        logger.warning("Webhook without transaction ignored: %s", data)
+        metrics.BEPAID_WEBHOOKS.labels("empty").inc()
+        return web.Response(text="OK", status=200)
+    metrics.BEPAID_WEBHOOKS.labels(str(transaction.get("status") or "unknown")).inc()
 
-        logger.info(
-            "Received webhook: uid=%s status=%s tracking_id=%s recurring_type=%s",
-            transaction.get("uid"),
-            status,
-            tracking_id,
-            transaction.get("recurring_type"),
-        )
+    try:
+        await db.enqueue_webhook(json.dumps(transaction, ensure_ascii=False))
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+        return web.Response(text="Error", status=500)
+    webhook_wakeup.set()
+    return web.Response(text="OK", status=200)
+
+
+async def metrics_handler(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(text="Unauthorized", status=401)
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
 
-        if status == "successful" and tracking_id:
+
+async def process_bepaid_notification(transaction: dict):
+    """Обработка уведомления bePaid из очереди. Исключение — задача будет повторена позже."""
+    status = transaction.get("status")
+    tracking_id = transaction.get("tracking_id")  # format: user_id:timestamp
+
+    logger.info(
+        "Received webhook: uid=%s status=%s tracking_id=%s recurring_type=%s",
+        transaction.get("uid"),
+        status,
+        tracking_id,
+        transaction.get("recurring_type"),
+    )
+
+    uid = transaction.get("uid")
+    user_id = None
+    if tracking_id:
+        try:
+            user_id = int(str(tracking_id).split(":")[0])
+        except ValueError:
+            logger.warning("Webhook with unexpected tracking_id=%s", tracking_id)
+
+    # Дедупликация: bePaid повторяет уведомления — уже применённый uid отсекаем одним запросом.
+    # Применённым uid отмечается только в одной записи с продлением подписки (flush_for_transaction)
+    if uid and not await db.claim_transaction(
+        uid, tracking_id, user_id, status, transaction.get("amount"), transaction.get("currency"),
+    ):
+        if user_id is not None and await db.needs_notification(uid):
+            # Подписка продлена прошлой попыткой, а уведомление не записано — повторяем только его
+            logger.info("Webhook uid=%s already applied, retrying payment notification", uid)
             try:
-                user_id = int(tracking_id.split(":")[0])
-
-                # Токен и email для последующих списаний (см. saved_cards)
-                credit_card = transaction.get("credit_card", {}) or {}
-                card_token = credit_card.get("token")
-                customer = transaction.get("customer", {}) or {}
-                paid_email = customer.get("email")
-
-                if not card_token:
-                    logger.error(
-                        "Webhook OK but credit_card.token is empty — автосписания будут невозможны. "
-                        "user_id=%s uid=%s (нужна инициализирующая оплата с contract recurring+card_on_file)",
-                        user_id,
-                        transaction.get("uid"),
-                    )
-
-                # Снимаем возможный бан и продлеваем подписку (например, на 30 дней)
-                days_str = await db.get_setting("subscription_days") or "30"
-                days = int(days_str)
-                new_end_date = time.time() + (days * 24 * 60 * 60)
-                try:
-                    await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                except Exception as e:
-                    logger.warning("Unban before invite failed for user %s: %s", user_id, e)
-
-                await db.clear_grace_period(user_id)
-                await db.set_subscription(
-                    user_id,
-                    status=True,
-                    end_date=new_end_date,
-                    card_token=card_token,
-                    email=paid_email,
-                )
-                end_date_str = datetime.utcfromtimestamp(new_end_date).strftime("%Y-%m-%d %H:%M UTC")
-                logger.info(
-                    f"Payment OK: user_id={user_id}, card_saved={'yes' if card_token else 'no'}, "
-                    f"subscription_until={end_date_str}, auto_renew={'yes' if card_token else 'no'}"
-                )
-                
-                # Инвайт только в канал из CHANNEL_ID (.env)
-                invite_link_obj = await bot.create_chat_invite_link(
-                    chat_id=CHANNEL_ID,
-                    member_limit=1,
-                    name=f"Sub_{user_id}_{int(time.time())}"
-                )
-                invite_link = invite_link_obj.invite_link
-                
-                payment_text = await db.get_setting("payment_success_text") or "✅ Оплата прошла успешно!\n\nНажмите кнопку ниже, чтобы вступить в канал."
-                
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=payment_text,
-                    reply_markup=kb.get_member_keyboard(MANAGER_LINK, invite_link=invite_link)
-                )
-                
+                await send_payment_notification(uid, user_id)
             except Exception as e:
-                logger.error(f"Error processing webhook logic: {e}")
-        
-        return web.Response(text="OK", status=200)
+                raise PaymentNotificationError(str(e)) from e
+            return
+        logger.info("Duplicate webhook ignored: uid=%s status=%s", uid, status)
+        return
+
+    if status != "successful" or user_id is None:
+        # Применять нечего — просто отмечаем транзакцию обработанной
+        if uid:
+            await db.WriteBatch().flush_for_transaction(uid)
+        return
+
+    # Токен и email для последующих списаний (см. saved_cards)
+    credit_card = transaction.get("credit_card", {}) or {}
+    card_token = credit_card.get("token")
+    customer = transaction.get("customer", {}) or {}
+    paid_email = customer.get("email")
+
+    if not card_token:
+        logger.error(
+            "Webhook OK but credit_card.token is empty — автосписания будут невозможны. "
+            "user_id=%s uid=%s (нужна инициализирующая оплата с contract recurring+card_on_file)",
+            user_id,
+            transaction.get("uid"),
+        )
+
+    # Снимаем возможный бан и продлеваем подписку (например, на 30 дней)
+    days = db.get_subscription_days()
+    new_end_date = time.time() + (days * 24 * 60 * 60)
+    try:
+        await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
-        return web.Response(text="Error", status=500)
+        logger.warning("Unban before invite failed for user %s: %s", user_id, e)
+
+    previous = await db.get_user_subscription(user_id)
+    # Оплата при активной подписке (в т.ч. в грейсе) — продление, иначе новая подписка
+    renewed = bool(previous and previous[0])
+    batch = db.WriteBatch()
+    batch.clear_grace_period(user_id)
+    batch.set_subscription(
+        user_id,
+        status=True,
+        end_date=new_end_date,
+        card_token=card_token,
+        email=paid_email,
+    )
+    batch.count_stats(
+        renewals=int(renewed),
+        new_subs=int(not renewed),
+        revenue_cents=_amount_cents(transaction.get("amount"), db.get_subscription_price()),
+    )
+    # Продление, счётчики и отметка uid — одна транзакция: падение до неё ничего не
+    # применяет (повтор задачи применит), после неё повтор увидит uid применённым
+    if not await batch.flush_for_transaction(uid):
+        logger.info("Webhook uid=%s already applied by another worker", uid)
+        return
+    # Оплаченная ссылка больше не нужна: следующее «Оплатить» создаст новую
+    checkout_links.invalidate(user_id)
+    end_date_str = datetime.utcfromtimestamp(new_end_date).strftime("%Y-%m-%d %H:%M UTC")
+    logger.info(
+        f"Payment OK: user_id={user_id}, card_saved={'yes' if card_token else 'no'}, "
+        f"subscription_until={end_date_str}, auto_renew={'yes' if card_token else 'no'}"
+    )
+
+    try:
+        await send_payment_notification(uid, user_id)
+    except Exception as e:
+        if uid:
+            # Повтор задачи пропустит продление (uid применён) и выполнит только этот шаг
+            raise PaymentNotificationError(str(e)) from e
+        # Без uid повтор нельзя отличить от новой оплаты — он удвоил бы период
+        logger.error("Payment notification for user %s failed: %s", user_id, e)
+
+
+class PaymentNotificationError(Exception):
+    """Оплата применена, но инвайт / сообщение записать не удалось (например, пул пуст и Telegram
+    не создаёт ссылку). Такую задачу вебхука повторяем без лимита попыток — пока инвайт не появится."""
+
+
+async def send_payment_notification(uid, user_id: int):
+    """
+    Второй шаг обработки оплаты — инвайт и сообщение об успехе. Сообщение попадает в outbox
+    одной транзакцией с отметкой notified_at, так что при ошибке его можно повторять отдельно.
+    """
+    # Инвайт только в канал из CHANNEL_ID (.env): готовый из пула, без запроса к Telegram
+    invite_link = await invite_pool.take(user_id, name=f"Sub_{user_id}_{int(time.time())}")
+
+    payment_text = await db.get_setting("payment_success_text") or "✅ Оплата прошла успешно!\n\nНажмите кнопку ниже, чтобы вступить в канал."
+
+    batch = db.WriteBatch()
+    batch.notify(
+        user_id,
+        payment_text,
+        dump_markup(kb.get_member_keyboard(MANAGER_LINK, invite_link=invite_link)),
+    )
+    if not await batch.flush_for_transaction(uid, mark="notified_at"):
+        logger.info("Payment notification for uid=%s already queued", uid)
+
+async def handle_webhook_job(job):
+    """Обработать задачу из webhook_inbox; при ошибке — повтор с экспоненциальной паузой."""
+    job_id, payload, attempts = job
+    try:
+        await process_bepaid_notification(json.loads(payload))
+    except asyncio.CancelledError:
+        # Остановка процесса: задачу сразу берёт другой воркер, а не через WEBHOOK_CLAIM_TIMEOUT
+        await db.release_webhook_job(job_id)
+        raise
+    except Exception as e:
+        retry_in = min(WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempts - 1), 3600)
+        # Оплаченному пользователю инвайт обязан дойти — такие задачи не бросаем
+        give_up = attempts >= WEBHOOK_MAX_ATTEMPTS and not isinstance(e, PaymentNotificationError)
+        logger.error(
+            "Webhook job %s failed (attempt %s%s): %s",
+            job_id, attempts, ", giving up" if give_up else f", retry in {retry_in}s", e,
+        )
+        await db.fail_webhook_job(job_id, str(e), None if give_up else time.time() + retry_in)
+    else:
+        await db.complete_webhook_job(job_id)
+
+async def webhook_worker():
+    """Разбирает очередь webhook_inbox."""
+    while True:
+        try:
+            job = await db.claim_webhook_job()
+            if job is None:
+                webhook_wakeup.clear()
+                try:
+                    await asyncio.wait_for(webhook_wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await handle_webhook_job(job)
+        except Exception as e:
+            logger.error(f"Webhook worker error: {e}")
+            await asyncio.sleep(WEBHOOK_POLL_INTERVAL)
+
 
 # --- Scheduler for Recurring Payments ---
+async def charge_user(user, price: Decimal, days: int, batch: db.WriteBatch):
+    """
+    Одна попытка автосписания. Изменения состояния пользователя копятся в batch,
+    списание фиксируется в журнале transactions сразу. Возвращает 'charged' или 'declined'.
+    Временный сбой шлюза — BePaidTransientError: пользователя не трогаем (токен и период
+    остаются), повтор — в следующем проходе с тем же tracking_id.
+    """
+    user_id, card_token, email, grace_until_ts, last_notice_ts, end_date = user
+    # tracking_id привязан к оплачиваемому периоду, а не к моменту попытки:
+    # повтор того же периода (перезапуск, повторный проход) идёт с тем же id
+    tracking_id = f"{user_id}:{int(end_date)}"
+
+    # Период уже оплачен, но состояние не успели записать (падение до flush) — не списываем повторно
+    if await db.is_charge_successful(tracking_id):
+        logger.info("Charge %s already successful, skipping gateway call", tracking_id)
+        success, result = True, {}
+    else:
+        logger.info(f"Attempting to charge user {user_id}")
+        await charge_limiter.acquire()
+        success, result = await bepaid.charge_recurrent(
+            amount=price,
+            currency="BYN",
+            description=f"Продление подписки (Bot) для {user_id}",
+            order_id=tracking_id,
+            card_token=card_token,
+            email=email or "no-email@example.com"
+        )
+
+    if success:
+        if result.get("uid"):
+            await db.claim_transaction(
+                result["uid"], result.get("tracking_id"), user_id, result.get("status"),
+                result.get("amount"), result.get("currency"), kind="recurring", processed=True,
+            )
+        new_end_date = time.time() + (days * 24 * 60 * 60)
+        batch.clear_grace_period(user_id)
+        batch.set_subscription(user_id, status=True, end_date=new_end_date)
+        batch.count_stats(renewals=1, revenue_cents=_amount_cents(result.get("amount"), price))
+        batch.notify(user_id, f"✅ Подписка успешно продлена на {days} дней!")
+        return "charged"
+
+    now_ts = time.time()
+    grace_until = now_ts + (3 * 24 * 60 * 60)
+
+    # Отключаем автосписание по токену (чтобы не долбить карту) и включаем грейс 3 дня
+    batch.set_subscription(user_id, status=True, card_token="")
+    batch.set_grace_period(
+        user_id=user_id,
+        grace_until_ts=grace_until,
+        fail_ts=now_ts,
+        notice_ts=now_ts,
+    )
+    batch.count_stats(failed_charges=1)
+
+    logger.info(
+        "Payment failed, grace started: user_id=%s, grace_until=%s, reason=%s",
+        user_id,
+        datetime.utcfromtimestamp(grace_until).strftime("%Y-%m-%d %H:%M UTC"),
+        result,
+    )
+
+    # Сообщаем и предлагаем оплатить заново по кнопке (с актуальной суммой)
+    batch.notify(
+        user_id,
+        "❌ Автосписание не прошло.\n\n"
+        "У вас есть 3 дня, чтобы пополнить карту или оплатить заново по кнопке ниже.\n"
+        "После 3 дней доступ к каналу будет отключён.",
+        PAY_AGAIN_MARKUP_JSON,
+    )
+    return "declined"
+
+
+async def run_recurring_charges(users_due, price: Decimal, days: int, admin_ids: frozenset):
+    """
+    Пул из CHARGE_CONCURRENCY воркеров разбирает очередь должников; запросы к bePaid
+    дополнительно ограничены charge_limiter. Один пользователь — не больше одного списания
+    одновременно (_charges_in_flight), ошибка по одному не останавливает остальных.
+    Результаты пишутся пакетами по WriteBatch.chunk_size строк.
+
+    Временный сбой по пользователю — errors, повтор через CHARGE_RETRY_DELAY. Если шлюз
+    деградировал (breaker разомкнут), остаток очереди откладывается (deferred) до его проверки.
+    """
+    batch = db.WriteBatch()
+    queue = asyncio.Queue()
+    for user in users_due:
+        queue.put_nowait(user)
+    stats = {"charged": 0, "declined": 0, "skipped": 0, "errors": 0, "deferred": 0}
+    started = time.monotonic()
+
+    async def worker():
+        while True:
+            try:
+                user = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            user_id, card_token = user[0], user[1]
+            if user_id in admin_ids or not card_token or user_id in _charges_in_flight:
+                stats["skipped"] += 1
+                continue
+            _charges_in_flight.add(user_id)
+            try:
+                stats[await charge_user(user, price, days, batch)] += 1
+                if len(batch) >= batch.chunk_size:
+                    await batch.flush()
+            except BePaidUnavailable as e:
+                # Шлюз недоступен: не тратим запросы на остальных, вернёмся к ним после паузы
+                retry_at = time.time() + e.retry_in
+                deferred = [user_id]
+                while not queue.empty():
+                    deferred.append(queue.get_nowait()[0])
+                stats["deferred"] += len(deferred)
+                for deferred_id in deferred:
+                    deadlines.arm(deferred_id, retry_at)
+            except BePaidTransientError as e:
+                stats["errors"] += 1
+                deadlines.arm(user_id, time.time() + CHARGE_RETRY_DELAY)
+                logger.warning("Recurring charge for user %s postponed: %s", user_id, e)
+            except Exception as e:
+                stats["errors"] += 1
+                logger.error("Recurring charge error for user %s: %s", user_id, e)
+            finally:
+                _charges_in_flight.discard(user_id)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(CHARGE_CONCURRENCY, queue.qsize()))))
+    finally:
+        await batch.flush()
+
+    elapsed = time.monotonic() - started
+    if users_due:
+        logger.info(
+            "Recurring charges done: due=%s charged=%s declined=%s skipped=%s errors=%s deferred=%s "
+            "elapsed=%.1fs rate=%.1f/s",
+            len(users_due), stats["charged"], stats["declined"], stats["skipped"], stats["errors"],
+            stats["deferred"],
+            elapsed, len(users_due) / elapsed if elapsed else 0.0,
+        )
+    return stats
+
+
+async def run_scheduler_pass():
+    """Один проход: автосписания, напоминания в грейсе, запуск грейса, кик после грейса."""
+    global _stats_snapshot_at
+    users_due = await db.get_users_due_payment()
+    
+    price = db.get_subscription_price()
+    days = db.get_subscription_days()
+    # Никогда не трогаем админов (из .env и из БД) — множество берём один раз на проход
+    admin_ids = await db.get_admin_ids()
+
+    stats = await run_recurring_charges(users_due, price, days, admin_ids)
+    metrics.SCHEDULER_LAST_PASS_USERS.labels("charge").set(len(users_due))
+    for outcome, count in stats.items():
+        metrics.SCHEDULER_USERS.labels("charge", outcome).inc(count)
+
+    # Уведомления в грейс-период (раз в 24 часа)
+    batch = db.WriteBatch()
+    try:
+        users_in_grace = await db.get_users_in_grace_to_notify()
+        metrics.SCHEDULER_LAST_PASS_USERS.labels("grace_notice").set(len(users_in_grace))
+        for row in users_in_grace:
+            user_id, email, grace_until_ts, last_notice_ts = row
+            if user_id in admin_ids:
+                continue
+            batch.update_grace_notice_ts(user_id, time.time())
+            batch.notify(
+                user_id,
+                "⏳ Напоминание: оплата подписки не прошла.\n\n"
+                "Пополните карту или оплатите заново по кнопке ниже.\n"
+                "Иначе доступ к каналу будет отключён по окончании 3 дней.",
+                PAY_AGAIN_MARKUP_JSON,
+            )
+            metrics.SCHEDULER_USERS.labels("grace_notice", "queued").inc()
+    finally:
+        # Каждый этап пишется до выборки следующего — она должна видеть обновлённые строки
+        await batch.flush()
+
+    # Истёкшая подписка без карты: запускаем грейс (если ещё не запускали)
+    try:
+        expired_no_card_start = await db.get_users_expired_no_card_start_grace()
+        metrics.SCHEDULER_LAST_PASS_USERS.labels("grace_start").set(len(expired_no_card_start))
+        for user_id, email in expired_no_card_start:
+            if user_id in admin_ids:
+                continue
+            now_ts = time.time()
+            grace_until = now_ts + (3 * 24 * 60 * 60)
+            batch.set_grace_period(
+                user_id=user_id,
+                grace_until_ts=grace_until,
+                fail_ts=now_ts,
+                notice_ts=now_ts,
+            )
+            batch.notify(
+                user_id,
+                "❌ Срок подписки истёк.\n\n"
+                "У вас есть 3 дня, чтобы оплатить подписку заново по кнопке ниже.\n"
+                "После 3 дней доступ к каналу будет отключён.",
+                PAY_AGAIN_MARKUP_JSON,
+            )
+            metrics.SCHEDULER_USERS.labels("grace_start", "queued").inc()
+    finally:
+        await batch.flush()
+
+    # Истёкшая подписка без карты — выгоняем после окончания грейса (админов не трогаем)
+    try:
+        expired_no_card_to_kick = await db.get_users_expired_no_card_to_kick()
+        metrics.SCHEDULER_LAST_PASS_USERS.labels("kick").set(len(expired_no_card_to_kick))
+        for user_id in expired_no_card_to_kick:
+            if user_id in admin_ids:
+                continue
+            batch.set_subscription(user_id, status=False)
+            batch.count_stats(kicked=1)
+            try:
+                await bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+                logger.info(f"Kicked user {user_id} (subscription expired, no card, grace ended)")
+                metrics.SCHEDULER_USERS.labels("kick", "kicked").inc()
+            except Exception as k_err:
+                logger.error(f"Failed to kick user {user_id}: {k_err}")
+                metrics.SCHEDULER_USERS.labels("kick", "errors").inc()
+    finally:
+        await batch.flush()
+
+    if time.monotonic() - _stats_snapshot_at >= STATS_SNAPSHOT_INTERVAL:
+        await db.snapshot_active_subscriptions()
+        _stats_snapshot_at = time.monotonic()
+
+
 async def check_recurring_payments():
-    """Ежедневная проверка подписок"""
+    """
+    Планировщик подписок: спит до ближайшего дедлайна из очереди (окончание периода,
+    конец грейса, напоминание), а раз в SCHEDULER_SWEEP_INTERVAL сверяется с БД
+    и перезагружает очередь на следующее окно.
+    """
+    next_sweep_at = 0.0
     while True:
         try:
-            # Ждем 24 часа (или запускаем раз в день в определенное время)
-            # Для теста можно уменьшить
-            users_due = await db.get_users_due_payment()
-            
-            price_str = await db.get_setting("subscription_price") or "30"
-            price = float(price_str)
-            days_str = await db.get_setting("subscription_days") or "30"
-            days = int(days_str)
-
-            for user in users_due:
-                user_id, card_token, email, grace_until_ts, last_notice_ts = user
-
-                # Никогда не трогаем админов (из .env и из БД)
-                if await is_admin(user_id):
-                    continue
-                
-                if not card_token:
-                    continue
-                
-                logger.info(f"Attempting to charge user {user_id}")
-                
-                success, result = await bepaid.charge_recurrent(
-                    amount=price,
-                    currency="BYN",
-                    description=f"Продление подписки (Bot) для {user_id}",
-                    order_id=f"{user_id}:{int(time.time())}",
-                    card_token=card_token,
-                    email=email or "no-email@example.com"
-                )
-                
-                if success:
-                    new_end_date = time.time() + (days * 24 * 60 * 60)
-                    await db.clear_grace_period(user_id)
-                    await db.set_subscription(user_id, status=True, end_date=new_end_date)
-                    await bot.send_message(user_id, f"✅ Подписка успешно продлена на {days} дней!")
-                else:
-                    now_ts = time.time()
-                    grace_until = now_ts + (3 * 24 * 60 * 60)
-
-                    # Отключаем автосписание по токену (чтобы не долбить карту) и включаем грейс 3 дня
-                    await db.set_subscription(user_id, status=True, card_token="")
-                    await db.set_grace_period(
-                        user_id=user_id,
-                        grace_until_ts=grace_until,
-                        fail_ts=now_ts,
-                        notice_ts=now_ts,
-                    )
-
-                    logger.info(
-                        "Payment failed, grace started: user_id=%s, grace_until=%s, reason=%s",
-                        user_id,
-                        datetime.utcfromtimestamp(grace_until).strftime("%Y-%m-%d %H:%M UTC"),
-                        result,
-                    )
-
-                    # Сообщаем и предлагаем оплатить заново по кнопке (с актуальной суммой)
-                    retry_kb = types.InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [types.InlineKeyboardButton(text="💳 Оплатить заново", callback_data="pay_again")]
-                        ]
-                    )
-                    await bot.send_message(
-                        user_id,
-                        "❌ Автосписание не прошло.\n\n"
-                        "У вас есть 3 дня, чтобы пополнить карту или оплатить заново по кнопке ниже.\n"
-                        "После 3 дней доступ к каналу будет отключён.",
-                        reply_markup=retry_kb,
-                    )
-
-            # Уведомления в грейс-период (раз в 24 часа)
-            users_in_grace = await db.get_users_in_grace_to_notify()
-            for row in users_in_grace:
-                user_id, email, grace_until_ts, last_notice_ts = row
-                if await is_admin(user_id):
-                    continue
-                retry_kb = types.InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [types.InlineKeyboardButton(text="💳 Оплатить заново", callback_data="pay_again")]
-                    ]
-                )
-                await bot.send_message(
-                    user_id,
-                    "⏳ Напоминание: оплата подписки не прошла.\n\n"
-                    "Пополните карту или оплатите заново по кнопке ниже.\n"
-                    "Иначе доступ к каналу будет отключён по окончании 3 дней.",
-                    reply_markup=retry_kb,
-                )
-                await db.update_grace_notice_ts(user_id, time.time())
+            now = time.time()
+            if now >= next_sweep_at:
+                next_sweep_at = now + SCHEDULER_SWEEP_INTERVAL
+                deadlines.reset(await db.get_upcoming_deadlines(next_sweep_at), next_sweep_at)
+            deadlines.pop_due(now)
+            with metrics.SCHEDULER_PASS_DURATION.time():
+                await run_scheduler_pass()
+            await deadlines.wait(until=next_sweep_at)
+        except Exception as e:
+            logger.error(f"Scheduler error: {e}")
+            await asyncio.sleep(SCHEDULER_RETRY_DELAY)
 
-            # Истёкшая подписка без карты: запускаем грейс (если ещё не запускали)
-            expired_no_card_start = await db.get_users_expired_no_card_start_grace()
-            for user_id, email in expired_no_card_start:
-                if await is_admin(user_id):
-                    continue
-                now_ts = time.time()
-                grace_until = now_ts + (3 * 24 * 60 * 60)
-                await db.set_grace_period(
-                    user_id=user_id,
-                    grace_until_ts=grace_until,
-                    fail_ts=now_ts,
-                    notice_ts=now_ts,
-                )
-                retry_kb = types.InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [types.InlineKeyboardButton(text="💳 Оплатить заново", callback_data="pay_again")]
-                    ]
-                )
-                await bot.send_message(
-                    user_id,
-                    "❌ Срок подписки истёк.\n\n"
-                    "У вас есть 3 дня, чтобы оплатить подписку заново по кнопке ниже.\n"
-                    "После 3 дней доступ к каналу будет отключён.",
-                    reply_markup=retry_kb,
-                )
 
-            # Истёкшая подписка без карты — выгоняем после окончания грейса (админов не трогаем)
-            expired_no_card_to_kick = await db.get_users_expired_no_card_to_kick()
-            for user_id in expired_no_card_to_kick:
-                if await is_admin(user_id):
-                    continue
-                await db.set_subscription(user_id, status=False)
-                try:
-                    await bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                    logger.info(f"Kicked user {user_id} (subscription expired, no card, grace ended)")
-                except Exception as k_err:
-                    logger.error(f"Failed to kick user {user_id}: {k_err}")
+async def broadcast_supervisor():
+    """Только у лидера: ведёт рассылки — прерванные рестартом и начатые в других процессах."""
+    try:
+        while True:
+            try:
+                await broadcaster.resume_unfinished()
+            except Exception as e:
+                logger.error(f"Broadcast supervisor error: {e}")
+            await asyncio.sleep(BROADCAST_RESUME_INTERVAL)
+    finally:
+        # Лидерство потеряно — рассылки продолжит новый лидер с сохранённого курсора
+        await broadcaster.stop()
+
 
-            # Проверка раз в час (чтобы не пропустить)
-            await asyncio.sleep(3600) 
+async def settings_refresher():
+    """Несколько процессов: подтягиваем настройки и админов, изменённые в других процессах."""
+    while True:
+        await asyncio.sleep(SETTINGS_REFRESH_INTERVAL)
+        try:
+            await db.refresh_settings()
+            await db.refresh_admin_ids()
         except Exception as e:
-            logger.error(f"Scheduler error: {e}")
-            await asyncio.sleep(3600)
+            logger.warning(f"Settings refresh failed: {e}")
+
+
+leader.add_task("scheduler", check_recurring_payments)
+leader.add_task("broadcasts", broadcast_supervisor)
+# И при INVITE_POOL_SIZE=0: выданные напрямую ссылки тоже нужно отзывать
+leader.add_task("invite_pool", invite_pool.run)
+leader.add_task("reconcile", reconciler.run)
+
+
+async def get_checkout_link(user_id: int, price: Decimal, description: str):
+    """Ссылка на оплату: из кэша (та же цена, не истекла) или новая от bePaid."""
+    def create():
+        return bepaid.create_checkout_link(
+            amount=price,
+            currency="BYN",
+            description=description,
+            order_id=f"{user_id}:{int(time.time())}",
+            email=f"user{user_id}@telegram.bot",  # Заглушка, т.к. мы не знаем email
+            notification_url=f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
+            return_url=os.getenv("BOT_LINK") or "https://t.me/n_deniseva_bot",
+        )
+    return await checkout_links.get(user_id, price, create)
 
 
 @dp.callback_query(F.data == "pay_again")
 async def pay_again(callback: types.CallbackQuery):
-    """Сгенерировать новую ссылку на оплату с актуальной суммой подписки."""
+    """Ссылка на оплату с актуальной суммой подписки (повторные нажатия — та же ссылка)."""
     user_id = callback.from_user.id
-    price_str = await db.get_setting("subscription_price") or "30"
-    try:
-        price = float(price_str)
-    except ValueError:
-        price = 30.0
-
-    order_id = f"{user_id}:{int(time.time())}"
-    email = f"user{user_id}@telegram.bot"
-
-    payment_url = await bepaid.create_checkout_link(
-        amount=price,
-        currency="BYN",
-        description="Подписка на закрытый канал (повторная оплата)",
-        order_id=order_id,
-        email=email,
-        notification_url=f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
-        return_url=os.getenv("BOT_LINK") or "https://t.me/n_deniseva_bot",
-    )
+    price = db.get_subscription_price()
+
+    payment_url = await get_checkout_link(user_id, price, "Подписка на закрытый канал (повторная оплата)")
 
     if not payment_url:
         await callback.message.answer("❌ Не удалось сформировать ссылку на оплату. Попробуйте позже.")
@@ -343,29 +755,20 @@ async def pay_again(callback: types.CallbackQuery):
 @dp.message(CommandStart())
 async def cmd_start(message: types.Message):
     user = message.from_user
-    print(f"--- USER ID: {user.id} ---")
+    logger.debug("/start from user %s", user.id)
     await db.add_user(user.id, user.username, user.full_name)
     
-    intro = await db.get_setting("welcome_text") or "Добро пожаловать в наш бот!\n\nПожалуйста, ознакомьтесь с правилами ниже.\n\nНажмите кнопку ниже, чтобы продолжить."
-    if WELCOME_LINKS_HTML not in intro:
-        full_welcome = intro.rstrip() + "\n\n" + WELCOME_LINKS_HTML
-    else:
-        full_welcome = intro
-    welcome_photo = await db.get_setting("welcome_photo")
+    full_welcome, welcome_photo, welcome_kb = await get_welcome_payload()
     
     if welcome_photo:
-        await message.answer_photo(photo=welcome_photo, caption=full_welcome, parse_mode="HTML", reply_markup=kb.get_welcome_keyboard())
+        await message.answer_photo(photo=welcome_photo, caption=full_welcome, parse_mode="HTML", reply_markup=welcome_kb)
     else:
-        await message.answer(text=full_welcome, parse_mode="HTML", disable_web_page_preview=True, reply_markup=kb.get_welcome_keyboard())
+        await message.answer(text=full_welcome, parse_mode="HTML", disable_web_page_preview=True, reply_markup=welcome_kb)
 
     # Админу показываем отдельную кнопку над клавиатурой для входа в админ-панель
     if await is_admin(user.id):
-        admin_kb = types.ReplyKeyboardMarkup(
-            keyboard=[[types.KeyboardButton(text="Админ-панель")]],
-            resize_keyboard=True
-        )
         # Отправляем явное сообщение, чтобы клавиатура точно появилась
-        await message.answer("🔧 Вы администратор. Меню управления доступно по кнопке ниже.", reply_markup=admin_kb)
+        await message.answer("🔧 Вы администратор. Меню управления доступно по кнопке ниже.", reply_markup=kb.ADMIN_REPLY_KEYBOARD)
 
 @dp.callback_query(F.data == "agreed_to_terms")
 async def process_agreement(callback: types.CallbackQuery):
@@ -379,17 +782,11 @@ async def start_payment(callback: types.CallbackQuery):
 
     # Админ пропускает оплату — сразу выдаём блок подписчика (инвайт + кнопки)
     if await is_admin(user_id):
-        days_str = await db.get_setting("subscription_days") or "30"
-        days = int(days_str)
+        days = db.get_subscription_days()
         new_end_date = time.time() + (days * 24 * 60 * 60)
         await db.set_subscription(user_id, status=True, end_date=new_end_date)
         try:
-            invite_link_obj = await bot.create_chat_invite_link(
-                chat_id=CHANNEL_ID,
-                member_limit=1,
-                name=f"Admin_{user_id}_{int(time.time())}"
-            )
-            invite_link = invite_link_obj.invite_link
+            invite_link = await invite_pool.take(user_id, name=f"Admin_{user_id}_{int(time.time())}")
         except Exception as e:
             logger.warning("Admin bypass: could not create invite link: %s", e)
             invite_link = None
@@ -401,20 +798,8 @@ async def start_payment(callback: types.CallbackQuery):
         await callback.answer()
         return
 
-    price_str = await db.get_setting("subscription_price") or "10"
-    price = float(price_str)
-    order_id = f"{user_id}:{int(time.time())}"
-    email = f"user{user_id}@telegram.bot" # Заглушка, т.к. мы не знаем email
-    
-    payment_url = await bepaid.create_checkout_link(
-        amount=price,
-        currency="BYN",
-        description="Подписка на закрытый канал",
-        order_id=order_id,
-        email=email,
-        notification_url=f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
-        return_url=os.getenv("BOT_LINK") or "https://t.me/n_deniseva_bot"
-    )
+    price = db.get_subscription_price()
+    payment_url = await get_checkout_link(user_id, price, "Подписка на закрытый канал")
     
     if payment_url:
         # Отправляем кнопку с ссылкой на оплату
@@ -441,7 +826,10 @@ async def process_cancel_sub(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "cancel_subscription_confirm")
 async def process_cancel_sub_confirm(callback: types.CallbackQuery):
     user_id = callback.from_user.id
+    previous = await db.get_user_subscription(user_id)
     await db.set_subscription(user_id, status=False, card_token="")
+    if previous and previous[0]:
+        await db.count_stats(cancelled=1)
     logger.info(
         "Subscription cancelled by user: user_id=%s, token_removed=yes, auto_charge_disabled=yes, kick_attempt=now",
         user_id,
@@ -575,6 +963,18 @@ async def cmd_force_kick(message: types.Message):
         logger.error("Force kick failed for uid=%s: %s", uid, e)
 
 
+@dp.message(Command("reconcile"))
+async def cmd_reconcile(message: types.Message):
+    """/reconcile — сверить участников канала с подписками, не дожидаясь планового прохода."""
+    if not await is_admin(message.from_user.id):
+        return
+    await db.request_job_run(RECONCILE_JOB)
+    await message.answer(
+        "Сверка участников канала запланирована (начнётся в течение минуты)."
+        + ("\nRECONCILE_DRY_RUN: баны и разбаны будут только в логе." if RECONCILE_DRY_RUN else "")
+    )
+
+
 # --- Admin Handlers (Оставил основные, добавил цену) ---
 
 @dp.message(Command("admin"))
@@ -588,11 +988,7 @@ async def cmd_admin(message: types.Message):
     await message.answer("🔧 Админ-панель:", reply_markup=kb.get_admin_keyboard())
 
     # И гарантированно показываем reply-клавиатуру с кнопкой «Админ-панель»
-    admin_kb = types.ReplyKeyboardMarkup(
-        keyboard=[[types.KeyboardButton(text="Админ-панель")]],
-        resize_keyboard=True,
-    )
-    await message.answer("Клавиатура управления:", reply_markup=admin_kb)
+    await message.answer("Клавиатура управления:", reply_markup=kb.ADMIN_REPLY_KEYBOARD)
 
 
 @dp.callback_query(F.data == "open_admin_panel")
@@ -605,11 +1001,7 @@ async def open_admin_panel(callback: types.CallbackQuery):
 
     # То же поведение, что и у /admin
     await callback.message.answer("🔧 Админ-панель:", reply_markup=kb.get_admin_keyboard())
-    admin_kb = types.ReplyKeyboardMarkup(
-        keyboard=[[types.KeyboardButton(text="Админ-панель")]],
-        resize_keyboard=True,
-    )
-    await callback.message.answer("Клавиатура управления:", reply_markup=admin_kb)
+    await callback.message.answer("Клавиатура управления:", reply_markup=kb.ADMIN_REPLY_KEYBOARD)
     await callback.answer()
 
 # ... (остальные хендлеры админки те же, добавлю только один для цены) ...
@@ -623,17 +1015,13 @@ async def admin_broadcast_start(callback: types.CallbackQuery, state: FSMContext
 
 @dp.message(AdminStates.waiting_for_broadcast)
 async def admin_broadcast_send(message: types.Message, state: FSMContext):
-    users = await db.get_users()
-    count = 0
-    status_msg = await message.answer(f"Начинаю рассылку для {len(users)} пользователей...")
-    for user_id in users:
-        try:
-            await message.copy_to(chat_id=user_id)
-            count += 1
-            await asyncio.sleep(0.05) 
-        except Exception:
-            pass
-    await status_msg.edit_text("✅Рассылка завершена.")
+    total = await db.count_broadcast_recipients()
+    status_msg = await message.answer(f"Начинаю рассылку для {total} пользователей...")
+    # Рассылка идёт в фоне; прогресс — правками status_msg
+    await broadcaster.start(
+        message.chat.id, message.message_id, status_msg.chat.id, status_msg.message_id,
+        run_here=leader.is_leader,
+    )
     await state.clear()
     await message.answer("🔧 Админ-панель:", reply_markup=kb.get_admin_keyboard())
 
@@ -689,7 +1077,7 @@ async def admin_save_payment_text(message: types.Message, state: FSMContext):
 async def admin_edit_price(callback: types.CallbackQuery, state: FSMContext):
     if not await is_admin(callback.from_user.id):
         return
-    current_price = await db.get_setting("subscription_price") or "30"
+    current_price = db.get_subscription_price()
     await state.set_state(AdminStates.waiting_for_price)
     await callback.message.answer(
         f"Текущая стоимость подписки: {current_price} BYN.\n"
@@ -703,10 +1091,10 @@ async def admin_edit_price(callback: types.CallbackQuery, state: FSMContext):
 async def admin_save_price(message: types.Message, state: FSMContext):
     text = (message.text or "").replace(",", ".").strip()
     try:
-        price = float(text)
-        if price <= 0:
+        price = Decimal(text)
+        if not price.is_finite() or price <= 0:
             raise ValueError
-    except ValueError:
+    except (ValueError, InvalidOperation):
         await message.answer("Некорректное значение. Введите положительное число, например 30 или 29.9.")
         return
 
@@ -716,6 +1104,47 @@ async def admin_save_price(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("🔧 Админ-панель:", reply_markup=kb.get_admin_keyboard())
 
+def _format_daily_stats(rows, price: Decimal) -> str:
+    header = f"{'День':<5} {'Нов':>4} {'Прод':>4} {'Отк':>4} {'Кик':>4} {'Отм':>4} {'BYN':>8}"
+    lines = [header]
+    totals = [0] * 6
+    for day, *counters, _active in rows:
+        totals = [total + value for total, value in zip(totals, counters)]
+        new_subs, renewals, failed, kicked, cancelled, revenue = counters
+        lines.append(
+            f"{day[5:]:<5} {new_subs:>4} {renewals:>4} {failed:>4} {kicked:>4} {cancelled:>4} {revenue / 100:>8.2f}"
+        )
+    new_subs, renewals, failed, kicked, cancelled, revenue = totals
+    lines.append(f"{'Итого':<5} {new_subs:>4} {renewals:>4} {failed:>4} {kicked:>4} {cancelled:>4} {revenue / 100:>8.2f}")
+
+    # Снимок активных — самый свежий из строк, где он есть (пишет планировщик)
+    active = next((row[-1] for row in rows if row[-1] is not None), None)
+    summary = [f"📊 Статистика за {STATS_REPORT_DAYS} дн. (UTC)"]
+    if active is not None:
+        churned = kicked + cancelled
+        summary.append(f"Активных подписок: {active}")
+        summary.append(f"MRR (оценка): {active * price:.2f} BYN")
+        summary.append(f"Отток: {churned} ({churned * 100 / (active + churned) if active + churned else 0:.1f}%)")
+    attempts = renewals + failed
+    if attempts:
+        summary.append(f"Успешных автопродлений: {renewals * 100 / attempts:.1f}%")
+    legend = "Нов — новые, Прод — продления, Отк — отказы автосписания, Кик — удалены после грейса, Отм — отменили сами."
+    return "\n".join(summary) + "\n\n<pre>" + html.escape("\n".join(lines)) + "</pre>\n" + legend
+
+
+@dp.callback_query(F.data == "admin_stats")
+async def admin_stats(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        return
+    rows = await db.get_daily_stats(STATS_REPORT_DAYS)
+    if rows:
+        text = _format_daily_stats(rows, db.get_subscription_price())
+    else:
+        text = "📊 Статистики пока нет."
+    await callback.message.answer(text, parse_mode="HTML", reply_markup=kb.get_admin_keyboard())
+    await callback.answer()
+
+
 @dp.callback_query(F.data == "cancel_action")
 async def cancel_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
@@ -726,7 +1155,7 @@ async def cancel_handler(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 # --- Main ---
-async def main():
+async def main(worker_index: int = 0):
     if not CHANNEL_ID:
         logger.critical("CHANNEL_ID не задан в .env. Проверьте файл .env в папке с ботом.")
         raise SystemExit(1)
@@ -738,19 +1167,107 @@ async def main():
     # Создаем aiohttp приложение для вебхуков
     app = web.Application()
     app.router.add_post(WEBHOOK_PATH, bepaid_webhook_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    if TELEGRAM_WEBHOOK_URL:
+        # Апдейты Telegram на том же сервере: проверяем секрет, отвечаем 200 сразу,
+        # а обработку запускаем фоновой задачей — апдейты разбираются параллельно
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            handle_in_background=True,
+        ).register(app, path=TELEGRAM_WEBHOOK_PATH)
+        # startup/shutdown диспетчера — вместе с приложением
+        setup_application(app, dp, bot=bot)
     
     # Запускаем сервер в фоне
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT)
+    site = web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT, reuse_port=WORKERS > 1)
     await site.start()
     
     print(f"Bot started. Webhook listening on {WEBHOOK_HOST}{WEBHOOK_PATH}")
     
-    # Запускаем планировщик
-    asyncio.create_task(check_recurring_payments())
+    # Воркеры очереди вебхуков bePaid
+    background = [asyncio.create_task(webhook_worker()) for _ in range(WEBHOOK_WORKERS)]
+    # Отправитель уведомлений из outbox (досылает и то, что не ушло до рестарта)
+    background.append(asyncio.create_task(notifier.run()))
+    # Планировщик и рассылки (в т.ч. прерванные рестартом) — у процесса, взявшего аренду
+    background.append(asyncio.create_task(leader.run()))
+    if WORKERS > 1:
+        background.append(asyncio.create_task(settings_refresher()))
     
-    await dp.start_polling(bot)
+    try:
+        if TELEGRAM_WEBHOOK_URL:
+            if worker_index == 0:
+                await bot.set_webhook(
+                    f"{TELEGRAM_WEBHOOK_URL}{TELEGRAM_WEBHOOK_PATH}",
+                    secret_token=TELEGRAM_WEBHOOK_SECRET,
+                    allowed_updates=dp.resolve_used_update_types(),
+                    max_connections=TELEGRAM_MAX_CONNECTIONS,
+                )
+                logger.info("Telegram updates via webhook %s%s", TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_PATH)
+            # Вебхук не снимаем при остановке: апдейты за время рестарта Telegram доставит позже
+            await asyncio.Event().wait()
+        else:
+            # Вебхук мог остаться от запуска в режиме webhook — иначе getUpdates не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        # Фоновые задачи останавливаем до закрытия bePaid и БД, которыми они пользуются
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await leader.release()
+        await runner.cleanup()
+        if TELEGRAM_WEBHOOK_URL:
+            await bot.session.close()
+        await bepaid.close()
+        await db.close_db()
+
+async def _serve_worker(worker_index: int):
+    # terminate() от родителя — штатная остановка: отдаём аренду и закрываем БД
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    await main(worker_index)
+
+
+def _worker_entry(worker_index: int):
+    try:
+        asyncio.run(_serve_worker(worker_index))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+def run_workers(count: int):
+    """Запустить count процессов бота и перезапускать упавшие."""
+    if not TELEGRAM_WEBHOOK_URL:
+        logger.critical("WORKERS > 1 требует TELEGRAM_WEBHOOK_URL: long polling возможен только в одном процессе.")
+        raise SystemExit(1)
+    ctx = multiprocessing.get_context("spawn")
+    processes = {}
+    try:
+        while True:
+            for index in range(count):
+                proc = processes.get(index)
+                if proc is not None and proc.is_alive():
+                    continue
+                if proc is not None:
+                    logger.warning("Worker %s exited with code %s, restarting", index, proc.exitcode)
+                proc = ctx.Process(target=_worker_entry, args=(index,), name=f"bot-worker-{index}")
+                proc.start()
+                processes[index] = proc
+            time.sleep(WORKER_RESTART_DELAY)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in processes.values():
+            proc.terminate()
+        for proc in processes.values():
+            proc.join(timeout=30)
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        asyncio.run(main())
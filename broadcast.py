@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """
+    Рассылка копии сообщения всем пользователям.
+
+    - параллельные отправители (concurrency) под общим лимитом Telegram (rate сообщений/сек);
+      в каждый чат уходит одно сообщение, так что лимит «1 сообщение/сек на чат» не нарушается;
+    - на RetryAfter (flood wait) приостанавливаем всю рассылку на retry_after и повторяем;
+    - заблокировавших бота / удалённые аккаунты помечаем в users.blocked_at — дальше их пропускаем;
+    - прогресс (курсор по id и счётчики) пишется в таблицу broadcasts после каждой страницы,
+      поэтому после рестарта рассылка продолжается с места остановки (resume_unfinished);
+    - статус-сообщение админа периодически редактируется с текущим прогрессом;
+    - рассылка, прерванная ошибкой, повторяется с экспоненциальной паузой; после max_attempts
+      неудач подряд она помечается 'failed' и больше не возобновляется (видно в статусе).
+    """
+
+    def __init__(self, bot: Bot, rate: float = 25.0, concurrency: int = 20,
+                 page_size: int = 100, progress_interval: float = 3.0,
+                 max_attempts: int = 5, retry_base_delay: float = 30.0):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self._limiter = TokenBucket(rate=rate, capacity=rate)
+        self._paused_until = 0.0
+        self._tasks = {}
+
+    async def start(self, from_chat_id: int, message_id: int, status_chat_id: int, status_message_id: int,
+                    run_here: bool = True) -> int:
+        """run_here=False — только записать рассылку; запустит её процесс-лидер (resume_unfinished)."""
+        total = await db.count_broadcast_recipients()
+        broadcast_id = await db.create_broadcast(from_chat_id, message_id, status_chat_id, status_message_id, total)
+        if run_here:
+            self._spawn((broadcast_id, from_chat_id, message_id, status_chat_id, status_message_id, 0, total, 0, 0, 0))
+        return broadcast_id
+
+    async def resume_unfinished(self):
+        for row in await db.get_running_broadcasts():
+            if row[0] not in self._tasks:
+                logger.info("Resuming broadcast %s from user_id > %s", row[0], row[5])
+                self._spawn(row)
+
+    async def stop(self):
+        """Прервать рассылки этого процесса; прогресс сохранён, их продолжит resume_unfinished."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, row):
+        broadcast_id = row[0]
+        task = asyncio.create_task(self._run(*row))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _wait_pause(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _send_one(self, user_id: int, from_chat_id: int, message_id: int) -> str:
+        """Возвращает 'sent', 'blocked' или 'failed'."""
+        while True:
+            await self._wait_pause()
+            await self._limiter.acquire()
+            try:
+                await self.bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+                return "sent"
+            except TelegramRetryAfter as e:
+                # Flood wait касается всего бота — притормаживаем всех отправителей
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning("Broadcast flood wait %ss (user %s)", e.retry_after, user_id)
+            except TelegramForbiddenError:
+                # Бот заблокирован / пользователь удалён
+                return "blocked"
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                logger.warning("Broadcast to %s failed: %s", user_id, e)
+                return "failed"
+            except Exception as e:
+                logger.warning("Broadcast to %s failed: %s", user_id, e)
+                return "failed"
+
+    async def _edit_status(self, chat_id, message_id, text):
+        if not chat_id or not message_id:
+            return
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logger.debug("Broadcast status edit failed: %s", e)
+
+    async def _fail(self, broadcast_id, cursor_user_id, status_chat_id, status_message_id, counts, error):
+        attempts, retry_at = await db.fail_broadcast(
+            broadcast_id, str(error), self.max_attempts, self.retry_base_delay
+        )
+        totals = f"Доставлено: {counts['sent']}, заблокировали бота: {counts['blocked']}, ошибок: {counts['failed']}"
+        if retry_at is None:
+            logger.error(
+                "Broadcast %s failed at user_id > %s after %s attempts: %s",
+                broadcast_id, cursor_user_id, attempts, error,
+            )
+            text = f"❌ Рассылка остановлена после {attempts} неудачных попыток: {error}\n{totals}"
+        else:
+            retry_in = retry_at - time.time()
+            logger.error(
+                "Broadcast %s interrupted at user_id > %s (attempt %s/%s), retry in %.0fs: %s",
+                broadcast_id, cursor_user_id, attempts, self.max_attempts, retry_in, error,
+            )
+            text = (
+                f"⚠️ Рассылка прервана ошибкой (попытка {attempts}/{self.max_attempts}), "
+                f"повтор через {retry_in:.0f} сек: {error}\n{totals}"
+            )
+        await self._edit_status(status_chat_id, status_message_id, text)
+
+    async def _run(self, broadcast_id, from_chat_id, message_id, status_chat_id, status_message_id,
+                   cursor_user_id, total, sent, failed, blocked):
+        counts = {"sent": sent, "failed": failed, "blocked": blocked}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_progress = time.monotonic()
+        started = time.monotonic()
+
+        async def send(user_id):
+            async with semaphore:
+                return user_id, await self._send_one(user_id, from_chat_id, message_id)
+
+        try:
+            while True:
+                page = await db.get_broadcast_recipients(cursor_user_id, self.page_size)
+                if not page:
+                    break
+                results = await asyncio.gather(*(send(user_id) for user_id in page))
+                newly_blocked = [user_id for user_id, outcome in results if outcome == "blocked"]
+                for _, outcome in results:
+                    counts[outcome] += 1
+                await db.mark_users_blocked(newly_blocked)
+                cursor_user_id = page[-1]
+                await db.save_broadcast_progress(
+                    broadcast_id, cursor_user_id, counts["sent"], counts["failed"], counts["blocked"]
+                )
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    done = counts["sent"] + counts["failed"] + counts["blocked"]
+                    await self._edit_status(
+                        status_chat_id, status_message_id,
+                        f"📢 Рассылка: {done}/{total}\n"
+                        f"Доставлено: {counts['sent']}, заблокировали бота: {counts['blocked']}, "
+                        f"ошибок: {counts['failed']}",
+                    )
+        except Exception as e:
+            await self._fail(broadcast_id, cursor_user_id, status_chat_id, status_message_id, counts, e)
+            return
+
+        await db.save_broadcast_progress(
+            broadcast_id, cursor_user_id, counts["sent"], counts["failed"], counts["blocked"], done=True
+        )
+        elapsed = time.monotonic() - started
+        logger.info(
+            "Broadcast %s done: sent=%s blocked=%s failed=%s elapsed=%.1fs",
+            broadcast_id, counts["sent"], counts["blocked"], counts["failed"], elapsed,
+        )
+        await self._edit_status(
+            status_chat_id, status_message_id,
+            f"✅Рассылка завершена.\n"
+            f"Доставлено: {counts['sent']}, заблокировали бота: {counts['blocked']}, ошибок: {counts['failed']}",
+        )
@@ -2,9 +2,25 @@
 """
 Проверка подписок и привязки карт. Запуск на сервере:
   cd /opt/tgbotpavelganaratsky-podpiska && ./venv/bin/python check_subscriptions.py
+
+Без аргументов — последние 30 подписок, как раньше. Отчёты:
+  check_subscriptions.py status                 # сколько активных / с картой / в грейсе / заблокировали бота
+  check_subscriptions.py renewals --days 14     # продления по дням: с картой (автосписание) и без
+  check_subscriptions.py queues                 # очереди планировщика: списание, грейс, напоминания, кик
+  check_subscriptions.py queues --list kick     # ID из очереди (построчно, без загрузки в память)
+  check_subscriptions.py cards                  # доля активных подписок с привязанной картой
+  check_subscriptions.py list --limit 0 --format csv -o users.csv   # все пользователи
+
+--format table|csv|json, -o FILE — вывод в файл. Строки читаются курсором и пишутся сразу,
+сводки считаются агрегатными запросами в SQLite — память не зависит от числа пользователей.
+База открывается только на чтение; путь — DB_NAME из .env (по умолчанию bot_database.db рядом).
 """
+import argparse
 import asyncio
+import csv
+import json
 import os
+import sys
 import time
 from pathlib import Path
 from datetime import datetime
@@ -12,30 +28,263 @@ from datetime import datetime
 from dotenv import load_dotenv
 import aiosqlite
 
-load_dotenv(Path(__file__).resolve().parent / ".env")
-DB_NAME = Path(__file__).resolve().parent / "bot_database.db"
+BASE_DIR = Path(__file__).resolve().parent
+load_dotenv(BASE_DIR / ".env")
+DB_NAME = BASE_DIR / os.getenv("DB_NAME", "bot_database.db")
+
+# Как в database.py: напоминание в грейсе не чаще раза в сутки
+GRACE_NOTICE_INTERVAL = 24 * 60 * 60
+
+_HAS_CARD = "(card_token IS NOT NULL AND card_token != '')"
+
+
+def _sql_ts(column: str) -> str:
+    """Дата в формате _fmt_ts, но средствами SQLite — на больших выгрузках это основная работа."""
+    return f"COALESCE(strftime('%Y-%m-%d %H:%M UTC', {column}, 'unixepoch'), '-')"
+
+# Очереди планировщика — те же условия, что в database.py (get_users_due_payment и т.д.)
+_QUEUES = {
+    "charge": f"""subscription_active = 1 AND {_HAS_CARD} AND subscription_end_date <= :now
+                  AND (grace_until_ts IS NULL OR grace_until_ts <= :now)""",
+    "grace_start": f"""subscription_active = 1 AND NOT {_HAS_CARD} AND subscription_end_date <= :now
+                       AND grace_until_ts IS NULL""",
+    "grace_notice": """subscription_active = 1 AND subscription_end_date <= :now
+                       AND grace_until_ts IS NOT NULL AND grace_until_ts > :now
+                       AND (last_payment_fail_notice_ts IS NULL OR last_payment_fail_notice_ts <= :day_ago)""",
+    "kick": f"""subscription_active = 1 AND subscription_end_date <= :now AND NOT {_HAS_CARD}
+                AND grace_until_ts IS NOT NULL AND grace_until_ts <= :now""",
+}
+
+
+def _fmt_ts(ts):
+    return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M UTC") if ts else "-"
+
+
+class _Writer:
+    """Построчный вывод table / csv / json (массив объектов пишется по одному)."""
+
+    def __init__(self, fmt: str, stream, columns):
+        self.fmt = fmt
+        self.stream = stream
+        self.columns = columns
+        self._count = 0
+        if fmt == "csv":
+            self._csv = csv.writer(stream)
+            self._csv.writerow(columns)
+        elif fmt == "json":
+            stream.write("[")
+        else:
+            stream.write(" | ".join(f"{c:<14}" for c in columns).rstrip() + "\n")
+            stream.write("-" * (17 * len(columns)) + "\n")
+
+    def rows(self, rows):
+        if self.fmt == "csv":
+            self._csv.writerows(rows)
+            self._count += len(rows)
+            return
+        for values in rows:
+            self.row(values)
+
+    def row(self, values):
+        if self.fmt == "csv":
+            self._csv.writerow(values)
+        elif self.fmt == "json":
+            prefix = "," if self._count else ""
+            self.stream.write(prefix + "\n  " + json.dumps(dict(zip(self.columns, values)), ensure_ascii=False))
+        else:
+            self.stream.write(" | ".join(f"{'-' if v is None else v!s:<14}" for v in values).rstrip() + "\n")
+        self._count += 1
+
+    def close(self):
+        if self.fmt == "json":
+            self.stream.write("\n]\n" if self._count else "]\n")
+
+
+async def _stream(db, sql, params, writer: _Writer, chunk_size: int = 2000):
+    async with db.execute(sql, params) as cursor:
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            writer.rows(rows)
 
 
-async def main():
-    now = time.time()
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("""
-            SELECT id, subscription_active, subscription_end_date, 
-                   CASE WHEN card_token IS NOT NULL AND card_token != '' THEN 1 ELSE 0 END
+async def report_list(db, args, out):
+    if args.format == "table" and args.limit == 30 and out is sys.stdout:
+        # Прежний вид по умолчанию
+        async with db.execute(f"""
+            SELECT id, subscription_active, subscription_end_date, CASE WHEN {_HAS_CARD} THEN 1 ELSE 0 END
             FROM users
             ORDER BY subscription_end_date DESC
             LIMIT 30
         """) as cur:
             rows = await cur.fetchall()
-    print("user_id      | active | sub_until           | card_saved")
-    print("-" * 60)
-    for (uid, active, end_ts, has_card) in rows:
-        end_str = datetime.utcfromtimestamp(end_ts).strftime("%Y-%m-%d %H:%M UTC") if end_ts else "-"
-        print(f"{uid:<12} | {active}      | {end_str} | {'YES' if has_card else 'NO'}")
-    print()
-    print("card_saved=YES -> карта привязана, будут автосписания.")
-    print("sub_until — до этой даты подписка; потом бот попытается списать с карты.")
+        print("user_id      | active | sub_until           | card_saved")
+        print("-" * 60)
+        for (uid, active, end_ts, has_card) in rows:
+            print(f"{uid:<12} | {active}      | {_fmt_ts(end_ts)} | {'YES' if has_card else 'NO'}")
+        print()
+        print("card_saved=YES -> карта привязана, будут автосписания.")
+        print("sub_until — до этой даты подписка; потом бот попытается списать с карты.")
+        return
+    writer = _Writer(args.format, out, ["user_id", "active", "sub_until", "card_saved", "grace_until", "blocked"])
+    limit = f"LIMIT {int(args.limit)}" if args.limit > 0 else ""
+    await _stream(
+        db,
+        f"""
+        SELECT id, subscription_active, {_sql_ts("subscription_end_date")}, CASE WHEN {_HAS_CARD} THEN 1 ELSE 0 END,
+               {_sql_ts("grace_until_ts")}, CASE WHEN blocked_at IS NOT NULL THEN 1 ELSE 0 END
+        FROM users
+        ORDER BY subscription_end_date DESC
+        {limit}
+        """,
+        (),
+        writer,
+    )
+    writer.close()
+
+
+async def report_status(db, args, out):
+    async with db.execute(
+        f"""
+        SELECT
+            COUNT(*),
+            SUM(subscription_active = 1),
+            SUM(subscription_active = 1 AND {_HAS_CARD}),
+            SUM(subscription_active = 1 AND subscription_end_date > :now),
+            SUM(subscription_active = 1 AND grace_until_ts IS NOT NULL AND grace_until_ts > :now),
+            SUM(subscription_active = 0 AND subscription_end_date IS NOT NULL),
+            SUM(subscription_end_date IS NULL AND subscription_active = 0),
+            SUM(agreed_to_terms = 1),
+            SUM(blocked_at IS NOT NULL)
+        FROM users
+        """,
+        {"now": int(time.time())},
+    ) as cursor:
+        row = await cursor.fetchone()
+    names = [
+        "users_total", "active", "active_with_card", "active_paid_period", "in_grace",
+        "expired", "never_subscribed", "agreed_to_terms", "blocked_bot",
+    ]
+    writer = _Writer(args.format, out, ["metric", "users"])
+    for name, value in zip(names, row):
+        writer.row((name, value or 0))
+    writer.close()
+
+
+async def report_renewals(db, args, out):
+    now = int(time.time())
+    writer = _Writer(args.format, out, ["date", "renewals", "with_card", "without_card"])
+    await _stream(
+        db,
+        f"""
+        SELECT date(subscription_end_date, 'unixepoch') AS day, COUNT(*),
+               SUM({_HAS_CARD}), SUM(NOT {_HAS_CARD})
+        FROM users
+        WHERE subscription_active = 1 AND subscription_end_date > ? AND subscription_end_date <= ?
+        GROUP BY day
+        ORDER BY day
+        """,
+        (now, now + args.days * 24 * 60 * 60),
+        writer,
+    )
+    writer.close()
+
+
+async def report_queues(db, args, out):
+    now = int(time.time())
+    params = {"now": now, "day_ago": now - GRACE_NOTICE_INTERVAL}
+    if args.list:
+        writer = _Writer(args.format, out, ["user_id", "sub_until", "grace_until"])
+        await _stream(
+            db,
+            f"""SELECT id, {_sql_ts("subscription_end_date")}, {_sql_ts("grace_until_ts")}
+                FROM users WHERE {_QUEUES[args.list]} ORDER BY id""",
+            params,
+            writer,
+        )
+        writer.close()
+        return
+    # Одним проходом по таблице: каждое условие — отдельная сумма
+    sums = ", ".join(f"SUM({condition})" for condition in _QUEUES.values())
+    async with db.execute(f"SELECT {sums} FROM users", params) as cursor:
+        row = await cursor.fetchone()
+    writer = _Writer(args.format, out, ["queue", "users"])
+    for name, value in zip(_QUEUES, row):
+        writer.row((name, value or 0))
+    writer.close()
+
+
+async def report_cards(db, args, out):
+    async with db.execute(
+        f"""
+        SELECT SUM(subscription_active = 1), SUM(subscription_active = 1 AND {_HAS_CARD}),
+               COUNT(*), SUM({_HAS_CARD})
+        FROM users
+        """
+    ) as cursor:
+        active, active_card, total, total_card = (value or 0 for value in await cursor.fetchone())
+    writer = _Writer(args.format, out, ["scope", "users", "with_card", "coverage_pct"])
+    writer.row(("active", active, active_card, round(active_card * 100 / active, 1) if active else 0.0))
+    writer.row(("all", total, total_card, round(total_card * 100 / total, 1) if total else 0.0))
+    writer.close()
+
+
+REPORTS = {
+    "list": report_list,
+    "status": report_status,
+    "renewals": report_renewals,
+    "queues": report_queues,
+    "cards": report_cards,
+}
+
+
+def _common_options(parser, defaults: bool = True):
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+    parser.add_argument("--format", choices=("table", "csv", "json"), default=default("table"))
+    parser.add_argument("-o", "--output", default=default(None), help="записать в файл вместо stdout")
+    parser.add_argument("--db", default=default(str(DB_NAME)), help="путь к базе (по умолчанию DB_NAME)")
+    return parser
+
+
+def _parse_args(argv):
+    parser = _common_options(argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+    ))
+    # Те же опции после имени отчёта; SUPPRESS — чтобы не затирать указанные до него
+    common = _common_options(argparse.ArgumentParser(add_help=False), defaults=False)
+    sub = parser.add_subparsers(dest="report")
+    p = sub.add_parser("list", parents=[common], help="пользователи по дате окончания подписки")
+    p.add_argument("--limit", type=int, default=30, help="сколько строк (0 — все)")
+    sub.add_parser("status", parents=[common], help="разбивка по статусам подписки")
+    p = sub.add_parser("renewals", parents=[common], help="предстоящие продления по дням")
+    p.add_argument("--days", type=int, default=14)
+    p = sub.add_parser("queues", parents=[common], help="очереди планировщика")
+    p.add_argument("--list", choices=tuple(_QUEUES), help="вывести ID пользователей очереди")
+    sub.add_parser("cards", parents=[common], help="покрытие привязанными картами")
+
+    args = parser.parse_args(argv)
+    if args.report is None:
+        args.report, args.limit = "list", 30
+    return args
+
+
+async def main(argv=None):
+    args = _parse_args(argv)
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        # as_uri() экранирует ?, # и % в пути — иначе они испортили бы URI
+        async with aiosqlite.connect(Path(args.db).resolve().as_uri() + "?mode=ro", uri=True) as db:
+            await REPORTS[args.report](db, args, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except BrokenPipeError:
+        # Вывод обрезан (| head) — не ошибка; stdout уводим в /dev/null, чтобы не упасть на flush при выходе
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
@@ -0,0 +1,65 @@
+import asyncio
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+
+class CheckoutCache:
+    """
+    Ссылки на оплату bePaid по пользователям: повторное нажатие «Оформить подписку» /
+    «Оплатить заново» отдаёт уже созданную ссылку, пока не истёк ttl и не изменилась цена.
+    Одновременные нажатия одного пользователя ждут один общий запрос к bePaid.
+
+    Кэш в памяти процесса (при WORKERS > 1 — свой в каждом процессе); после оплаты
+    ссылку пользователя сбрасывают через invalidate().
+    """
+
+    def __init__(self, ttl: float = 900.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # user_id -> (цена, ссылка, истекает_в по monotonic), в порядке последнего обращения
+        self._links: "OrderedDict[int, Tuple[Decimal, str, float]]" = OrderedDict()
+        self._pending: Dict[Tuple[int, Decimal], asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._links)
+
+    def _cached(self, user_id: int, price: Decimal) -> Optional[str]:
+        entry = self._links.get(user_id)
+        if entry is None:
+            return None
+        cached_price, url, expires_at = entry
+        if cached_price != price or time.monotonic() >= expires_at:
+            del self._links[user_id]
+            return None
+        self._links.move_to_end(user_id)
+        return url
+
+    async def get(self, user_id: int, price: Decimal, create: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """Ссылка из кэша или новая от create(); None (ошибка bePaid) не кэшируется."""
+        url = self._cached(user_id, price)
+        if url is not None:
+            return url
+        key = (user_id, price)
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(self._create(key, create))
+        # shield: отмена одного из ждущих хендлеров не обрывает общий запрос
+        return await asyncio.shield(future)
+
+    async def _create(self, key: Tuple[int, Decimal], create) -> Optional[str]:
+        user_id, price = key
+        try:
+            url = await create()
+            if url:
+                self._links[user_id] = (price, url, time.monotonic() + self.ttl)
+                self._links.move_to_end(user_id)
+                while len(self._links) > self.max_entries:
+                    self._links.popitem(last=False)
+            return url
+        finally:
+            self._pending.pop(key, None)
+
+    def invalidate(self, user_id: int):
+        self._links.pop(user_id, None)
@@ -1,9 +1,186 @@
 import aiosqlite
+import asyncio
+import functools
+import logging
 import os
+import sqlite3
 import time
+from contextlib import asynccontextmanager
+from decimal import Decimal, InvalidOperation
 from typing import Optional
 
-DB_NAME = "bot_database.db"
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Путь к файлу базы (переопределяется из окружения — например, бенчмарками)
+DB_NAME = os.getenv("DB_NAME", "bot_database.db")
+# Сколько соединений держим под чтение (писатель всегда один — SQLite всё равно сериализует запись)
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+
+# WAL: читатели не блокируют писателя; synchronous=NORMAL в WAL безопасен и без fsync на каждый commit
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+
+class _ConnectionPool:
+    """
+    Долгоживущие соединения с БД: один писатель + пул читателей.
+    Открывается в init_db(), закрывается в close_db().
+    """
+
+    def __init__(self):
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: Optional[asyncio.Queue] = None
+        self._connections = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, path, query_only: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(path)
+        for pragma in _PRAGMAS:
+            await conn.execute(pragma)
+        if query_only:
+            await conn.execute("PRAGMA query_only=ON")
+        self._connections.append(conn)
+        return conn
+
+    async def open(self, path, readers: int = DB_READERS):
+        if self.is_open:
+            return
+        # Писатель первым: он создаёт файл и переводит его в WAL
+        self._writer = await self._connect(path)
+        self._path, self._reader_count = path, max(1, readers)
+        self._readers = asyncio.Queue()
+        for _ in range(self._reader_count):
+            self._readers.put_nowait(await self._connect(path, query_only=True))
+
+    async def reopen_readers(self):
+        """
+        Пересоздать соединения-читатели (все должны быть свободны). Нужно после миграций:
+        открытые раньше читатели не подхватывают статистику ANALYZE из пересобранной схемы
+        и планируют запросы планировщика полным сканом вместо частичных индексов.
+        """
+        self._ensure_open()
+        for _ in range(self._reader_count):
+            conn = self._readers.get_nowait()
+            self._connections.remove(conn)
+            await conn.close()
+        for _ in range(self._reader_count):
+            self._readers.put_nowait(await self._connect(self._path, query_only=True))
+
+    async def close(self):
+        if not self.is_open:
+            return
+        try:
+            await self._writer.execute("PRAGMA optimize")
+        except Exception:
+            pass
+        for conn in self._connections:
+            await conn.close()
+        self._connections = []
+        self._writer = None
+        self._readers = None
+
+    def _ensure_open(self):
+        if not self.is_open:
+            raise RuntimeError("База данных не открыта: сначала вызовите init_db()")
+
+    @asynccontextmanager
+    async def write(self):
+        """Эксклюзивный доступ к писателю; commit при успехе, rollback при ошибке."""
+        self._ensure_open()
+        started = time.perf_counter()
+        async with self._write_lock:
+            metrics.DB_WRITE_LOCK_WAIT.observe(time.perf_counter() - started)
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+    @asynccontextmanager
+    async def read(self):
+        self._ensure_open()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+
+_pool = _ConnectionPool()
+
+
+def _timed(func):
+    """Длительность вызова — в db_call_duration_seconds (метка — имя функции)."""
+    histogram = metrics.DB_CALL_DURATION.labels(func.__qualname__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+# Кэш таблицы settings: загружается целиком в init_db и обновляется в set_setting (write-through),
+# поэтому чтение настроек на горячих путях не делает запросов к БД.
+_settings: dict = {}
+# Растёт при каждом изменении кэша настроек: по нему производные кэши (приветствие) понимают, что устарели
+_settings_version = 0
+
+DEFAULT_SUBSCRIPTION_PRICE = Decimal("30")
+DEFAULT_SUBSCRIPTION_DAYS = 30
+
+# Реестр админов: ID из .env (задаются при старте) + таблица admins.
+# Таблица перечитывается не чаще раза в ADMIN_CACHE_TTL секунд и сразу при add_admin.
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))
+_static_admin_ids: frozenset = frozenset()
+_admin_ids: frozenset = frozenset()
+_admin_ids_expire_at = 0.0
+
+# Как часто напоминаем об оплате во время грейс-периода
+GRACE_NOTICE_INTERVAL = 86400
+
+# Подписчики на изменение дедлайнов пользователя: callback(user_id, ts | None).
+# Через них планировщик узнаёт о новых датах (вебхук, set_subscription) без опроса БД.
+_deadline_listeners = []
+
+
+def add_deadline_listener(callback):
+    _deadline_listeners.append(callback)
+
+
+# Подписчики на появление новых уведомлений в outbox: callback() — будит диспетчер отправки
+_outbox_listeners = []
+
+
+def add_outbox_listener(callback):
+    _outbox_listeners.append(callback)
+
+
+def _notify_outbox():
+    for callback in _outbox_listeners:
+        callback()
+
+
+def _notify_deadline(user_id: int, ts: Optional[float]):
+    for callback in _deadline_listeners:
+        callback(user_id, ts)
 
 # Только вступительный текст (ссылки добавляются в коде — захардкожены)
 WELCOME_INTRO_DEFAULT = """Добро пожаловать в наш бот!
@@ -17,8 +194,252 @@ NEW_CANCEL_TEXT = """Для отмены подписки:
 2. Нажмите 'Отменить'.
 3. Если возникли вопросы, напишите в поддержку."""
 
+# Индексы под запросы планировщика (частичные — только активные подписки,
+# чтобы проход был O(должников), а не O(всех пользователей))
+_USERS_INDEXES = (
+    # get_users_due_payment: активные с картой, отсортированные по дате окончания
+    """CREATE INDEX IF NOT EXISTS idx_users_due_charge ON users(subscription_end_date)
+       WHERE subscription_active = 1 AND card_token IS NOT NULL AND card_token != ''""",
+    # get_users_expired_no_card_start_grace: активные без грейса по дате окончания
+    """CREATE INDEX IF NOT EXISTS idx_users_grace_pending ON users(subscription_end_date)
+       WHERE subscription_active = 1 AND grace_until_ts IS NULL""",
+    # get_users_expired_no_card_to_kick / get_users_in_grace_to_notify: только те, кто в грейсе
+    """CREATE INDEX IF NOT EXISTS idx_users_active_grace ON users(grace_until_ts)
+       WHERE subscription_active = 1 AND grace_until_ts IS NOT NULL""",
+)
+
+# STRICT-таблицы — с SQLite 3.37; на более старой библиотеке схема та же, но без проверки типов
+_STRICT = " STRICT" if sqlite3.sqlite_version_info >= (3, 37, 0) else ""
+
+# Все даты в users — целые секунды Unix (UTC): сравнения в запросах планировщика идут
+# INTEGER с INTEGER, без смешения аффинностей TIMESTAMP / REAL / текста CURRENT_TIMESTAMP
+_USERS_TABLE = f"""CREATE TABLE users_new (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    full_name TEXT,
+    agreed_to_terms INTEGER NOT NULL DEFAULT 0,
+    subscription_active INTEGER NOT NULL DEFAULT 0,
+    join_date INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+    bepaid_uid TEXT,
+    card_token TEXT,
+    subscription_end_date INTEGER,
+    last_payment_date INTEGER,
+    email TEXT,
+    grace_until_ts INTEGER,
+    last_payment_fail_ts INTEGER,
+    last_payment_fail_notice_ts INTEGER,
+    blocked_at INTEGER
+){_STRICT}"""
+
+
+def _epoch_sql(column: str) -> str:
+    """Старое значение даты -> целые секунды: число (float) отбрасывает дробную часть,
+    текст ('2024-01-31 12:00:00', как CURRENT_TIMESTAMP) разбирается strftime, мусор -> NULL."""
+    return (
+        f"CASE WHEN typeof({column}) IN ('integer', 'real') THEN CAST({column} AS INTEGER) "
+        f"ELSE CAST(strftime('%s', {column}) AS INTEGER) END"
+    )
+
+
+# Версионированные миграции схемы: номер версии хранится в PRAGMA user_version.
+# Каждая миграция — набор SQL, выполняемый в одной транзакции. Добавлять только в конец.
+_MIGRATIONS = (
+    # 1: индексы под запросы планировщика
+    (*_USERS_INDEXES, "ANALYZE users"),
+    # 2: рассылки с сохранением прогресса + отметка пользователей, заблокировавших бота
+    (
+        "ALTER TABLE users ADD COLUMN blocked_at REAL",
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            state TEXT NOT NULL DEFAULT 'running',
+            cursor_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at REAL,
+            finished_at REAL
+        )""",
+    ),
+    # 3: журнал транзакций bePaid (ключ — uid транзакции): дедупликация повторных вебхуков
+    (
+        """CREATE TABLE IF NOT EXISTS transactions (
+            uid TEXT PRIMARY KEY,
+            tracking_id TEXT,
+            user_id INTEGER,
+            kind TEXT NOT NULL DEFAULT 'checkout',
+            status TEXT,
+            amount INTEGER,
+            currency TEXT,
+            created_at REAL,
+            updated_at REAL,
+            processed_at REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id)",
+    ),
+    # 4: входящая очередь вебхуков bePaid (ответ 200 сразу после записи, обработка — воркерами)
+    (
+        """CREATE TABLE IF NOT EXISTS webhook_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            received_at REAL,
+            claimed_at REAL,
+            last_error TEXT
+        )""",
+        """CREATE INDEX IF NOT EXISTS idx_webhook_inbox_pending ON webhook_inbox(next_attempt_at)
+           WHERE state = 'pending'""",
+    ),
+    # 5: поиск списания по tracking_id (is_charge_successful перед повторной попыткой)
+    (
+        "CREATE INDEX IF NOT EXISTS idx_transactions_tracking ON transactions(tracking_id)",
+    ),
+    # 6: исходящие уведомления (outbox): пишутся вместе с изменением подписки, отправляются диспетчером
+    (
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            parse_mode TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            created_at REAL,
+            claimed_at REAL,
+            last_error TEXT
+        )""",
+        """CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at)
+           WHERE state = 'pending'""",
+    ),
+    # 7: состояния FSM (диалоги админки) — переживают рестарт бота
+    (
+        """CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL
+        )""",
+    ),
+    # 8: аренды (leader election между процессами): держатель и срок действия
+    (
+        """CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )""",
+    ),
+    # 9: пул заранее созданных одноразовых инвайт-ссылок (user_id IS NULL — свободна;
+    # свободную после expires_at отзываем и заменяем новой)
+    (
+        """CREATE TABLE IF NOT EXISTS invite_links (
+            link TEXT PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            user_id INTEGER,
+            claimed_at REAL
+        )""",
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_free ON invite_links(chat_id, expires_at)
+           WHERE user_id IS NULL""",
+    ),
+    # 10: состояние долгих фоновых задач (сверка участников канала): курсор для продолжения
+    # после рестарта; cursor IS NULL — проход завершён в finished_at
+    (
+        """CREATE TABLE IF NOT EXISTS job_state (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER,
+            started_at REAL,
+            finished_at REAL,
+            updated_at REAL
+        )""",
+    ),
+    # 11: сводка по дням (UTC) — счётчики увеличиваются вместе с изменениями подписок,
+    # отчёт в админке читает несколько строк, а не сканирует users
+    (
+        """CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            new_subs INTEGER NOT NULL DEFAULT 0,
+            renewals INTEGER NOT NULL DEFAULT 0,
+            failed_charges INTEGER NOT NULL DEFAULT 0,
+            kicked INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            revenue_cents INTEGER NOT NULL DEFAULT 0,
+            active_subs INTEGER
+        )""",
+    ),
+    # 12: users пересобирается с типизированной схемой (см. _USERS_TABLE) с переводом данных;
+    # индексы удаляются вместе со старой таблицей и создаются заново
+    (
+        _USERS_TABLE,
+        f"""INSERT INTO users_new (
+            id, username, full_name, agreed_to_terms, subscription_active, join_date,
+            bepaid_uid, card_token, subscription_end_date, last_payment_date, email,
+            grace_until_ts, last_payment_fail_ts, last_payment_fail_notice_ts, blocked_at
+        )
+        SELECT
+            id, CAST(username AS TEXT), CAST(full_name AS TEXT),
+            COALESCE(CAST(agreed_to_terms AS INTEGER), 0), COALESCE(CAST(subscription_active AS INTEGER), 0),
+            COALESCE({_epoch_sql("join_date")}, CAST(strftime('%s', 'now') AS INTEGER)),
+            CAST(bepaid_uid AS TEXT), CAST(card_token AS TEXT),
+            {_epoch_sql("subscription_end_date")}, {_epoch_sql("last_payment_date")}, CAST(email AS TEXT),
+            {_epoch_sql("grace_until_ts")}, {_epoch_sql("last_payment_fail_ts")},
+            {_epoch_sql("last_payment_fail_notice_ts")}, {_epoch_sql("blocked_at")}
+        FROM users""",
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+        *_USERS_INDEXES,
+        "ANALYZE users",
+    ),
+    # 13: повтор рассылки, прерванной ошибкой: счётчик неудачных попыток подряд и время
+    # следующей; после исчерпания попыток — state = 'failed'
+    (
+        "ALTER TABLE broadcasts ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE broadcasts ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE broadcasts ADD COLUMN last_error TEXT",
+    ),
+    # 14: уведомление об оплате — отдельный шаг после продления (notified_at); его можно
+    # повторить, не применяя платёж второй раз. Уже обработанные транзакции считаем уведомлёнными
+    (
+        "ALTER TABLE transactions ADD COLUMN notified_at REAL",
+        "UPDATE transactions SET notified_at = processed_at WHERE processed_at IS NOT NULL",
+    ),
+    # 15: первое неотправленное сообщение каждого чата (claim_notifications берёт только его)
+    (
+        """CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox(chat_id, id)
+           WHERE state IN ('pending', 'sending')""",
+    ),
+)
+
+
+async def _migrate(db):
+    async with db.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+    for target, statements in enumerate(_MIGRATIONS, start=1):
+        if target <= version:
+            continue
+        # IMMEDIATE + повторная проверка версии: несколько процессов могут стартовать одновременно
+        await db.execute("BEGIN IMMEDIATE")
+        async with db.execute("PRAGMA user_version") as cursor:
+            (version,) = await cursor.fetchone()
+        if target <= version:
+            await db.commit()
+            continue
+        for sql in statements:
+            await db.execute(sql)
+        await db.execute(f"PRAGMA user_version = {target}")
+        await db.commit()
+
+
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
+    await _pool.open(DB_NAME)
+    async with _pool.write() as db:
         # Обновляем таблицу users: добавляем поля для подписки
         # SQLite не поддерживает ADD COLUMN IF NOT EXISTS в старых версиях,
         # поэтому делаем через try/except или проверку PRAGMA table_info,
@@ -79,6 +500,7 @@ async def init_db():
                 value TEXT
             )
         """)
+        await _migrate(db)
         
         # При первом запуске — только вступление; ссылки всегда подставляются в коде
         await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('welcome_text', ?)", (WELCOME_INTRO_DEFAULT,))
@@ -90,111 +512,285 @@ async def init_db():
         await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('subscription_days', '30')")
         # Если раньше была цена 10 BYN и не меняли вручную — обновим до 30
         await db.execute("UPDATE settings SET value='30' WHERE key='subscription_price' AND value='10'")
-        
-        await db.commit()
+        await _load_settings(db)
+    await _pool.reopen_readers()
 
+@_timed
 async def add_user(user_id, username, full_name):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO users (id, username, full_name) VALUES (?, ?, ?)", (user_id, username, full_name))
-        await db.commit()
+    async with _pool.write() as db:
+        # Повторный /start от заблокировавшего ранее — снова получает рассылки
+        await db.execute(
+            "INSERT INTO users (id, username, full_name) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET blocked_at = NULL WHERE blocked_at IS NOT NULL",
+            (user_id, username, full_name),
+        )
 
+@_timed
 async def set_agreed(user_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET agreed_to_terms = 1 WHERE id = ?", (user_id,))
-        await db.commit()
 
-async def set_subscription(user_id, status=True, end_date=None, card_token=None, email=None):
-    async with aiosqlite.connect(DB_NAME) as db:
-        query = "UPDATE users SET subscription_active = ?"
-        params = [1 if status else 0]
-        
-        if end_date:
-            query += ", subscription_end_date = ?"
-            params.append(end_date)
-        
-        # Если передан card_token=None, не обновляем его (чтобы не затереть).
-        # Если передан "", значит хотим стереть (например, при отмене).
-        if card_token is not None:
-             query += ", card_token = ?"
-             params.append(card_token)
-
-        if email is not None:
-            query += ", email = ?"
-            params.append(email)
-            
-        query += " WHERE id = ?"
-        params.append(user_id)
+# Построители UPDATE для изменений состояния пользователя: (sql, params, новый дедлайн | None).
+# Ими пользуются и одиночные функции ниже, и пакетная запись WriteBatch.
+# Даты в users — целые секунды (миграция 12): вызывающий код передаёт time.time() как есть.
+
+def _epoch(ts):
+    return None if ts is None else int(ts)
+
+
+def _subscription_update(user_id, status=True, end_date=None, card_token=None, email=None):
+    query = "UPDATE users SET subscription_active = ?"
+    params = [1 if status else 0]
+    
+    end_date = _epoch(end_date)
+    if end_date:
+        query += ", subscription_end_date = ?"
+        params.append(end_date)
+    
+    # Если передан card_token=None, не обновляем его (чтобы не затереть).
+    # Если передан "", значит хотим стереть (например, при отмене).
+    if card_token is not None:
+         query += ", card_token = ?"
+         params.append(card_token)
+
+    if email is not None:
+        query += ", email = ?"
+        params.append(email)
         
-        await db.execute(query, tuple(params))
-        await db.commit()
+    query += " WHERE id = ?"
+    params.append(user_id)
+    return query, tuple(params), end_date if status and end_date else None
+
+
+def _grace_period_update(user_id, grace_until_ts, fail_ts, notice_ts):
+    grace_until_ts, fail_ts, notice_ts = _epoch(grace_until_ts), _epoch(fail_ts), _epoch(notice_ts)
+    next_notice = notice_ts + GRACE_NOTICE_INTERVAL if notice_ts is not None else grace_until_ts
+    return (
+        "UPDATE users "
+        "SET grace_until_ts = ?, last_payment_fail_ts = ?, last_payment_fail_notice_ts = ? "
+        "WHERE id = ?",
+        (grace_until_ts, fail_ts, notice_ts, user_id),
+        min(grace_until_ts, next_notice),
+    )
+
+
+def _clear_grace_update(user_id):
+    return (
+        "UPDATE users "
+        "SET grace_until_ts = NULL, last_payment_fail_ts = NULL, last_payment_fail_notice_ts = NULL "
+        "WHERE id = ?",
+        (user_id,),
+        None,
+    )
+
+
+def _grace_notice_update(user_id, notice_ts):
+    notice_ts = _epoch(notice_ts)
+    return (
+        "UPDATE users SET last_payment_fail_notice_ts = ? WHERE id = ?",
+        (notice_ts, user_id),
+        notice_ts + GRACE_NOTICE_INTERVAL,
+    )
+
+
+_OUTBOX_INSERT = (
+    "INSERT INTO outbox (chat_id, text, reply_markup, parse_mode, created_at) VALUES (?, ?, ?, ?, ?)"
+)
 
 
+def _notification_insert(chat_id, text, reply_markup=None, parse_mode=None):
+    return _OUTBOX_INSERT, (chat_id, text, reply_markup, parse_mode, time.time()), None
+
+
+_STATS_COLUMNS = ("new_subs", "renewals", "failed_charges", "kicked", "cancelled", "revenue_cents")
+# Один текст запроса на любые счётчики — в WriteBatch они уходят одним executemany
+_STATS_UPSERT = (
+    f"INSERT INTO daily_stats (day, {', '.join(_STATS_COLUMNS)}) VALUES (?{', ?' * len(_STATS_COLUMNS)}) "
+    "ON CONFLICT(day) DO UPDATE SET "
+    + ", ".join(f"{column} = {column} + excluded.{column}" for column in _STATS_COLUMNS)
+)
+
+
+def _stats_day(ts: Optional[float] = None) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def _stats_increment(**deltas):
+    unknown = set(deltas) - set(_STATS_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown daily_stats counters: {unknown}")
+    return _STATS_UPSERT, (_stats_day(), *(int(deltas.get(column, 0)) for column in _STATS_COLUMNS)), None
+
+
+def _after_commit(updates):
+    """Разбудить подписчиков: новые дедлайны пользователей и уведомления в outbox."""
+    queued = False
+    for query, params, deadline in updates:
+        if query is _OUTBOX_INSERT:
+            queued = True
+        elif deadline is not None:
+            _notify_deadline(params[-1], deadline)
+    if queued:
+        _notify_outbox()
+
+
+async def _apply_update(update):
+    query, params, deadline = update
+    async with _pool.write() as db:
+        await db.execute(query, params)
+    _after_commit((update,))
+
+
+@_timed
+async def set_subscription(user_id, status=True, end_date=None, card_token=None, email=None):
+    await _apply_update(_subscription_update(user_id, status, end_date, card_token, email))
+
+
+@_timed
 async def set_grace_period(
     user_id: int,
     grace_until_ts: float,
     fail_ts: float,
     notice_ts: Optional[float],
 ):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE users "
-            "SET grace_until_ts = ?, last_payment_fail_ts = ?, last_payment_fail_notice_ts = ? "
-            "WHERE id = ?",
-            (grace_until_ts, fail_ts, notice_ts, user_id),
-        )
-        await db.commit()
+    await _apply_update(_grace_period_update(user_id, grace_until_ts, fail_ts, notice_ts))
 
 
+@_timed
 async def clear_grace_period(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE users "
-            "SET grace_until_ts = NULL, last_payment_fail_ts = NULL, last_payment_fail_notice_ts = NULL "
-            "WHERE id = ?",
-            (user_id,),
-        )
-        await db.commit()
+    await _apply_update(_clear_grace_update(user_id))
 
 
+@_timed
 async def update_grace_notice_ts(user_id: int, notice_ts: float):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE users SET last_payment_fail_notice_ts = ? WHERE id = ?",
-            (notice_ts, user_id),
-        )
-        await db.commit()
+    await _apply_update(_grace_notice_update(user_id, notice_ts))
+
+
+class WriteBatch:
+    """
+    Пакетная запись изменений состояния пользователей (для прохода планировщика).
+
+    Те же операции, что set_subscription / set_grace_period / clear_grace_period /
+    update_grace_notice_ts, но накапливаются в памяти и пишутся flush():
+    одинаковые запросы — одним executemany, по одной транзакции (и одному fsync) на чанк.
+    Если чанк падает, он повторяется построчно — одна плохая строка не теряет остальные.
+    Операции одного пользователя в пакете должны касаться разных колонок
+    (порядок между разными запросами не сохраняется).
+    """
+
+    def __init__(self, chunk_size: int = 500):
+        self.chunk_size = chunk_size
+        self._pending = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set_subscription(self, user_id, status=True, end_date=None, card_token=None, email=None):
+        self._pending.append(_subscription_update(user_id, status, end_date, card_token, email))
+
+    def set_grace_period(self, user_id, grace_until_ts, fail_ts, notice_ts):
+        self._pending.append(_grace_period_update(user_id, grace_until_ts, fail_ts, notice_ts))
+
+    def clear_grace_period(self, user_id):
+        self._pending.append(_clear_grace_update(user_id))
+
+    def update_grace_notice_ts(self, user_id, notice_ts):
+        self._pending.append(_grace_notice_update(user_id, notice_ts))
+
+    def notify(self, chat_id, text, reply_markup=None, parse_mode=None):
+        """Уведомление в outbox — в той же транзакции, что и изменение состояния."""
+        self._pending.append(_notification_insert(chat_id, text, reply_markup, parse_mode))
+
+    def count_stats(self, **deltas):
+        """Счётчики daily_stats за сегодня (renewals=1, revenue_cents=3000, ...)."""
+        self._pending.append(_stats_increment(**deltas))
 
+    @_timed
+    async def flush(self) -> int:
+        """Записать накопленное; возвращает число строк, которые записать не удалось."""
+        pending, self._pending = self._pending, []
+        failed = 0
+        for start in range(0, len(pending), self.chunk_size):
+            chunk = pending[start:start + self.chunk_size]
+            grouped = {}
+            for query, params, _ in chunk:
+                grouped.setdefault(query, []).append(params)
+            try:
+                async with _pool.write() as db:
+                    for query, rows in grouped.items():
+                        await db.executemany(query, rows)
+            except Exception as e:
+                logger.error("Batch chunk of %s rows failed (%s), retrying row by row", len(chunk), e)
+                for update in chunk:
+                    try:
+                        await _apply_update(update)
+                    except Exception as row_err:
+                        failed += 1
+                        logger.error("Batch row failed: %s %s: %s", update[0], update[1], row_err)
+                continue
+            _after_commit(chunk)
+        return failed
+
+    @_timed
+    async def flush_for_transaction(self, uid, mark: str = "processed_at") -> bool:
+        """
+        Применить накопленное одной транзакцией вместе с отметкой mark (processed_at или
+        notified_at) у транзакции bePaid uid — и только если этой отметки ещё нет. False — шаг
+        уже выполнил другой воркер (изменения отброшены). Падение до commit оставляет отметку
+        пустой: повторная доставка выполнит шаг заново. uid=None — без проверки журнала.
+        """
+        if mark not in ("processed_at", "notified_at"):
+            raise ValueError(f"Unknown transaction mark: {mark}")
+        pending, self._pending = self._pending, []
+        async with _pool.write() as db:
+            if uid is not None:
+                async with db.execute(
+                    f"UPDATE transactions SET {mark} = ? WHERE uid = ? AND {mark} IS NULL RETURNING uid",
+                    (time.time(), uid),
+                ) as cursor:
+                    if await cursor.fetchone() is None:
+                        return False
+            for query, params, _ in pending:
+                await db.execute(query, params)
+        _after_commit(pending)
+        return True
+
+@_timed
 async def get_all_active_users():
     """Получить всех пользователей с активной подпиской"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _pool.read() as db:
         async with db.execute("SELECT id FROM users WHERE subscription_active = 1") as cursor:
             return [row[0] for row in await cursor.fetchall()]
 
+@_timed
 async def get_user_subscription(user_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _pool.read() as db:
         async with db.execute("SELECT subscription_active, subscription_end_date, card_token FROM users WHERE id = ?", (user_id,)) as cursor:
             return await cursor.fetchone()
 
+@_timed
 async def get_users_due_payment():
     """Пользователи с истёкшей подпиской и привязанной картой (пробуем автосписание)."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        now = time.time()
+    async with _pool.read() as db:
+        now = int(time.time())
         async with db.execute("""
-            SELECT id, card_token, email, grace_until_ts, last_payment_fail_notice_ts
+            SELECT id, card_token, email, grace_until_ts, last_payment_fail_notice_ts, subscription_end_date
             FROM users 
             WHERE subscription_active = 1 
               AND card_token IS NOT NULL 
               AND card_token != ''
               AND subscription_end_date <= ?
               AND (grace_until_ts IS NULL OR grace_until_ts <= ?)
+            ORDER BY subscription_end_date
         """, (now, now)) as cursor:
             return await cursor.fetchall()
 
 
+@_timed
 async def get_users_expired_no_card_start_grace():
     """Истёкшая подписка без карты, грейс ещё не запускали — надо запустить грейс и уведомить."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        now = time.time()
+    async with _pool.read() as db:
+        now = int(time.time())
         async with db.execute(
             """
             SELECT id, email
@@ -209,10 +805,11 @@ async def get_users_expired_no_card_start_grace():
             return await cursor.fetchall()
 
 
+@_timed
 async def get_users_expired_no_card_to_kick():
     """Истёкшая подписка без карты, грейс закончился — пора отключать доступ (кик)."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        now = time.time()
+    async with _pool.read() as db:
+        now = int(time.time())
         async with db.execute(
             """
             SELECT id
@@ -228,14 +825,15 @@ async def get_users_expired_no_card_to_kick():
             return [row[0] for row in await cursor.fetchall()]
 
 
+@_timed
 async def get_users_in_grace_to_notify():
     """
     Пользователи, у которых подписка истекла, но действует грейс-период.
     Уведомляем максимум раз в 24 часа.
     """
-    async with aiosqlite.connect(DB_NAME) as db:
-        now = time.time()
-        day_ago = now - 86400
+    async with _pool.read() as db:
+        now = int(time.time())
+        day_ago = now - GRACE_NOTICE_INTERVAL
         async with db.execute(
             """
             SELECT id, email, grace_until_ts, last_payment_fail_notice_ts
@@ -250,28 +848,638 @@ async def get_users_in_grace_to_notify():
         ) as cursor:
             return await cursor.fetchall()
 
+@_timed
+async def get_upcoming_deadlines(until_ts: float):
+    """
+    Ближайшие дедлайны активных подписок в окне (сейчас, until_ts]: (user_id, ts).
+    Конец периода, конец грейса и время следующего напоминания в грейсе —
+    каждая ветка идёт по своему частичному индексу.
+    """
+    async with _pool.read() as db:
+        now, until_ts = int(time.time()), int(until_ts)
+        async with db.execute(
+            """
+            SELECT id, subscription_end_date FROM users
+            WHERE subscription_active = 1 AND grace_until_ts IS NULL
+              AND subscription_end_date > ? AND subscription_end_date <= ?
+            UNION ALL
+            SELECT id, grace_until_ts FROM users
+            WHERE subscription_active = 1 AND grace_until_ts IS NOT NULL
+              AND grace_until_ts > ? AND grace_until_ts <= ?
+            UNION ALL
+            SELECT id, last_payment_fail_notice_ts + ? FROM users
+            WHERE subscription_active = 1 AND grace_until_ts IS NOT NULL
+              AND grace_until_ts > ?
+              AND last_payment_fail_notice_ts + ? > ?
+              AND last_payment_fail_notice_ts + ? <= ?
+            """,
+            (
+                now, until_ts,
+                now, until_ts,
+                GRACE_NOTICE_INTERVAL, now, GRACE_NOTICE_INTERVAL, now, GRACE_NOTICE_INTERVAL, until_ts,
+            ),
+        ) as cursor:
+            return await cursor.fetchall()
+
+@_timed
 async def get_users():
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _pool.read() as db:
         async with db.execute("SELECT id FROM users") as cursor:
             return [row[0] for row in await cursor.fetchall()]
 
+@_timed
 async def add_admin(user_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    global _admin_ids
+    async with _pool.write() as db:
         await db.execute("INSERT OR IGNORE INTO admins (id) VALUES (?)", (user_id,))
-        await db.commit()
+    _admin_ids = _admin_ids | {user_id}
 
+@_timed
 async def get_admins():
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _pool.read() as db:
         async with db.execute("SELECT id FROM admins") as cursor:
             return [row[0] for row in await cursor.fetchall()]
 
+def set_static_admins(user_ids):
+    """Админы, которые не хранятся в БД (ADMIN_IDS из .env)."""
+    global _static_admin_ids, _admin_ids, _admin_ids_expire_at
+    _static_admin_ids = frozenset(user_ids)
+    _admin_ids = _admin_ids | _static_admin_ids
+    _admin_ids_expire_at = 0.0
+
+@_timed
+async def refresh_admin_ids() -> frozenset:
+    global _admin_ids, _admin_ids_expire_at
+    _admin_ids = _static_admin_ids | frozenset(await get_admins())
+    _admin_ids_expire_at = time.monotonic() + ADMIN_CACHE_TTL
+    return _admin_ids
+
+@_timed
+async def get_admin_ids() -> frozenset:
+    """Все ID админов (из .env и из таблицы admins); обращается к БД только по истечении TTL."""
+    if time.monotonic() >= _admin_ids_expire_at:
+        return await refresh_admin_ids()
+    return _admin_ids
+
+async def _load_settings(db):
+    global _settings_version
+    async with db.execute("SELECT key, value FROM settings") as cursor:
+        rows = await cursor.fetchall()
+    rows = dict(rows)
+    if rows != _settings:
+        _settings.clear()
+        _settings.update(rows)
+        _settings_version += 1
+
+@_timed
+async def refresh_settings():
+    """Перечитать settings (несколько процессов: изменения из другого процесса)."""
+    async with _pool.read() as db:
+        await _load_settings(db)
+
+@_timed
 async def get_setting(key):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else None
+    # Значение из кэша: после init_db таблица settings целиком в памяти
+    return _settings.get(key)
 
+@_timed
 async def set_setting(key, value):
-    async with aiosqlite.connect(DB_NAME) as db:
+    global _settings_version
+    async with _pool.write() as db:
         await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-        await db.commit()
+    _settings[key] = value
+    _settings_version += 1
+
+def get_settings_version() -> int:
+    return _settings_version
+
+def get_subscription_price() -> Decimal:
+    """Цена подписки в BYN из кэша настроек."""
+    try:
+        price = Decimal(_settings.get("subscription_price") or DEFAULT_SUBSCRIPTION_PRICE)
+    except InvalidOperation:
+        return DEFAULT_SUBSCRIPTION_PRICE
+    return price if price.is_finite() and price > 0 else DEFAULT_SUBSCRIPTION_PRICE
+
+def get_subscription_days() -> int:
+    """Длительность периода подписки в днях из кэша настроек."""
+    try:
+        days = int(_settings.get("subscription_days") or DEFAULT_SUBSCRIPTION_DAYS)
+    except ValueError:
+        return DEFAULT_SUBSCRIPTION_DAYS
+    return days if days > 0 else DEFAULT_SUBSCRIPTION_DAYS
+
+
+# --- Рассылки ---
+
+@_timed
+async def create_broadcast(from_chat_id, message_id, status_chat_id, status_message_id, total):
+    async with _pool.write() as db:
+        cursor = await db.execute(
+            "INSERT INTO broadcasts (from_chat_id, message_id, status_chat_id, status_message_id, total, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (from_chat_id, message_id, status_chat_id, status_message_id, total, time.time()),
+        )
+        return cursor.lastrowid
+
+@_timed
+async def get_running_broadcasts():
+    """Незавершённые рассылки, которые пора (про)должать — без ждущих повтора после ошибки."""
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT id, from_chat_id, message_id, status_chat_id, status_message_id, "
+            "cursor_user_id, total, sent, failed, blocked "
+            "FROM broadcasts WHERE state = 'running' AND next_attempt_at <= ? ORDER BY id",
+            (time.time(),),
+        ) as cursor:
+            return await cursor.fetchall()
+
+@_timed
+async def save_broadcast_progress(broadcast_id, cursor_user_id, sent, failed, blocked, done=False):
+    # Страница разослана — счётчик неудачных попыток подряд сбрасывается
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE broadcasts SET cursor_user_id = ?, sent = ?, failed = ?, blocked = ?, attempts = 0, "
+            "state = ?, finished_at = ? WHERE id = ?",
+            (
+                cursor_user_id, sent, failed, blocked,
+                "done" if done else "running", time.time() if done else None,
+                broadcast_id,
+            ),
+        )
+
+@_timed
+async def fail_broadcast(broadcast_id, error: str, max_attempts: int, retry_base_delay: float):
+    """
+    Рассылка прервалась ошибкой. Повтор — через retry_base_delay * 2^(n-1) сек (не больше часа),
+    после max_attempts неудач подряд — state = 'failed'. Возвращает (attempts, retry_at | None).
+    """
+    now = time.time()
+    async with _pool.write() as db:
+        async with db.execute(
+            "UPDATE broadcasts SET attempts = attempts + 1, last_error = ? WHERE id = ? RETURNING attempts",
+            (error, broadcast_id),
+        ) as cursor:
+            (attempts,) = await cursor.fetchone()
+        if attempts >= max_attempts:
+            retry_at = None
+            await db.execute(
+                "UPDATE broadcasts SET state = 'failed', finished_at = ? WHERE id = ?", (now, broadcast_id)
+            )
+        else:
+            retry_at = now + min(retry_base_delay * 2 ** (attempts - 1), 3600)
+            await db.execute("UPDATE broadcasts SET next_attempt_at = ? WHERE id = ?", (retry_at, broadcast_id))
+    return attempts, retry_at
+
+@_timed
+async def count_broadcast_recipients():
+    async with _pool.read() as db:
+        async with db.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL") as cursor:
+            return (await cursor.fetchone())[0]
+
+@_timed
+async def get_broadcast_recipients(after_user_id, limit):
+    """Страница получателей по возрастанию id (keyset-пагинация — курсор переживает рестарт)."""
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT id FROM users WHERE id > ? AND blocked_at IS NULL ORDER BY id LIMIT ?",
+            (after_user_id, limit),
+        ) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+@_timed
+async def mark_users_blocked(user_ids):
+    if not user_ids:
+        return
+    now = int(time.time())
+    async with _pool.write() as db:
+        await db.executemany(
+            "UPDATE users SET blocked_at = ? WHERE id = ?",
+            [(now, user_id) for user_id in user_ids],
+        )
+
+
+# --- Журнал транзакций ---
+
+@_timed
+async def claim_transaction(uid, tracking_id, user_id, status, amount, currency, kind="checkout",
+                            processed: bool = False):
+    """
+    Записать транзакцию в журнал. True — её ещё надо применить (новая, статус изменился или
+    прошлая обработка не дошла до commit); False — повторная доставка уже применённой.
+    Отметку processed_at ставит WriteBatch.flush_for_transaction в одной записи с изменением
+    подписки; processed=True — транзакция применяется в другом месте (автосписание),
+    сразу записываем её обработанной. Один запрос по PRIMARY KEY.
+    """
+    now = time.time()
+    async with _pool.write() as db:
+        async with db.execute(
+            """
+            INSERT INTO transactions
+                (uid, tracking_id, user_id, kind, status, amount, currency, created_at, updated_at, processed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(uid) DO UPDATE SET
+                status = excluded.status,
+                updated_at = excluded.updated_at,
+                processed_at = CASE WHEN transactions.status IS excluded.status
+                                    THEN transactions.processed_at ELSE excluded.processed_at END
+            RETURNING processed_at IS NULL
+            """,
+            (uid, tracking_id, user_id, kind, status, amount, currency, now, now, now if processed else None),
+        ) as cursor:
+            return bool((await cursor.fetchone())[0])
+
+@_timed
+async def needs_notification(uid) -> bool:
+    """Оплата по uid применена, а сообщение с инвайтом ещё не поставлено в outbox."""
+    async with _pool.read() as db:
+        async with db.execute(
+            """
+            SELECT 1 FROM transactions
+            WHERE uid = ? AND kind = 'checkout' AND status = 'successful'
+              AND processed_at IS NOT NULL AND notified_at IS NULL
+            """,
+            (uid,),
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+@_timed
+async def is_charge_successful(tracking_id) -> bool:
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT 1 FROM transactions WHERE tracking_id = ? AND status = 'successful' LIMIT 1",
+            (tracking_id,),
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+
+# --- Очередь входящих вебхуков ---
+
+# Задача, взятая воркером и не завершённая за это время (процесс упал), снова становится доступной
+WEBHOOK_CLAIM_TIMEOUT = 300
+
+@_timed
+async def enqueue_webhook(payload: str):
+    async with _pool.write() as db:
+        await db.execute(
+            "INSERT INTO webhook_inbox (payload, received_at) VALUES (?, ?)",
+            (payload, time.time()),
+        )
+
+@_timed
+async def claim_webhook_job():
+    """Атомарно взять следующую готовую задачу: (id, payload, attempts) или None."""
+    now = time.time()
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE webhook_inbox SET state = 'pending' WHERE state = 'processing' AND claimed_at < ?",
+            (now - WEBHOOK_CLAIM_TIMEOUT,),
+        )
+        async with db.execute(
+            """
+            UPDATE webhook_inbox
+            SET state = 'processing', attempts = attempts + 1, claimed_at = ?
+            WHERE id = (
+                SELECT id FROM webhook_inbox
+                WHERE state = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT 1
+            )
+            RETURNING id, payload, attempts
+            """,
+            (now, now),
+        ) as cursor:
+            return await cursor.fetchone()
+
+@_timed
+async def complete_webhook_job(job_id):
+    # История остаётся в журнале transactions, саму задачу удаляем
+    async with _pool.write() as db:
+        await db.execute("DELETE FROM webhook_inbox WHERE id = ?", (job_id,))
+
+@_timed
+async def release_webhook_job(job_id):
+    """Вернуть взятую задачу в очередь без траты попытки (обработку прервала остановка процесса)."""
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE webhook_inbox SET state = 'pending', attempts = attempts - 1, claimed_at = NULL "
+            "WHERE id = ? AND state = 'processing'",
+            (job_id,),
+        )
+
+@_timed
+async def fail_webhook_job(job_id, error: str, retry_at: Optional[float]):
+    """retry_at=None — попытки исчерпаны, задача остаётся в состоянии failed для разбора."""
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE webhook_inbox SET state = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            ("failed" if retry_at is None else "pending", retry_at or 0, error, job_id),
+        )
+
+
+# --- Исходящие уведомления (outbox) ---
+
+OUTBOX_CLAIM_TIMEOUT = 300
+
+# Первое неотправленное сообщение каждого чата: следующие ждут, пока оно не уйдёт (или не
+# станет failed), даже если оно отложено повтором или отправляется другим процессом
+_OUTBOX_HEADS = """
+    SELECT id, next_attempt_at FROM outbox
+    WHERE state = 'pending' AND id IN (
+        SELECT MIN(id) FROM outbox WHERE state IN ('pending', 'sending') GROUP BY chat_id
+    )
+"""
+
+@_timed
+async def enqueue_notification(chat_id, text, reply_markup=None, parse_mode=None):
+    """reply_markup — JSON клавиатуры (см. outbox.dump_markup)."""
+    await _apply_update(_notification_insert(chat_id, text, reply_markup, parse_mode))
+
+@_timed
+async def claim_notifications(limit):
+    """Атомарно взять до limit готовых к отправке уведомлений — не больше одного на чат."""
+    now = time.time()
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE outbox SET state = 'pending' WHERE state = 'sending' AND claimed_at < ?",
+            (now - OUTBOX_CLAIM_TIMEOUT,),
+        )
+        async with db.execute(
+            f"""
+            UPDATE outbox
+            SET state = 'sending', attempts = attempts + 1, claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM ({_OUTBOX_HEADS})
+                WHERE next_attempt_at <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+            )
+            RETURNING id, chat_id, text, reply_markup, parse_mode, attempts
+            """,
+            (now, now, limit),
+        ) as cursor:
+            rows = await cursor.fetchall()
+    return sorted(rows, key=lambda row: row[0])
+
+@_timed
+async def get_next_notification_at() -> Optional[float]:
+    async with _pool.read() as db:
+        async with db.execute(f"SELECT MIN(next_attempt_at) FROM ({_OUTBOX_HEADS})") as cursor:
+            return (await cursor.fetchone())[0]
+
+@_timed
+async def complete_notifications(notification_ids):
+    if not notification_ids:
+        return
+    async with _pool.write() as db:
+        await db.executemany("DELETE FROM outbox WHERE id = ?", [(n,) for n in notification_ids])
+
+@_timed
+async def retry_notification(notification_id, error: str, retry_at: Optional[float], count_attempt: bool = True):
+    """retry_at=None — отправка невозможна (попытки исчерпаны / бот заблокирован), оставляем failed."""
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE outbox SET state = ?, next_attempt_at = ?, last_error = ?, "
+            "attempts = attempts - ? WHERE id = ?",
+            (
+                "failed" if retry_at is None else "pending", retry_at or 0, error,
+                0 if count_attempt else 1, notification_id,
+            ),
+        )
+
+
+# --- Состояния FSM (см. fsm_storage.SQLiteStorage) ---
+
+@_timed
+async def get_fsm_record(key: str):
+    """(state, data_json) или None."""
+    async with _pool.read() as db:
+        async with db.execute("SELECT state, data FROM fsm_state WHERE key = ?", (key,)) as cursor:
+            return await cursor.fetchone()
+
+@_timed
+async def save_fsm_records(records):
+    """records: [(key, state, data_json)]; пустые (без состояния и данных) удаляются."""
+    now = time.time()
+    upserts = [(key, state, data, now) for key, state, data in records if state is not None or data is not None]
+    deletes = [(key,) for key, state, data in records if state is None and data is None]
+    async with _pool.write() as db:
+        if upserts:
+            await db.executemany(
+                """
+                INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                    updated_at = excluded.updated_at
+                """,
+                upserts,
+            )
+        if deletes:
+            await db.executemany("DELETE FROM fsm_state WHERE key = ?", deletes)
+
+
+# --- Пул инвайт-ссылок (см. invite_pool.InvitePool) ---
+
+@_timed
+async def add_invite_links(chat_id, links):
+    """links: [(link, expires_at)] — только что созданные свободные ссылки."""
+    now = time.time()
+    async with _pool.write() as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO invite_links (link, chat_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            [(link, chat_id, now, expires_at) for link, expires_at in links],
+        )
+
+@_timed
+async def add_claimed_invite_link(chat_id, link, user_id):
+    """Ссылка, созданная напрямую для user_id (пул был пуст), — чтобы её тоже отозвали со временем."""
+    now = time.time()
+    async with _pool.write() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO invite_links (link, chat_id, created_at, expires_at, user_id, claimed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (link, chat_id, now, now, user_id, now),
+        )
+
+@_timed
+async def claim_invite_link(chat_id, user_id) -> Optional[str]:
+    """Атомарно закрепить за user_id свободную ссылку пула (None — пул пуст)."""
+    now = time.time()
+    async with _pool.write() as db:
+        async with db.execute(
+            """
+            UPDATE invite_links SET user_id = ?, claimed_at = ?
+            WHERE link = (
+                SELECT link FROM invite_links
+                WHERE user_id IS NULL AND chat_id = ? AND expires_at > ?
+                ORDER BY expires_at LIMIT 1
+            )
+            RETURNING link
+            """,
+            (user_id, now, chat_id, now),
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+@_timed
+async def count_free_invite_links(chat_id) -> int:
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM invite_links WHERE user_id IS NULL AND chat_id = ? AND expires_at > ?",
+            (chat_id, time.time()),
+        ) as cursor:
+            (count,) = await cursor.fetchone()
+    return count
+
+@_timed
+async def get_stale_invite_links(chat_id, limit: int = 100):
+    """
+    Свободные ссылки, которые уже не выдадим: пролежали в пуле дольше срока или созданы
+    для другого канала (CHANNEL_ID сменили). [(link, chat_id)] — их отзывают и удаляют.
+    """
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT link, chat_id FROM invite_links WHERE user_id IS NULL AND (chat_id != ? OR expires_at <= ?) "
+            "LIMIT ?",
+            (chat_id, time.time(), limit),
+        ) as cursor:
+            return await cursor.fetchall()
+
+@_timed
+async def delete_invite_links(links):
+    if not links:
+        return
+    async with _pool.write() as db:
+        await db.executemany("DELETE FROM invite_links WHERE link = ?", [(link,) for link in links])
+
+@_timed
+async def get_expired_claimed_invite_links(before: float, limit: int = 100):
+    """
+    Выданные до before ссылки: [(link, chat_id)]. Неиспользованная ссылка в Telegram действует
+    бессрочно — их отзывают и удаляют, и история выдачи тоже не копится вечно.
+    """
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT link, chat_id FROM invite_links WHERE user_id IS NOT NULL AND claimed_at < ? LIMIT ?",
+            (before, limit),
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+# --- Сводка по дням (daily_stats) ---
+
+@_timed
+async def count_stats(**deltas):
+    """Увеличить счётчики daily_stats за сегодня (UTC)."""
+    await _apply_update(_stats_increment(**deltas))
+
+@_timed
+async def snapshot_active_subscriptions():
+    """Записать в строку сегодняшнего дня текущее число активных подписок."""
+    async with _pool.write() as db:
+        await db.execute(
+            """
+            INSERT INTO daily_stats (day, active_subs)
+            VALUES (?, (SELECT COUNT(*) FROM users WHERE subscription_active = 1))
+            ON CONFLICT(day) DO UPDATE SET active_subs = excluded.active_subs
+            """,
+            (_stats_day(),),
+        )
+
+@_timed
+async def get_daily_stats(days: int):
+    """Последние days дней, новые сверху: [(day, new_subs, renewals, failed_charges, kicked,
+    cancelled, revenue_cents, active_subs)]."""
+    async with _pool.read() as db:
+        async with db.execute(
+            f"SELECT day, {', '.join(_STATS_COLUMNS)}, active_subs FROM daily_stats WHERE day >= ? ORDER BY day DESC",
+            (_stats_day(time.time() - (days - 1) * 24 * 60 * 60),),
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+# --- Состояние фоновых задач (см. reconcile.MembershipReconciler) ---
+
+@_timed
+async def get_job_state(name: str):
+    """(cursor, started_at, finished_at) или None, если задача ещё не запускалась."""
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT cursor, started_at, finished_at FROM job_state WHERE name = ?", (name,)
+        ) as cursor:
+            return await cursor.fetchone()
+
+@_timed
+async def save_job_state(name: str, cursor, started_at, finished_at):
+    async with _pool.write() as db:
+        await db.execute(
+            """
+            INSERT INTO job_state (name, cursor, started_at, finished_at, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET cursor = excluded.cursor, started_at = excluded.started_at,
+                finished_at = excluded.finished_at, updated_at = excluded.updated_at
+            """,
+            (name, cursor, started_at, finished_at, time.time()),
+        )
+
+@_timed
+async def request_job_run(name: str):
+    """Запустить задачу при ближайшей проверке (из любого процесса); идущий проход не сбрасывается."""
+    async with _pool.write() as db:
+        await db.execute(
+            """
+            INSERT INTO job_state (name, finished_at, updated_at) VALUES (?, 0, ?)
+            ON CONFLICT(name) DO UPDATE SET finished_at = 0, updated_at = excluded.updated_at
+            """,
+            (name, time.time()),
+        )
+
+@_timed
+async def get_users_page(after_id: int, limit: int):
+    """Страница пользователей по возрастанию id: [(id, subscription_active)]."""
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT id, subscription_active FROM users WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        ) as cursor:
+            return await cursor.fetchall()
+
+@_timed
+async def get_active_subscriber_ids(user_ids) -> set:
+    """Кто из user_ids сейчас с активной подпиской (перепроверка перед киком)."""
+    if not user_ids:
+        return set()
+    placeholders = ",".join("?" * len(user_ids))
+    async with _pool.read() as db:
+        async with db.execute(
+            f"SELECT id FROM users WHERE subscription_active = 1 AND id IN ({placeholders})",
+            tuple(user_ids),
+        ) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+
+# --- Аренды (см. leader.LeaderLease) ---
+
+@_timed
+async def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """Взять или продлить аренду; True — она у holder до now + ttl."""
+    now = time.time()
+    async with _pool.write() as db:
+        async with db.execute(
+            """
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            RETURNING holder
+            """,
+            (name, holder, now + ttl, now),
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+@_timed
+async def release_lease(name: str, holder: str):
+    async with _pool.write() as db:
+        await db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+async def close_db():
+    await _pool.close()
+
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в той же SQLite-базе (таблица fsm_state).
+
+    Чтение идёт из кэша в памяти процесса (в БД — только при первом обращении к ключу),
+    запись — write-back: ключ помечается изменённым, а фоновая задача раз в flush_interval
+    сбрасывает все изменения одной транзакцией; close() дописывает остаток при остановке.
+    Кэш рассчитан на один процесс бота; при нескольких процессах (cached=False) каждое
+    чтение и запись идут прямо в БД — или используйте Redis.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, max_cached: int = 10000, cached: bool = True):
+        self.cached = cached
+        self.flush_interval = flush_interval
+        self.max_cached = max_cached
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> [state, data]; порядок — для вытеснения давно не использованных
+        self._cache: "OrderedDict[str, list]" = OrderedDict()
+        self._dirty = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _entry(self, key: StorageKey) -> Tuple[str, list]:
+        k = self.key_builder.build(key)
+        entry = self._cache.get(k)
+        if entry is None:
+            row = await db.get_fsm_record(k)
+            loaded = [row[0], json.loads(row[1]) if row[1] else {}] if row else [None, {}]
+            if not self.cached:
+                return k, loaded
+            # Пока ждали БД, ключ мог записать другой обработчик — его значение новее
+            entry = self._cache.setdefault(k, loaded)
+            self._evict(keep=k)
+        self._cache.move_to_end(k)
+        return k, entry
+
+    def _evict(self, keep: str):
+        # Вытесняем только уже сохранённые записи и не ту, к которой сейчас обращаются
+        while len(self._cache) > self.max_cached:
+            victim = next((k for k in self._cache if k not in self._dirty and k != keep), None)
+            if victim is None:
+                return
+            del self._cache[victim]
+
+    @staticmethod
+    def _record(k: str, entry: list):
+        state, data = entry
+        return k, state, json.dumps(data, ensure_ascii=False) if data else None
+
+    async def _store(self, k: str, entry: list):
+        if not self.cached:
+            await db.save_fsm_records([self._record(k, entry)])
+            return
+        self._dirty.add(k)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        dirty, self._dirty = self._dirty, set()
+        records = [self._record(k, self._cache[k]) for k in dirty]
+        if not records:
+            return
+        try:
+            await db.save_fsm_records(records)
+        except asyncio.CancelledError:
+            self._dirty |= dirty
+            raise
+        except Exception as e:
+            logger.error("FSM storage flush failed (%s keys): %s", len(records), e)
+            self._dirty |= dirty
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        await self._store(k, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise TypeError(f"Data must be a dict, got {type(data).__name__}")
+        k, entry = await self._entry(key)
+        entry[1] = data.copy()
+        await self._store(k, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+
+def create_storage(
+    kind: str, redis_url: Optional[str] = None, shared: bool = False,
+) -> Tuple[BaseStorage, Optional[BaseEventIsolation]]:
+    """
+    Хранилище FSM по имени из .env (FSM_STORAGE):
+    - memory — в памяти (состояния теряются при рестарте);
+    - sqlite — в базе бота, см. SQLiteStorage (по умолчанию); shared — база общая для
+      нескольких процессов, кэш отключается;
+    - redis  — Redis или совместимый сервер (Valkey, KeyDB) по REDIS_URL, для нескольких процессов;
+      нужен пакет redis.
+    Возвращает (storage, events_isolation); None — изоляция по умолчанию.
+    """
+    kind = (kind or "sqlite").strip().lower()
+    if kind == "memory":
+        return MemoryStorage(), None
+    if kind == "sqlite":
+        return SQLiteStorage(cached=not shared), None
+    if kind == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE=redis требует пакет redis: pip install redis") from e
+        storage = RedisStorage.from_url(
+            redis_url or "redis://localhost:6379/0",
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+        )
+        # Несколько процессов: апдейты одного пользователя обрабатываются по очереди
+        return storage, storage.create_isolation()
+    raise ValueError(f"Неизвестный FSM_STORAGE={kind!r}: ожидается memory, sqlite или redis")
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+
+class InvitePool:
+    """
+    Пул заранее созданных одноразовых инвайт-ссылок в канал (таблица invite_links).
+
+    После оплаты ссылку не создают запросом к Telegram, а забирают из пула одним UPDATE
+    (take) — это работает в любом процессе. Пополняет пул только лидер (run): держит
+    size свободных ссылок, доливает, когда их меньше low_watermark, а свободные ссылки
+    старше max_age (или созданные для прежнего CHANNEL_ID) отзывает и заменяет.
+    Если пул пуст, take создаёт ссылку напрямую, как раньше, и тоже записывает её в таблицу.
+    Выданные ссылки старше claimed_retention отзываются: неоткрытая ссылка иначе осталась бы
+    действующей в Telegram навсегда (вступившего участника отзыв не затрагивает).
+    """
+
+    def __init__(self, bot: Bot, chat_id, size: int = 20, low_watermark: Optional[int] = None,
+                 max_age: float = 7 * 24 * 3600, poll_interval: float = 60.0,
+                 claimed_retention: float = 30 * 24 * 3600):
+        self.bot = bot
+        self.chat_id = str(chat_id)
+        self.size = size
+        self.low_watermark = size // 2 if low_watermark is None else low_watermark
+        self.max_age = max_age
+        self.poll_interval = poll_interval
+        self.claimed_retention = claimed_retention
+        self._wakeup = asyncio.Event()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    async def _create(self, name: str) -> str:
+        link = await self.bot.create_chat_invite_link(chat_id=self.chat_id, member_limit=1, name=name)
+        return link.invite_link
+
+    async def take(self, user_id: int, name: str) -> str:
+        """Ссылка для user_id: из пула, а если он пуст — новая (name — подпись такой ссылки)."""
+        link = await db.claim_invite_link(self.chat_id, user_id)
+        # Пул проседает — будим пополнение (в этом процессе; лидер в другом заметит по опросу)
+        self._wakeup.set()
+        if link is not None:
+            return link
+        logger.warning("Invite pool is empty, creating link for user %s directly", user_id)
+        link = await self._create(name)
+        try:
+            await db.add_claimed_invite_link(self.chat_id, link, user_id)
+        except Exception as e:
+            # Ссылку пользователь всё равно получит; не отозванной останется только она
+            logger.warning("Could not record invite link for user %s: %s", user_id, e)
+        return link
+
+    async def _revoke(self, links, kind: str):
+        """links: [(link, chat_id)] — отозвать в Telegram и удалить из таблицы."""
+        if not links:
+            return
+        revoked = []
+        try:
+            for link, chat_id in links:
+                try:
+                    await self.bot.revoke_chat_invite_link(chat_id=chat_id, invite_link=link)
+                except TelegramBadRequest as e:
+                    # Ссылки/канала уже нет или нет прав — запись всё равно не нужна
+                    logger.warning("Invite link revoke failed, dropping it: %s", e)
+                revoked.append(link)
+        finally:
+            # Отозванные до ошибки (например, RetryAfter) больше не трогаем
+            await db.delete_invite_links(revoked)
+        logger.info("Invite pool: revoked %s %s links", len(revoked), kind)
+
+    async def _revoke_stale(self):
+        await self._revoke(await db.get_stale_invite_links(self.chat_id), "stale")
+
+    async def _revoke_claimed(self):
+        before = time.time() - self.claimed_retention
+        await self._revoke(await db.get_expired_claimed_invite_links(before), "expired claimed")
+
+    async def _refill(self):
+        free = await db.count_free_invite_links(self.chat_id)
+        if free >= self.low_watermark and free > 0:
+            return
+        expires_at = time.time() + self.max_age
+        created = []
+        try:
+            for _ in range(self.size - free):
+                created.append((await self._create(f"Pool_{int(time.time())}"), expires_at))
+        finally:
+            # Созданные до ошибки ссылки не теряем
+            await db.add_invite_links(self.chat_id, created)
+        if created:
+            logger.info("Invite pool: added %s links (%s free)", len(created), free + len(created))
+
+    async def run(self):
+        while True:
+            try:
+                await self._revoke_stale()
+                await self._refill()
+                await self._revoke_claimed()
+            except TelegramRetryAfter as e:
+                logger.warning("Invite pool flood wait %ss", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Invite pool error: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
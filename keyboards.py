@@ -1,14 +1,21 @@
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from functools import lru_cache
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup
+
+# Статичные клавиатуры собираются один раз при импорте: get_*() отдают готовые объекты,
+# а не строят pydantic-модели заново на каждом апдейте. Объекты общие — не изменять.
 
 # --- Block 1: Welcome & Consent ---
+# Links are in text, here only "Agreed"
+WELCOME_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Ознакомился", callback_data="agreed_to_terms")]
+])
+
 def get_welcome_keyboard():
-    # Links are in text, here only "Agreed"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Ознакомился", callback_data="agreed_to_terms")]
-    ])
-    return keyboard
+    return WELCOME_KEYBOARD
 
 # --- Block 2: Subscription & Manager ---
+@lru_cache(maxsize=None)
 def get_subscription_keyboard(manager_link: str):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         # Placeholder for payment
@@ -32,27 +39,40 @@ def get_member_keyboard(manager_link: str, invite_link: str = None):
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     return keyboard
 
+# Автосписание не прошло / подписка истекла: оплатить заново с актуальной суммой
+PAY_AGAIN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💳 Оплатить заново", callback_data="pay_again")]
+])
+
+CANCEL_SUBSCRIPTION_CONFIRM_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="Да", callback_data="cancel_subscription_confirm"),
+        InlineKeyboardButton(text="Нет", callback_data="cancel_subscription_abort"),
+    ]
+])
 
 def get_cancel_subscription_confirm_keyboard():
     """Инлайн-кнопки Да/Нет для подтверждения отмены подписки."""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="Да", callback_data="cancel_subscription_confirm"),
-            InlineKeyboardButton(text="Нет", callback_data="cancel_subscription_abort"),
-        ]
-    ])
+    return CANCEL_SUBSCRIPTION_CONFIRM_KEYBOARD
 
 
 # --- Admin Keyboards ---
+ADMIN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+    [InlineKeyboardButton(text="📝 Изм. приветствие (Текст)", callback_data="admin_edit_welcome_text")],
+    [InlineKeyboardButton(text="🖼 Изм. приветствие (Фото)", callback_data="admin_edit_welcome_photo")],
+    [InlineKeyboardButton(text="📝 Изм. текст после оплаты", callback_data="admin_edit_payment_text")],
+    [InlineKeyboardButton(text="💰 Изм. цену подписки", callback_data="admin_edit_price")],
+    [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")]
+])
+
+# Кнопка «Админ-панель» под полем ввода
+ADMIN_REPLY_KEYBOARD = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Админ-панель")]], resize_keyboard=True)
+
+CANCEL_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="cancel_action")]])
+
 def get_admin_keyboard():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
-        [InlineKeyboardButton(text="📝 Изм. приветствие (Текст)", callback_data="admin_edit_welcome_text")],
-        [InlineKeyboardButton(text="🖼 Изм. приветствие (Фото)", callback_data="admin_edit_welcome_photo")],
-        [InlineKeyboardButton(text="📝 Изм. текст после оплаты", callback_data="admin_edit_payment_text")],
-        [InlineKeyboardButton(text="💰 Изм. цену подписки", callback_data="admin_edit_price")]
-    ])
-    return keyboard
+    return ADMIN_KEYBOARD
 
 def get_cancel_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="cancel_action")]])
+    return CANCEL_KEYBOARD
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Dict
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease:
+    """
+    Выбор лидера между процессами бота через аренду в таблице leases.
+
+    Каждый процесс раз в renew_interval пытается взять/продлить аренду на ttl секунд;
+    у кого получилось — лидер и держит запущенными задачи лидера (планировщик списаний и т.п.).
+    Если продлить не удалось (аренду перехватили или БД недоступна дольше ttl), задачи
+    отменяются раньше, чем истечёт аренда в БД, — два лидера одновременно не работают.
+    Упавший процесс перестаёт продлевать аренду, и через ttl её забирает другой.
+
+    Часы: expires_at в БД — по time.time(), его сравнивают другие процессы (monotonic у каждого
+    свой); локальный срок лидерства — по time.monotonic(), чтобы перевод системных часов его не
+    продлил. Оба отсчитываются от начала запроса, расхождение часов между процессами должно
+    быть меньше safety margin.
+    """
+
+    def __init__(self, name: str, ttl: float = 30.0, renew_interval: float = 10.0):
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Задачи останавливаем с запасом до истечения аренды в БД
+        self._safety_margin = min(5.0, ttl / 5)
+        self._valid_until = 0.0
+        self._factories: Dict[str, Callable[[], Awaitable]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    def add_task(self, name: str, factory: Callable[[], Awaitable]):
+        """Задача, которая должна работать только у лидера (factory() -> корутина)."""
+        self._factories[name] = factory
+
+    def _start_tasks(self):
+        for name, factory in self._factories.items():
+            task = self._tasks.get(name)
+            if task is None or task.done():
+                # Упавшую задачу лидера перезапускаем на следующем продлении
+                self._tasks[name] = asyncio.create_task(factory())
+
+    async def _stop_tasks(self):
+        tasks, self._tasks = list(self._tasks.values()), {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _renew(self) -> bool:
+        started = time.monotonic()
+        # Продление ждёт блокировку записи; лидер ждёт его не дольше, чем действует текущая
+        # аренда (_valid_until уже с запасом до срока в БД), не лидер — не дольше ttl
+        timeout = self._valid_until - started if self.is_leader else self.ttl
+        try:
+            acquired = await asyncio.wait_for(db.acquire_lease(self.name, self.holder, self.ttl), timeout=timeout)
+        except asyncio.TimeoutError:
+            # Аренда истекла раньше, чем удалось её продлить, — задачи лидера остановятся
+            logger.warning("Lease %s renew timed out after %.1fs", self.name, timeout)
+            self._valid_until = 0.0
+            return False
+        except Exception as e:
+            logger.warning("Lease %s renew failed: %s", self.name, e)
+            return self.is_leader
+        if acquired:
+            # Отсчёт от начала запроса: в БД аренда продлена не раньше этого момента
+            self._valid_until = started + self.ttl - self._safety_margin
+        else:
+            self._valid_until = 0.0
+        return acquired
+
+    async def run(self):
+        try:
+            while True:
+                was_leader = self.is_leader
+                leader = await self._renew()
+                if leader:
+                    if not was_leader:
+                        logger.info("Lease %s acquired by %s", self.name, self.holder)
+                    self._start_tasks()
+                elif self._tasks:
+                    logger.warning("Lease %s lost by %s, stopping leader tasks", self.name, self.holder)
+                    await self._stop_tasks()
+                # Ждём до следующего продления, но не дольше срока аренды
+                delay = self.renew_interval
+                if self.is_leader:
+                    delay = min(delay, max(0.0, self._valid_until - time.monotonic()))
+                await asyncio.sleep(delay)
+        finally:
+            await self._stop_tasks()
+
+    async def release(self):
+        """Отдать аренду при остановке, чтобы другой процесс подхватил сразу, а не через ttl."""
+        await self._stop_tasks()
+        if self._valid_until:
+            self._valid_until = 0.0
+            try:
+                await db.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.warning("Lease %s release failed: %s", self.name, e)
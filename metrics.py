@@ -0,0 +1,234 @@
+"""
+Метрики в текстовом формате Prometheus (отдаются на /metrics, см. bot.py).
+
+Без prometheus_client: счётчики, gauge и гистограммы — обычные числа в памяти процесса.
+Дочерние серии (.labels(...)) кэшируются, так что на горячем пути — поиск в dict и пара сложений.
+При WORKERS > 1 у каждого процесса свои значения, а в ответ попадает тот процесс, который принял запрос.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple, object] = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# --- Метрики бота ---
+
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта хендлером", ("handler",),
+)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ("handler",))
+
+TELEGRAM_REQUEST_DURATION = Histogram(
+    "telegram_request_duration_seconds", "Длительность запросов к Telegram Bot API", ("method",),
+)
+TELEGRAM_REQUESTS = Counter(
+    "telegram_requests_total", "Запросы к Telegram Bot API по результату", ("method", "outcome"),
+)
+
+DB_CALL_DURATION = Histogram(
+    "db_call_duration_seconds", "Длительность вызовов функций database.py", ("function",),
+)
+DB_WRITE_LOCK_WAIT = Histogram(
+    "db_write_lock_wait_seconds", "Ожидание соединения-писателя SQLite",
+)
+
+BEPAID_REQUEST_DURATION = Histogram(
+    "bepaid_request_duration_seconds", "Длительность запросов к bePaid", ("operation",),
+)
+BEPAID_REQUESTS = Counter(
+    "bepaid_requests_total", "Запросы к bePaid по результату", ("operation", "outcome"),
+)
+
+BEPAID_WEBHOOKS = Counter("bepaid_webhooks_total", "Входящие вебхуки bePaid", ("status",))
+
+SCHEDULER_PASS_DURATION = Histogram(
+    "scheduler_pass_duration_seconds", "Длительность прохода планировщика",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+)
+SCHEDULER_USERS = Counter(
+    "scheduler_users_total", "Пользователи, обработанные планировщиком", ("stage", "outcome"),
+)
+SCHEDULER_LAST_PASS_USERS = Gauge(
+    "scheduler_last_pass_users", "Размер этапов последнего прохода планировщика", ("stage",),
+)
+
+RECONCILE_USERS = Counter(
+    "reconcile_users_total", "Сверка участников канала: пользователи по результату", ("outcome",),
+)
+
+
+# --- Middleware aiogram ---
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: время и ошибки по имени функции-хендлера."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_DURATION.labels(name).observe(time.perf_counter() - started)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: каждый запрос к Bot API (и из хендлеров, и из фоновых задач)."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            TELEGRAM_REQUEST_DURATION.labels(name).observe(time.perf_counter() - started)
+            TELEGRAM_REQUESTS.labels(name, outcome).inc()
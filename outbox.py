@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+import database as db
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def dump_markup(markup: Optional[InlineKeyboardMarkup]) -> Optional[str]:
+    """Клавиатура → JSON для хранения в outbox."""
+    return markup.model_dump_json(exclude_none=True) if markup is not None else None
+
+
+def load_markup(raw: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+    return InlineKeyboardMarkup.model_validate_json(raw) if raw else None
+
+
+class NotificationDispatcher:
+    """
+    Отправляет уведомления из таблицы outbox.
+
+    Планировщик и обработчик вебхуков только кладут сообщения в outbox (в той же транзакции,
+    что и изменение подписки), а отправка идёт здесь: параллельно (concurrency) под общим
+    лимитом Telegram (rate/сек), с повторами и экспоненциальной паузой при ошибках.
+    На RetryAfter притормаживаем всю отправку и переносим сообщение без списания попытки;
+    заблокировавших бота помечаем в users.blocked_at и больше не пытаемся.
+    Очерёдность сообщений одному чату держит claim_notifications: следующее берётся только
+    после того, как предыдущее отправлено или отброшено.
+    """
+
+    def __init__(self, bot: Bot, rate: float = 25.0, concurrency: int = 10,
+                 max_attempts: int = 8, retry_base_delay: float = 5.0, poll_interval: float = 30.0):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.poll_interval = poll_interval
+        self._limiter = TokenBucket(rate=rate, capacity=rate)
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    async def _send(self, row):
+        """'sent', 'dropped' (повтор бессмысленен) или время следующей попытки."""
+        notification_id, chat_id, text, reply_markup, parse_mode, attempts = row
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._limiter.acquire()
+        try:
+            await self.bot.send_message(
+                chat_id=chat_id, text=text, reply_markup=load_markup(reply_markup), parse_mode=parse_mode,
+            )
+            return "sent"
+        except TelegramRetryAfter as e:
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logger.warning("Outbox flood wait %ss (chat %s)", e.retry_after, chat_id)
+            retry_at = time.time() + e.retry_after
+            await db.retry_notification(notification_id, str(e), retry_at, count_attempt=False)
+            return retry_at
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован / чата нет / сообщение некорректно — повтор не поможет
+            logger.warning("Outbox message %s to %s dropped: %s", notification_id, chat_id, e)
+            if isinstance(e, TelegramForbiddenError):
+                await db.mark_users_blocked([chat_id])
+            await db.retry_notification(notification_id, str(e), None)
+            return "dropped"
+        except Exception as e:
+            give_up = attempts >= self.max_attempts
+            retry_in = min(self.retry_base_delay * 2 ** (attempts - 1), 3600)
+            logger.warning(
+                "Outbox message %s to %s failed (attempt %s%s): %s",
+                notification_id, chat_id, attempts, ", giving up" if give_up else f", retry in {retry_in}s", e,
+            )
+            if give_up:
+                await db.retry_notification(notification_id, str(e), None)
+                return "dropped"
+            retry_at = time.time() + retry_in
+            await db.retry_notification(notification_id, str(e), retry_at)
+            return retry_at
+
+    async def _send_limited(self, row, semaphore):
+        async with semaphore:
+            return await self._send(row)
+
+    async def _drain_once(self) -> int:
+        # По одному сообщению на чат — их можно отправлять параллельно
+        rows = await db.claim_notifications(self.concurrency * 4)
+        if not rows:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        outcomes = await asyncio.gather(*(self._send_limited(row, semaphore) for row in rows))
+        await db.complete_notifications([row[0] for row, outcome in zip(rows, outcomes) if outcome == "sent"])
+        return len(rows)
+
+    async def run(self):
+        while True:
+            try:
+                # Сбрасываем до чтения outbox: wakeup() во время запросов не потеряется
+                self._wakeup.clear()
+                if await self._drain_once():
+                    continue
+                next_at = await db.get_next_notification_at()
+                timeout = self.poll_interval if next_at is None else max(0.0, min(self.poll_interval, next_at - time.time()))
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                logger.error(f"Outbox dispatcher error: {e}")
+                await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+import database as db
+import metrics
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_JOB = "reconcile_members"
+
+# Статусы, при которых пользователь видит канал
+_IN_CHANNEL = {ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED}
+
+
+class MembershipReconciler:
+    """
+    Сверка участников канала с подписками в БД.
+
+    Проходит по известным боту пользователям (таблица users) страницами по id и для каждого
+    спрашивает get_chat_member — не больше rate запросов/сек, concurrency одновременно.
+    В канале без активной подписки — бан (как у планировщика после грейса), забанен при
+    активной подписке — разбан. Действия страницы применяются пачкой со своим лимитом
+    apply_rate; перед баном подписка перепроверяется в БД. Курсор (последний id) сохраняется
+    в job_state после каждой страницы — после рестарта проход продолжается с него.
+    С dry_run (по умолчанию) действия только пишутся в лог — применять их нужно включить явно.
+
+    Пользователей, которых нет в users, Bot API перечислить не даёт — их сверка не видит.
+    """
+
+    def __init__(self, bot: Bot, chat_id, admin_ids: Callable[[], Awaitable[frozenset]],
+                 interval: float = 24 * 3600, rate: float = 10.0, concurrency: int = 5,
+                 apply_rate: float = 2.0, page_size: int = 200, dry_run: bool = True,
+                 poll_interval: float = 60.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.admin_ids = admin_ids
+        self.interval = interval
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.poll_interval = poll_interval
+        self._check_limiter = TokenBucket(rate=rate, capacity=concurrency)
+        self._apply_limiter = TokenBucket(rate=apply_rate)
+
+    async def _call(self, limiter: TokenBucket, method, **kwargs):
+        """Запрос к Telegram под лимитом; на RetryAfter ждём и повторяем."""
+        while True:
+            await limiter.acquire()
+            try:
+                return await method(chat_id=self.chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                logger.warning("Reconcile flood wait %ss", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+    async def _check(self, user_id: int, active: bool) -> Optional[str]:
+        """'kick', 'unban' или None — что нужно сделать с пользователем."""
+        try:
+            member = await self._call(self._check_limiter, self.bot.get_chat_member, user_id=user_id)
+        except TelegramBadRequest as e:
+            # Пользователь удалил аккаунт / никогда не был в чате
+            logger.debug("Reconcile: get_chat_member %s failed: %s", user_id, e)
+            return None
+        if member.status in _IN_CHANNEL and not active:
+            if member.status == ChatMemberStatus.RESTRICTED and not getattr(member, "is_member", True):
+                return None
+            return "kick"
+        if member.status == ChatMemberStatus.KICKED and active:
+            return "unban"
+        return None
+
+    async def _check_page(self, rows, admin_ids: frozenset):
+        queue = asyncio.Queue()
+        for row in rows:
+            if row[0] not in admin_ids:
+                queue.put_nowait(row)
+        actions = []
+
+        async def worker():
+            while not queue.empty():
+                user_id, active = queue.get_nowait()
+                try:
+                    action = await self._check(user_id, bool(active))
+                except Exception as e:
+                    logger.warning("Reconcile: check of %s failed: %s", user_id, e)
+                    metrics.RECONCILE_USERS.labels("errors").inc()
+                    continue
+                metrics.RECONCILE_USERS.labels("checked").inc()
+                if action:
+                    actions.append((user_id, action))
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, queue.qsize()))))
+        return actions
+
+    async def _apply(self, actions):
+        # Между проверкой и действием пользователь мог оплатить или отменить подписку
+        active_now = await db.get_active_subscriber_ids([user_id for user_id, _ in actions])
+        for user_id, action in actions:
+            if (action == "kick") == (user_id in active_now):
+                continue
+            if self.dry_run:
+                logger.info("Reconcile (dry run): would %s user %s", action, user_id)
+                metrics.RECONCILE_USERS.labels(f"{action}_dry_run").inc()
+                continue
+            try:
+                if action == "kick":
+                    await self._call(self._apply_limiter, self.bot.ban_chat_member, user_id=user_id)
+                else:
+                    await self._call(
+                        self._apply_limiter, self.bot.unban_chat_member, user_id=user_id, only_if_banned=True,
+                    )
+                logger.info("Reconcile: %s user %s", action, user_id)
+                metrics.RECONCILE_USERS.labels(action).inc()
+            except Exception as e:
+                logger.error("Reconcile: %s of user %s failed: %s", action, user_id, e)
+                metrics.RECONCILE_USERS.labels("errors").inc()
+
+    async def run_pass(self, cursor: int = 0, started_at: Optional[float] = None):
+        """Один проход с id > cursor до конца таблицы users."""
+        started_at = started_at or time.time()
+        admin_ids = await self.admin_ids()
+        while True:
+            rows = await db.get_users_page(cursor, self.page_size)
+            if not rows:
+                break
+            actions = await self._check_page(rows, admin_ids)
+            if actions:
+                await self._apply(actions)
+            cursor = rows[-1][0]
+            await db.save_job_state(RECONCILE_JOB, cursor, started_at, None)
+        await db.save_job_state(RECONCILE_JOB, None, started_at, time.time())
+        logger.info("Reconcile pass finished in %.0fs", time.time() - started_at)
+
+    async def run(self):
+        """Только у лидера: проход раз в interval, незаконченный — продолжается с курсора."""
+        while True:
+            try:
+                state = await db.get_job_state(RECONCILE_JOB)
+                cursor, started_at, finished_at = state or (None, None, None)
+                if cursor is not None:
+                    logger.info("Reconcile: resuming after user %s", cursor)
+                    await self.run_pass(cursor, started_at)
+                elif finished_at is None or time.time() >= finished_at + self.interval:
+                    await self.run_pass()
+            except Exception as e:
+                logger.error(f"Reconcile error: {e}")
+            await asyncio.sleep(self.poll_interval)
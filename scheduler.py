@@ -0,0 +1,64 @@
+import asyncio
+import heapq
+import time
+from typing import Iterable, Optional, Tuple
+
+
+class DeadlineQueue:
+    """
+    Min-heap ближайших дедлайнов подписок (конец периода, конец грейса, очередное напоминание).
+
+    Планировщик спит ровно до ближайшего дедлайна, а не фиксированный интервал.
+    В очереди держим только дедлайны до конца текущего окна (horizon_end) — остальные
+    подтянет следующая сверка из БД. Дубликаты и устаревшие записи допустимы:
+    они дают лишь лишний (дешёвый) проход планировщика.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._horizon_end = 0.0
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def reset(self, deadlines: Iterable[Tuple[int, float]], horizon_end: float):
+        """Пересобрать очередь из свежей выборки (user_id, ts) с ts <= horizon_end."""
+        self._heap = [(ts, user_id) for user_id, ts in deadlines if ts is not None]
+        heapq.heapify(self._heap)
+        self._horizon_end = horizon_end
+        self._wakeup.set()
+
+    def arm(self, user_id: int, ts: Optional[float]):
+        """Поставить дедлайн пользователя (вызывается при изменении его дат в БД)."""
+        if ts is None or ts > self._horizon_end:
+            return
+        if not self._heap or ts < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (ts, user_id))
+
+    def next_deadline(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    async def wait(self, until: float):
+        """
+        Ждать до ближайшего дедлайна или до until (что раньше).
+        Если за время ожидания поставлен более ранний дедлайн — пересчитываем время сна.
+        """
+        while True:
+            nearest = self.next_deadline()
+            wake_at = until if nearest is None else min(until, nearest)
+            delay = wake_at - time.time()
+            if delay <= 0:
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
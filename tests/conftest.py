@@ -0,0 +1,49 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# Модули бота лежат в корне репозитория (без пакета)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Путь к пустой временной базе; подписчики database на время теста — свои."""
+    path = tmp_path / "bot.db"
+    monkeypatch.setattr(database, "DB_NAME", str(path))
+    monkeypatch.setattr(database, "_deadline_listeners", [])
+    monkeypatch.setattr(database, "_outbox_listeners", [])
+    return path
+
+
+@pytest.fixture
+def run_db(db_path):
+    """run_db(scenario): выполнить async-сценарий с открытой (init_db) временной базой."""
+
+    def run(scenario):
+        async def main():
+            await database.init_db()
+            try:
+                return await scenario()
+            finally:
+                await database.close_db()
+
+        return asyncio.run(main())
+
+    return run
+
+
+@pytest.fixture
+def bot_module(db_path, monkeypatch):
+    """Модуль bot с фиктивными токенами (сеть при импорте не используется)."""
+    for key, value in {
+        "BOT_TOKEN": "1:test", "BEPAID_SHOP_ID": "1", "BEPAID_SECRET_KEY": "secret", "CHANNEL_ID": "-100",
+    }.items():
+        monkeypatch.setenv(key, value)
+    import bot
+
+    return bot
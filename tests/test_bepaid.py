@@ -0,0 +1,54 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+import bepaid_api
+from bepaid_api import BePaidAPI
+
+
+def _charge(api):
+    return api.charge_recurrent(Decimal("30"), "BYN", "test", "42:1", "card", "user@example.com")
+
+
+def test_cancelled_probe_is_not_counted_as_failure():
+    api = BePaidAPI("shop", "secret", breaker_threshold=1, breaker_reset_timeout=0)
+    api.breaker.record_failure()
+
+    async def hang(url, payload):
+        await asyncio.Event().wait()
+
+    api._send_charge = hang
+
+    async def scenario():
+        task = asyncio.create_task(_charge(api))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return api.breaker._failures, api.breaker.allow()
+
+    failures, allowed = asyncio.run(scenario())
+
+    # Отмена не считается ошибкой и освобождает место для следующего пробного запроса
+    assert failures == 1
+    assert allowed
+    # Исход отменённого запроса неизвестен — следующий повтор начнётся со сверки
+    assert api._is_inconclusive("42:1")
+
+
+def test_inconclusive_charges_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bepaid_api.time, "monotonic", lambda: now[0])
+    api = BePaidAPI("shop", "secret", inconclusive_ttl=60)
+
+    api._mark_inconclusive("1:1")
+    now[0] += 30
+    api._mark_inconclusive("2:1")
+    now[0] += 40
+
+    assert not api._is_inconclusive("1:1")
+    assert api._is_inconclusive("2:1")
+
+    api._mark_inconclusive("3:1")
+    assert list(api._inconclusive) == ["2:1", "3:1"]
@@ -0,0 +1,77 @@
+import database
+from broadcast import Broadcaster
+
+
+class FakeBot:
+    def __init__(self):
+        self.copied = []
+        self.statuses = []
+
+    async def copy_message(self, chat_id, from_chat_id, message_id):
+        self.copied.append(chat_id)
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.statuses.append(text)
+
+
+async def _broadcast_state(broadcast_id):
+    async with database._pool.read() as conn:
+        async with conn.execute(
+            "SELECT state, attempts, sent, last_error FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ) as cursor:
+            return await cursor.fetchone()
+
+
+def test_broadcast_is_sent_to_all_recipients(run_db):
+    bot = FakeBot()
+
+    async def scenario():
+        for user_id in range(1, 6):
+            await database.add_user(user_id, f"u{user_id}", "User")
+        await database.mark_users_blocked([3])
+        broadcaster = Broadcaster(bot, rate=0, page_size=2)
+        broadcast_id = await broadcaster.start(100, 1, 100, 2, run_here=False)
+        await broadcaster.resume_unfinished()
+        await broadcaster._tasks[broadcast_id]
+        return await _broadcast_state(broadcast_id)
+
+    state = run_db(scenario)
+
+    assert bot.copied == [1, 2, 4, 5]
+    assert state[:3] == ("done", 0, 4)
+
+
+def test_failing_broadcast_backs_off_then_fails(run_db, monkeypatch):
+    bot = FakeBot()
+
+    async def broken_page(after_user_id, limit):
+        raise RuntimeError("boom")
+
+    async def scenario():
+        await database.add_user(1, "u1", "User")
+        broadcaster = Broadcaster(bot, rate=0, max_attempts=2, retry_base_delay=60)
+        broadcast_id = await broadcaster.start(100, 1, 100, 2, run_here=False)
+        monkeypatch.setattr(database, "get_broadcast_recipients", broken_page)
+
+        await broadcaster.resume_unfinished()
+        await broadcaster._tasks[broadcast_id]
+        after_first = await _broadcast_state(broadcast_id)
+        # Ждёт повтора — супервизор её не перезапускает
+        await broadcaster.resume_unfinished()
+        resumed_early = broadcast_id in broadcaster._tasks
+
+        async with database._pool.write() as conn:
+            await conn.execute("UPDATE broadcasts SET next_attempt_at = 0 WHERE id = ?", (broadcast_id,))
+        await broadcaster.resume_unfinished()
+        await broadcaster._tasks[broadcast_id]
+        after_second = await _broadcast_state(broadcast_id)
+        return after_first, resumed_early, after_second, await database.get_running_broadcasts()
+
+    after_first, resumed_early, after_second, running = run_db(scenario)
+
+    assert after_first == ("running", 1, 0, "boom")
+    assert not resumed_early
+    assert after_second[:2] == ("failed", 2)
+    assert running == []
+    assert "попытка 1/2" in bot.statuses[0]
+    assert bot.statuses[-1].startswith("❌ Рассылка остановлена после 2 неудачных попыток")
@@ -0,0 +1,76 @@
+import asyncio
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+import checkout_cache
+from checkout_cache import CheckoutCache
+
+
+class FakeBePaid:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    async def create_checkout_link(self, amount, order_id, **kwargs):
+        self.calls.append((amount, order_id))
+        await asyncio.sleep(0.05)
+        return None if self.fail else f"https://checkout.example/{len(self.calls)}"
+
+
+@pytest.fixture
+def checkout(bot_module, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(checkout_cache, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    monkeypatch.setattr(bot_module, "checkout_links", CheckoutCache(ttl=900))
+    fake = FakeBePaid()
+    monkeypatch.setattr(bot_module, "bepaid", fake)
+    return bot_module, fake, now
+
+
+def test_concurrent_requests_share_one_checkout(checkout):
+    bot_module, fake, _ = checkout
+
+    async def scenario():
+        return await asyncio.gather(
+            *(bot_module.get_checkout_link(42, Decimal("30"), "Подписка") for _ in range(5))
+        )
+
+    links = asyncio.run(scenario())
+
+    assert links == ["https://checkout.example/1"] * 5
+    assert len(fake.calls) == 1
+
+
+def test_cached_link_is_reused_until_ttl_or_price_change(checkout):
+    bot_module, fake, now = checkout
+
+    async def scenario():
+        first = await bot_module.get_checkout_link(42, Decimal("30"), "Подписка")
+        now[0] += 899
+        reused = await bot_module.get_checkout_link(42, Decimal("30"), "Подписка")
+        now[0] += 1
+        expired = await bot_module.get_checkout_link(42, Decimal("30"), "Подписка")
+        repriced = await bot_module.get_checkout_link(42, Decimal("35"), "Подписка")
+        bot_module.checkout_links.invalidate(42)
+        after_payment = await bot_module.get_checkout_link(42, Decimal("35"), "Подписка")
+        return first, reused, expired, repriced, after_payment
+
+    first, reused, expired, repriced, after_payment = asyncio.run(scenario())
+
+    assert reused == first
+    assert len({first, expired, repriced, after_payment}) == 4
+    assert [amount for amount, _ in fake.calls] == [Decimal("30"), Decimal("30"), Decimal("35"), Decimal("35")]
+
+
+def test_failed_checkout_is_not_cached(checkout):
+    bot_module, fake, _ = checkout
+    fake.fail = True
+
+    async def scenario():
+        failed = await bot_module.get_checkout_link(42, Decimal("30"), "Подписка")
+        fake.fail = False
+        return failed, await bot_module.get_checkout_link(42, Decimal("30"), "Подписка")
+
+    assert asyncio.run(scenario()) == (None, "https://checkout.example/2")
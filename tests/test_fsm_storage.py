@@ -0,0 +1,90 @@
+import asyncio
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+import database
+from fsm_storage import SQLiteStorage
+
+
+class Form(StatesGroup):
+    price = State()
+
+
+def _key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def _rows():
+    async with database._pool.read() as conn:
+        async with conn.execute("SELECT COUNT(*) FROM fsm_state") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+def test_state_and_data_round_trip_through_background_flush(run_db):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=0.01)
+        await storage.set_state(_key(1), Form.price)
+        await storage.set_data(_key(1), {"price": 30})
+        before_flush = await _rows()
+        await asyncio.sleep(0.1)
+
+        # Новый процесс: кэш пуст, значения читаются из БД
+        fresh = SQLiteStorage()
+        restored = await fresh.get_state(_key(1)), await fresh.get_data(_key(1))
+        await storage.close()
+        return before_flush, restored
+
+    before_flush, restored = run_db(scenario)
+
+    assert before_flush == 0
+    assert restored == ("Form:price", {"price": 30})
+
+
+def test_close_flushes_pending_changes_and_deletes_cleared_keys(run_db):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=60)
+        await storage.set_state(_key(1), "Form:price")
+        await storage.set_state(_key(2), "Form:price")
+        await storage.close()
+        saved = await _rows()
+
+        await storage.set_state(_key(2), None)
+        await storage.close()
+        fresh = SQLiteStorage()
+        return saved, await _rows(), await fresh.get_state(_key(1)), await fresh.get_state(_key(2))
+
+    assert run_db(scenario) == (2, 1, "Form:price", None)
+
+
+def test_least_recently_used_clean_keys_are_evicted(run_db):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=60, max_cached=2)
+        for user_id in (1, 2, 3):
+            await storage.set_data(_key(user_id), {"n": user_id})
+        # Несохранённые записи не вытесняются, даже сверх max_cached
+        unflushed = len(storage._cache)
+
+        await storage.flush()
+        await storage.get_data(_key(1))
+        await storage.get_data(_key(4))
+        cached = set(storage._cache)
+        return unflushed, cached, await storage.get_data(_key(2))
+
+    unflushed, cached, evicted_value = run_db(scenario)
+
+    assert unflushed == 3
+    key = SQLiteStorage().key_builder.build
+    assert cached == {key(_key(1)), key(_key(4))}
+    assert evicted_value == {"n": 2}
+
+
+def test_uncached_storage_is_shared_between_processes(run_db):
+    async def scenario():
+        first, second = SQLiteStorage(cached=False), SQLiteStorage(cached=False)
+        await first.set_state(_key(1), "Form:price")
+        seen = await second.get_state(_key(1))
+        await second.set_data(_key(1), {"price": 10})
+        return seen, await first.get_data(_key(1)), first._cache, first._flush_task
+
+    assert run_db(scenario) == ("Form:price", {"price": 10}, {}, None)
@@ -0,0 +1,60 @@
+import time
+from types import SimpleNamespace
+
+import database
+from invite_pool import InvitePool
+
+
+class FakeBot:
+    def __init__(self):
+        self.created = 0
+        self.revoked = []
+
+    async def create_chat_invite_link(self, chat_id, member_limit, name):
+        self.created += 1
+        return SimpleNamespace(invite_link=f"https://t.me/+link{self.created}")
+
+    async def revoke_chat_invite_link(self, chat_id, invite_link):
+        self.revoked.append(invite_link)
+
+
+async def _links():
+    async with database._pool.read() as conn:
+        async with conn.execute("SELECT link, user_id FROM invite_links ORDER BY link") as cursor:
+            return await cursor.fetchall()
+
+
+def test_take_uses_pool_then_records_direct_links(run_db):
+    bot = FakeBot()
+    pool = InvitePool(bot, -100, size=1)
+
+    async def scenario():
+        await pool._refill()
+        from_pool = await pool.take(1, "Sub_1")
+        direct = await pool.take(2, "Sub_2")
+        return from_pool, direct, await _links()
+
+    from_pool, direct, links = run_db(scenario)
+
+    assert from_pool == "https://t.me/+link1"
+    assert direct == "https://t.me/+link2"
+    assert links == [(from_pool, 1), (direct, 2)]
+
+
+def test_unused_claimed_links_are_revoked_after_retention(run_db):
+    bot = FakeBot()
+    pool = InvitePool(bot, -100, size=2, claimed_retention=3600)
+
+    async def scenario():
+        await pool._refill()
+        old = await pool.take(1, "Sub_1")
+        recent = await pool.take(2, "Sub_2")
+        async with database._pool.write() as conn:
+            await conn.execute("UPDATE invite_links SET claimed_at = ? WHERE link = ?", (time.time() - 7200, old))
+        await pool._revoke_claimed()
+        return old, recent, await _links()
+
+    old, recent, links = run_db(scenario)
+
+    assert bot.revoked == [old]
+    assert links == [(recent, 2)]
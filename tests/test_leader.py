@@ -0,0 +1,49 @@
+import asyncio
+
+import database
+from leader import LeaderLease
+
+
+def test_lease_is_taken_by_one_holder(run_db):
+    async def scenario():
+        first, second = LeaderLease("job", ttl=30), LeaderLease("job", ttl=30)
+        return await first._renew(), await second._renew(), first.is_leader, second.is_leader
+
+    assert run_db(scenario) == (True, False, True, False)
+
+
+def _run_leader_while_writer_is_busy(busy_for):
+    """Лидер с арендой на 1 сек; писатель занят busy_for сек. (задача лидера жива, лидер ли ещё)."""
+
+    async def scenario():
+        lease = LeaderLease("job", ttl=1.0, renew_interval=0.05)
+        started = asyncio.Event()
+
+        async def leader_task():
+            started.set()
+            await asyncio.Event().wait()
+
+        lease.add_task("job", leader_task)
+        runner = asyncio.create_task(lease.run())
+        await asyncio.wait_for(started.wait(), timeout=1)
+        task = lease._tasks["job"]
+
+        async with database._pool.write():
+            await asyncio.sleep(busy_for)
+            state = not task.done(), lease.is_leader
+
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        return state
+
+    return scenario
+
+
+def test_short_writer_stall_keeps_leadership(run_db):
+    # Аренда действует ещё ~0.8 сек — продление дождётся писателя
+    assert run_db(_run_leader_while_writer_is_busy(0.3)) == (True, True)
+
+
+def test_stuck_renew_stops_leader_tasks_when_lease_runs_out(run_db):
+    # Писатель занят дольше, чем живёт аренда, — задачи останавливаются до её истечения в БД
+    assert run_db(_run_leader_while_writer_is_busy(1.2)) == (False, False)
@@ -0,0 +1,146 @@
+import asyncio
+import contextlib
+import sqlite3
+
+import database
+
+# users в том виде, в каком её создавали версии до миграций (user_version = 0)
+LEGACY_USERS = """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        agreed_to_terms BOOLEAN DEFAULT 0,
+        subscription_active BOOLEAN DEFAULT 0,
+        join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        bepaid_uid TEXT,
+        card_token TEXT,
+        subscription_end_date TIMESTAMP,
+        last_payment_date TIMESTAMP,
+        email TEXT,
+        grace_until_ts REAL,
+        last_payment_fail_ts REAL,
+        last_payment_fail_notice_ts REAL
+    )
+"""
+
+
+def _make_legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_USERS)
+    conn.execute("CREATE TABLE admins (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)")
+    conn.executemany(
+        "INSERT INTO users (id, username, subscription_active, card_token, subscription_end_date, "
+        "join_date, grace_until_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (1, "paid", 1, "tok", 1700000000.75, "2023-11-14 22:13:20", None),
+            (2, "grace", 1, "", 1700000000.0, None, 1700086400.5),
+            (3, "text_date", 0, None, "2024-01-31 12:00:00", "2024-01-31 12:00:00", None),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+
+def _open_db(path):
+    asyncio.run(_init_and_close())
+    return sqlite3.connect(path)
+
+
+async def _init_and_close():
+    await database.init_db()
+    await database.close_db()
+
+
+def test_legacy_db_is_migrated_to_latest_version(db_path):
+    _make_legacy_db(db_path)
+    conn = _open_db(db_path)
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database._MIGRATIONS)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_users_due_charge", "idx_users_grace_pending", "idx_users_active_grace"} <= indexes
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"transactions", "webhook_inbox", "outbox", "leases", "daily_stats"} <= tables
+
+
+def test_legacy_dates_are_converted_to_integer_epoch(db_path):
+    _make_legacy_db(db_path)
+    conn = _open_db(db_path)
+
+    rows = conn.execute(
+        "SELECT id, subscription_end_date, typeof(subscription_end_date), join_date, typeof(join_date), "
+        "grace_until_ts FROM users ORDER BY id"
+    ).fetchall()
+    assert rows[0] == (1, 1700000000, "integer", 1700000000, "integer", None)
+    assert rows[1][1:3] == (1700000000, "integer") and rows[1][4] == "integer" and rows[1][5] == 1700086400
+    assert rows[2][1] == 1706702400
+
+
+def test_migrations_are_not_reapplied(db_path):
+    _make_legacy_db(db_path)
+    _open_db(db_path).close()
+    conn = _open_db(db_path)
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database._MIGRATIONS)
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 3
+
+
+def test_fresh_db_gets_full_schema(db_path):
+    conn = _open_db(db_path)
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database._MIGRATIONS)
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(users)")}
+    assert columns["subscription_end_date"] == "INTEGER"
+    assert columns["blocked_at"] == "INTEGER"
+
+
+SCHEDULER_QUERIES = (
+    "get_users_due_payment",
+    "get_users_expired_no_card_start_grace",
+    "get_users_expired_no_card_to_kick",
+    "get_users_in_grace_to_notify",
+)
+
+
+def test_scheduler_queries_use_partial_indexes_after_rebuild(db_path, monkeypatch):
+    _make_legacy_db(db_path)
+    original_read = database._pool.read
+    queries = {}
+
+    class Recorder:
+        def __init__(self, conn, name):
+            self.conn, self.name = conn, name
+
+        def execute(self, sql, params=()):
+            queries[self.name] = (sql, params)
+            return self.conn.execute(sql, params)
+
+    async def scenario():
+        # Миграция 12 пересобирает users — планы проверяем уже на новой таблице
+        await database.init_db()
+        plans = {}
+        try:
+            for name in SCHEDULER_QUERIES:
+                @contextlib.asynccontextmanager
+                async def recording_read(name=name):
+                    async with original_read() as conn:
+                        yield Recorder(conn, name)
+
+                monkeypatch.setattr(database._pool, "read", recording_read)
+                await getattr(database, name)()
+                monkeypatch.setattr(database._pool, "read", original_read)
+                sql, params = queries[name]
+                async with database._pool.read() as conn:
+                    async with conn.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                        plans[name] = [row[3] for row in await cursor.fetchall()]
+        finally:
+            await database.close_db()
+        return plans
+
+    plans = asyncio.run(scenario())
+
+    assert sorted(plans) == sorted(SCHEDULER_QUERIES)
+    for name, details in plans.items():
+        assert any(d.startswith("SEARCH users USING INDEX idx_users_") for d in details), (name, details)
+        assert not any(d.startswith("SCAN users") for d in details), (name, details)
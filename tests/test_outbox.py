@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import database
+from outbox import NotificationDispatcher
+
+
+class FakeBot:
+    def __init__(self, failures=()):
+        self.sent = []
+        self.failures = list(failures)
+
+    async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((chat_id, text))
+
+
+async def _outbox():
+    async with database._pool.read() as conn:
+        async with conn.execute(
+            "SELECT text, state, attempts, next_attempt_at FROM outbox ORDER BY id"
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+def test_claim_takes_only_first_pending_message_per_chat(run_db):
+    async def scenario():
+        for chat_id, text in ((1, "a1"), (1, "a2"), (2, "b1")):
+            await database.enqueue_notification(chat_id, text)
+        first = await database.claim_notifications(10)
+        # a1 ещё отправляется — a2 не берём
+        second = await database.claim_notifications(10)
+
+        a1, b1 = first[0][0], first[1][0]
+        await database.complete_notifications([b1])
+        retry_at = time.time() + 60
+        await database.retry_notification(a1, "timeout", retry_at)
+        while_retrying = await database.claim_notifications(10), await database.get_next_notification_at()
+
+        await database.retry_notification(a1, "bad request", None)
+        after_drop = await database.claim_notifications(10)
+        return first, second, while_retrying, retry_at, after_drop
+
+    first, second, (while_retrying, next_at), retry_at, after_drop = run_db(scenario)
+
+    assert [text for _, _, text, *_ in first] == ["a1", "b1"]
+    assert second == []
+    assert while_retrying == []
+    assert next_at == retry_at
+    assert [text for _, _, text, *_ in after_drop] == ["a2"]
+
+
+def test_dispatcher_keeps_chat_order_across_retries(run_db):
+    bot = FakeBot(failures=[RuntimeError("timeout")])
+    dispatcher = NotificationDispatcher(bot, rate=0, retry_base_delay=30)
+
+    async def scenario():
+        await database.enqueue_notification(1, "first")
+        await database.enqueue_notification(1, "second")
+        await dispatcher._drain_once()
+        after_failure = await _outbox()
+        drained_early = await dispatcher._drain_once()
+
+        async with database._pool.write() as conn:
+            await conn.execute("UPDATE outbox SET next_attempt_at = 0")
+        while await dispatcher._drain_once():
+            pass
+        return after_failure, drained_early, await _outbox()
+
+    after_failure, drained_early, left = run_db(scenario)
+
+    (_, state, attempts, retry_at), waiting = after_failure
+    assert (state, attempts) == ("pending", 1)
+    assert 25 < retry_at - time.time() <= 30
+    # Второе сообщение ждёт первое и попытку не тратит
+    assert waiting[1:3] == ("pending", 0)
+    assert drained_early == 0
+    assert bot.sent == [(1, "first"), (1, "second")]
+    assert left == []
+
+
+def test_dispatcher_backs_off_and_gives_up(run_db):
+    flood = TelegramRetryAfter(method=SendMessage(chat_id=1, text="x"), message="flood", retry_after=5)
+    bot = FakeBot(failures=[flood] + [RuntimeError("timeout")] * 3)
+    dispatcher = NotificationDispatcher(bot, rate=0, max_attempts=3, retry_base_delay=10)
+    delays = []
+
+    async def scenario():
+        await database.enqueue_notification(1, "text")
+        await database.enqueue_notification(1, "next")
+        for _ in range(4):
+            await dispatcher._drain_once()
+            text, state, attempts, next_attempt_at = (await _outbox())[0]
+            delays.append((state, attempts, round(next_attempt_at - time.time())))
+            dispatcher._paused_until = 0.0
+            async with database._pool.write() as conn:
+                await conn.execute("UPDATE outbox SET next_attempt_at = 0 WHERE text = ?", (text,))
+        await dispatcher._drain_once()
+        return await _outbox()
+
+    left = run_db(scenario)
+
+    # RetryAfter не списывает попытку; дальше — 10, 20 сек и failed после max_attempts
+    assert delays[0] == ("pending", 0, 5)
+    assert delays[1] == ("pending", 1, 10)
+    assert delays[2] == ("pending", 2, 20)
+    assert delays[3][:2] == ("failed", 3)
+    # Отброшенное сообщение не задерживает следующее в этом чате
+    assert bot.sent == [(1, "next")]
+    assert [row[:2] for row in left] == [("text", "failed")]
+
+
+def test_message_queued_while_dispatcher_goes_idle_is_sent_at_once(run_db, monkeypatch):
+    bot = FakeBot()
+    dispatcher = NotificationDispatcher(bot, rate=0, poll_interval=30)
+    database.add_outbox_listener(dispatcher.wakeup)
+    original = database.get_next_notification_at
+    queued = []
+
+    async def next_at_with_new_message():
+        # Сообщение приходит сразу после того, как диспетчер выяснил, сколько спать
+        next_at = await original()
+        if not queued:
+            queued.append(True)
+            await database.enqueue_notification(1, "late")
+        return next_at
+
+    monkeypatch.setattr(database, "get_next_notification_at", next_at_with_new_message)
+
+    async def scenario():
+        runner = asyncio.create_task(dispatcher.run())
+        try:
+            for _ in range(100):
+                if bot.sent:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+
+    run_db(scenario)
+
+    assert bot.sent == [(1, "late")]
@@ -0,0 +1,89 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from database import _ConnectionPool
+
+
+def _run(path, scenario, readers=2):
+    async def main():
+        pool = _ConnectionPool()
+        await pool.open(str(path), readers=readers)
+        try:
+            return await scenario(pool)
+        finally:
+            await pool.close()
+
+    return asyncio.run(main())
+
+
+async def _values(pool):
+    async with pool.read() as conn:
+        async with conn.execute("SELECT value FROM t ORDER BY value") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+def test_write_commits_and_is_visible_to_readers(tmp_path):
+    async def scenario(pool):
+        async with pool.write() as conn:
+            await conn.execute("CREATE TABLE t (value INTEGER)")
+            await conn.execute("INSERT INTO t VALUES (1)")
+        async with pool.read() as conn:
+            mode = await (await conn.execute("PRAGMA journal_mode")).fetchone()
+        return await _values(pool), mode[0]
+
+    values, mode = _run(tmp_path / "pool.db", scenario)
+
+    assert values == [1]
+    assert mode == "wal"
+
+
+def test_failed_write_is_rolled_back_and_releases_lock(tmp_path):
+    async def scenario(pool):
+        async with pool.write() as conn:
+            await conn.execute("CREATE TABLE t (value INTEGER)")
+        with pytest.raises(RuntimeError):
+            async with pool.write() as conn:
+                await conn.execute("INSERT INTO t VALUES (1)")
+                raise RuntimeError("boom")
+        async with pool.write() as conn:
+            await conn.execute("INSERT INTO t VALUES (2)")
+        return await _values(pool)
+
+    assert _run(tmp_path / "pool.db", scenario) == [2]
+
+
+def test_readers_are_query_only_and_shared(tmp_path):
+    async def scenario(pool):
+        async with pool.write() as conn:
+            await conn.execute("CREATE TABLE t (value INTEGER)")
+        async with pool.read() as first, pool.read() as second:
+            distinct = first is not second
+        # Свободных читателей нет — следующий ждёт, пока вернут соединение
+        async with pool.read():
+            async with pool.read():
+                waiter = asyncio.create_task(_values(pool))
+                await asyncio.sleep(0.05)
+                blocked = not waiter.done()
+        await waiter
+        with pytest.raises(sqlite3.OperationalError):
+            async with pool.read() as conn:
+                await conn.execute("INSERT INTO t VALUES (1)")
+        return distinct, blocked
+
+    assert _run(tmp_path / "pool.db", scenario) == (True, True)
+
+
+def test_closed_pool_rejects_calls(tmp_path):
+    async def scenario():
+        pool = _ConnectionPool()
+        await pool.open(str(tmp_path / "pool.db"), readers=1)
+        await pool.close()
+        await pool.close()
+        with pytest.raises(RuntimeError):
+            async with pool.write():
+                pass
+        return pool.is_open
+
+    assert asyncio.run(scenario()) is False
@@ -0,0 +1,106 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiogram.enums import ChatMemberStatus
+
+import database
+from reconcile import RECONCILE_JOB, MembershipReconciler
+
+MEMBER, KICKED, LEFT = ChatMemberStatus.MEMBER, ChatMemberStatus.KICKED, ChatMemberStatus.LEFT
+
+
+class Crash(BaseException):
+    """Процесс «упал» посреди прохода."""
+
+
+class FakeBot:
+    def __init__(self, statuses, crash_on=None):
+        self.statuses = statuses
+        self.crash_on = crash_on
+        self.checked = []
+        self.banned = []
+        self.unbanned = []
+
+    async def get_chat_member(self, chat_id, user_id):
+        if user_id == self.crash_on:
+            raise Crash()
+        self.checked.append(user_id)
+        return SimpleNamespace(status=self.statuses.get(user_id, LEFT))
+
+    async def ban_chat_member(self, chat_id, user_id):
+        self.banned.append(user_id)
+
+    async def unban_chat_member(self, chat_id, user_id, only_if_banned):
+        self.unbanned.append(user_id)
+
+
+# 1 — админ в канале без подписки, 2 — в канале без подписки, 3 — забанен с подпиской,
+# 4 — в канале с подпиской, 5 — не в канале
+STATUSES = {1: MEMBER, 2: MEMBER, 3: KICKED, 4: MEMBER}
+
+
+async def _admins():
+    return frozenset({1})
+
+
+async def _seed():
+    for user_id in range(1, 6):
+        await database.add_user(user_id, f"u{user_id}", "User")
+    for user_id in (3, 4):
+        await database.set_subscription(user_id, status=True, end_date=time.time() + 3600)
+
+
+def _reconciler(bot, **kwargs):
+    return MembershipReconciler(bot, -100, _admins, rate=0, apply_rate=0, page_size=2, **kwargs)
+
+
+def test_dry_run_is_the_default(run_db):
+    bot = FakeBot(STATUSES)
+
+    async def scenario():
+        await _seed()
+        await _reconciler(bot).run_pass()
+        return await database.get_job_state(RECONCILE_JOB)
+
+    cursor, started_at, finished_at = run_db(scenario)
+
+    assert sorted(bot.checked) == [2, 3, 4, 5]
+    assert bot.banned == [] and bot.unbanned == []
+    assert cursor is None and finished_at >= started_at
+
+
+def test_apply_bans_and_unbans_but_skips_admins(run_db):
+    bot = FakeBot(STATUSES)
+
+    async def scenario():
+        await _seed()
+        await _reconciler(bot, dry_run=False).run_pass()
+
+    run_db(scenario)
+
+    assert 1 not in bot.checked
+    assert bot.banned == [2]
+    assert bot.unbanned == [3]
+
+
+def test_interrupted_pass_resumes_from_saved_cursor(run_db):
+    async def scenario():
+        await _seed()
+        crashed = FakeBot(STATUSES, crash_on=4)
+        with pytest.raises(Crash):
+            await _reconciler(crashed, dry_run=False).run_pass()
+        cursor, started_at, finished_at = await database.get_job_state(RECONCILE_JOB)
+
+        resumed = FakeBot(STATUSES)
+        await _reconciler(resumed, dry_run=False).run_pass(cursor, started_at)
+        return crashed, (cursor, finished_at), resumed, await database.get_job_state(RECONCILE_JOB)
+
+    crashed, (cursor, finished_at), resumed, final = run_db(scenario)
+
+    # Первая страница (1, 2) сохранена курсором; вторая оборвалась на пользователе 4
+    assert cursor == 2 and finished_at is None
+    assert crashed.banned == [2]
+    assert sorted(resumed.checked) == [3, 4, 5]
+    assert resumed.unbanned == [3]
+    assert final[0] is None and final[2] is not None
@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+from scheduler import DeadlineQueue
+
+
+def test_pop_due_returns_users_in_deadline_order():
+    queue = DeadlineQueue()
+    queue.reset([(1, 30.0), (2, 10.0), (3, None), (4, 20.0)], horizon_end=100.0)
+
+    assert len(queue) == 3
+    assert queue.next_deadline() == 10.0
+    assert queue.pop_due(25.0) == [2, 4]
+    assert queue.pop_due(25.0) == []
+    assert queue.next_deadline() == 30.0
+
+
+def test_arm_ignores_deadlines_beyond_horizon():
+    queue = DeadlineQueue()
+    queue.reset([], horizon_end=100.0)
+
+    queue.arm(1, 150.0)
+    queue.arm(2, None)
+    queue.arm(3, 50.0)
+
+    assert queue.pop_due(200.0) == [3]
+
+
+def test_wait_wakes_up_for_earlier_deadline():
+    async def scenario():
+        queue = DeadlineQueue()
+        queue.reset([], horizon_end=time.time() + 3600)
+        started = time.monotonic()
+        waiter = asyncio.create_task(queue.wait(time.time() + 10))
+        await asyncio.sleep(0.05)
+        queue.arm(1, time.time() + 0.1)
+        await asyncio.wait_for(waiter, timeout=2)
+        return time.monotonic() - started, queue.pop_due(time.time())
+
+    elapsed, due = asyncio.run(scenario())
+
+    assert elapsed < 1
+    assert due == [1]
+
+
+def test_wait_returns_at_until_without_deadlines():
+    async def scenario():
+        queue = DeadlineQueue()
+        started = time.monotonic()
+        await queue.wait(time.time() + 0.1)
+        return time.monotonic() - started
+
+    assert 0.05 < asyncio.run(scenario()) < 1
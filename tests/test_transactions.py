@@ -0,0 +1,221 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import database
+
+
+class Crash(BaseException):
+    """Процесс «упал»: не перехватывается обработчиками except Exception."""
+
+
+def _payment(uid="tx-1", user_id=42, status="successful"):
+    return {
+        "uid": uid, "status": status, "tracking_id": f"{user_id}:1", "amount": 3000, "currency": "BYN",
+        "credit_card": {"token": "card"}, "customer": {"email": "user@example.com"},
+    }
+
+
+def test_claim_is_repeated_until_applied(run_db):
+    async def scenario():
+        await database.add_user(42, "u", "User")
+        claims = [await database.claim_transaction("tx-1", "42:1", 42, "successful", 3000, "BYN") for _ in range(2)]
+        batch = database.WriteBatch()
+        batch.set_subscription(42, status=True, end_date=time.time() + 3600)
+        applied = await batch.flush_for_transaction("tx-1")
+        batch.set_subscription(42, status=True, end_date=time.time() + 7200)
+        applied_again = await batch.flush_for_transaction("tx-1")
+        claim_after = await database.claim_transaction("tx-1", "42:1", 42, "successful", 3000, "BYN")
+        return claims, applied, applied_again, claim_after, await database.get_user_subscription(42)
+
+    claims, applied, applied_again, claim_after, subscription = run_db(scenario)
+
+    # Пока изменение не применено, повторная доставка снова получает транзакцию
+    assert claims == [True, True]
+    assert applied and not applied_again
+    assert claim_after is False
+    assert subscription[1] <= time.time() + 3600
+
+
+def test_status_change_is_processed_again(run_db):
+    async def scenario():
+        first = await database.claim_transaction("tx-1", "42:1", 42, "failed", 3000, "BYN")
+        await database.WriteBatch().flush_for_transaction("tx-1")
+        duplicate = await database.claim_transaction("tx-1", "42:1", 42, "failed", 3000, "BYN")
+        changed = await database.claim_transaction("tx-1", "42:1", 42, "successful", 3000, "BYN")
+        return first, duplicate, changed
+
+    assert run_db(scenario) == (True, False, True)
+
+
+def test_recurring_charge_is_recorded_as_processed(run_db):
+    async def scenario():
+        claimed = await database.claim_transaction("tx-1", "42:1", 42, "successful", 3000, "BYN",
+                                                   kind="recurring", processed=True)
+        return claimed, await database.claim_transaction("tx-1", "42:1", 42, "successful", 3000, "BYN")
+
+    assert run_db(scenario) == (False, False)
+
+
+def test_crash_between_claim_and_apply_is_redelivered(run_db, bot_module, monkeypatch):
+    async def take(user_id, name):
+        return "https://t.me/+invite"
+
+    async def unban(**kwargs):
+        return True
+
+    async def crash(user_id):
+        raise Crash()
+
+    monkeypatch.setattr(bot_module.invite_pool, "take", take)
+    monkeypatch.setattr(bot_module.bot, "unban_chat_member", unban)
+
+    async def run_job():
+        job = await database.claim_webhook_job()
+        job_id, payload, _ = job
+        await bot_module.process_bepaid_notification(json.loads(payload))
+        await database.complete_webhook_job(job_id)
+
+    async def scenario():
+        await database.add_user(42, "u", "User")
+        await database.enqueue_webhook(json.dumps(_payment()))
+
+        # Падение после claim_transaction, до продления подписки
+        original = database.get_user_subscription
+        monkeypatch.setattr(database, "get_user_subscription", crash)
+        with pytest.raises(Crash):
+            await run_job()
+        monkeypatch.setattr(database, "get_user_subscription", original)
+        after_crash = await database.get_user_subscription(42)
+
+        # Задача «зависла» в processing — через WEBHOOK_CLAIM_TIMEOUT её берут снова
+        async with database._pool.write() as conn:
+            await conn.execute("UPDATE webhook_inbox SET claimed_at = 0")
+        await run_job()
+        applied = await database.get_user_subscription(42)
+
+        # Повторная доставка того же uid не продлевает подписку второй раз
+        await database.enqueue_webhook(json.dumps(_payment()))
+        await run_job()
+        return after_crash, applied, await database.get_user_subscription(42), await database.get_daily_stats(1)
+
+    after_crash, applied, replayed, stats = run_db(scenario)
+
+    assert after_crash[0] == 0
+    assert applied[0] == 1 and applied[2] == "card"
+    assert replayed == applied
+    assert stats[0][1:3] == (1, 0)
+
+
+def test_failed_notification_is_retried_without_reapplying(run_db, bot_module, monkeypatch):
+    calls = []
+
+    async def take(user_id, name):
+        calls.append(user_id)
+        if len(calls) == 1:
+            raise RuntimeError("telegram is down")
+        return "https://t.me/+invite"
+
+    async def unban(**kwargs):
+        return True
+
+    monkeypatch.setattr(bot_module.invite_pool, "take", take)
+    monkeypatch.setattr(bot_module.bot, "unban_chat_member", unban)
+
+    async def scenario():
+        await database.add_user(42, "u", "User")
+        with pytest.raises(bot_module.PaymentNotificationError):
+            await bot_module.process_bepaid_notification(_payment())
+        after_failure = await database.get_user_subscription(42), await database.needs_notification("tx-1")
+
+        # Повтор задачи вебхука: продление пропускается, уходит только уведомление
+        await bot_module.process_bepaid_notification(_payment())
+        await bot_module.process_bepaid_notification(_payment())
+        return (
+            after_failure, await database.get_user_subscription(42), await database.needs_notification("tx-1"),
+            await database.claim_notifications(10), await database.get_daily_stats(1),
+        )
+
+    (subscription, pending), retried, pending_after, notifications, stats = run_db(scenario)
+
+    assert subscription[0] == 1 and pending
+    assert retried == subscription
+    assert not pending_after
+    assert len(notifications) == 1
+    assert "https://t.me/+invite" in notifications[0][3]
+    assert calls == [42, 42]
+    assert stats[0][1] == 1
+
+
+def test_webhook_job_is_kept_until_invite_is_delivered(run_db, bot_module, monkeypatch):
+    attempts_before_invite = bot_module.WEBHOOK_MAX_ATTEMPTS + 2
+    calls = []
+
+    async def take(user_id, name):
+        calls.append(user_id)
+        if len(calls) <= attempts_before_invite:
+            raise RuntimeError("invite pool is empty")
+        return "https://t.me/+invite"
+
+    async def unban(**kwargs):
+        return True
+
+    monkeypatch.setattr(bot_module.invite_pool, "take", take)
+    monkeypatch.setattr(bot_module.bot, "unban_chat_member", unban)
+
+    async def run_job():
+        async with database._pool.write() as conn:
+            await conn.execute("UPDATE webhook_inbox SET next_attempt_at = 0")
+        await bot_module.handle_webhook_job(await database.claim_webhook_job())
+
+    async def scenario():
+        await database.add_user(42, "u", "User")
+        await database.enqueue_webhook(json.dumps(_payment()))
+        for _ in range(attempts_before_invite):
+            await run_job()
+        async with database._pool.read() as conn:
+            async with conn.execute("SELECT state, attempts FROM webhook_inbox") as cursor:
+                stuck = await cursor.fetchall()
+        await run_job()
+        async with database._pool.read() as conn:
+            async with conn.execute("SELECT COUNT(*) FROM webhook_inbox") as cursor:
+                (left,) = await cursor.fetchone()
+        return stuck, left, await database.claim_notifications(10), await database.get_daily_stats(1)
+
+    stuck, left, notifications, stats = run_db(scenario)
+
+    # Лимит попыток исчерпан, но оплаченная задача не переходит в failed
+    assert stuck == [("pending", attempts_before_invite)]
+    assert left == 0
+    assert len(notifications) == 1
+    assert "https://t.me/+invite" in notifications[0][3]
+    assert stats[0][1] == 1
+
+
+def test_webhook_job_interrupted_by_shutdown_is_requeued(run_db, bot_module, monkeypatch):
+    started = []
+
+    async def hang(transaction):
+        started.append(transaction["uid"])
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(bot_module, "process_bepaid_notification", hang)
+
+    async def scenario():
+        await database.enqueue_webhook(json.dumps(_payment()))
+        worker = asyncio.create_task(bot_module.handle_webhook_job(await database.claim_webhook_job()))
+        while not started:
+            await asyncio.sleep(0.01)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        async with database._pool.read() as conn:
+            async with conn.execute("SELECT state, attempts FROM webhook_inbox") as cursor:
+                state = await cursor.fetchall()
+        return state, await database.claim_webhook_job()
+
+    state, reclaimed = run_db(scenario)
+
+    assert state == [("pending", 0)]
+    assert reclaimed is not None and reclaimed[2] == 1
@@ -0,0 +1,47 @@
+import time
+
+import database
+
+
+def test_flush_writes_all_rows_and_arms_deadlines(run_db):
+    armed = []
+    database.add_deadline_listener(lambda user_id, ts: armed.append((user_id, ts)))
+    end_date = int(time.time()) + 3600
+
+    async def scenario():
+        for user_id in (1, 2, 3):
+            await database.add_user(user_id, f"u{user_id}", "User")
+        batch = database.WriteBatch(chunk_size=2)
+        for user_id in (1, 2, 3):
+            batch.set_subscription(user_id, status=True, end_date=end_date, card_token="tok")
+        batch.count_stats(renewals=3)
+        failed = await batch.flush()
+        return failed, [await database.get_user_subscription(user_id) for user_id in (1, 2, 3)]
+
+    failed, subscriptions = run_db(scenario)
+
+    assert failed == 0
+    assert subscriptions == [(1, end_date, "tok")] * 3
+    assert sorted(armed) == [(1, end_date), (2, end_date), (3, end_date)]
+
+
+def test_failed_chunk_is_replayed_row_by_row(run_db):
+    async def scenario():
+        for user_id in (1, 2):
+            await database.add_user(user_id, f"u{user_id}", "User")
+        batch = database.WriteBatch()
+        batch.set_subscription(1, status=True, end_date=time.time() + 60)
+        # outbox.text NOT NULL — эта строка роняет весь чанк
+        batch.notify(1, None)
+        batch.set_subscription(2, status=True, end_date=time.time() + 60)
+        batch.notify(2, "ok")
+        failed = await batch.flush()
+        active = await database.get_all_active_users()
+        notifications = await database.claim_notifications(10)
+        return failed, active, notifications
+
+    failed, active, notifications = run_db(scenario)
+
+    assert failed == 1
+    assert sorted(active) == [1, 2]
+    assert [(chat_id, text) for _, chat_id, text, *_ in notifications] == [(2, "ok")]
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket: в среднем не больше rate операций в секунду,
+    кратковременный всплеск — до capacity. rate <= 0 отключает ограничение.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, tokens: float = 1.0):
+        if self.rate <= 0:
+            return
+        # Лок даёт очередь FIFO: ждущие получают токены в порядке прихода
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса: после failure_threshold ошибок подряд «размыкается»
+    на reset_timeout секунд — запросы не отправляем. Затем пропускает один пробный запрос:
+    успех замыкает цепь, ошибка размыкает снова.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half-open" if self.retry_in() == 0 else "open"
+
+    def retry_in(self) -> float:
+        """Через сколько секунд можно пробовать снова (0 — уже можно)."""
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        if self.retry_in() == 0 and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """Пробный запрос отменён без ответа: состояние не меняем, следующий allow() пропустит новый."""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probe_in_flight or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._probe_in_flight = False